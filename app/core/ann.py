@@ -0,0 +1,73 @@
+import os
+import math
+import faiss
+
+# 搜尋索引類型 (ingest 時決定)：
+# - flat  : 精確搜尋 (預設)，成本與 chunk 數線性成長
+# - ivf   : IVF{nlist},Flat，只搜尋 nprobe 個最近的群
+# - ivfpq : IVF{nlist},PQ{m}x{nbits}，再以 Product Quantization 壓縮向量 (省 RAM)
+# - hnsw  : HNSW{M},Flat 圖索引，以 efSearch 控制召回率/延遲
+INDEX_TYPES = ("flat", "ivf", "ivfpq", "hnsw")
+
+INDEX_TYPE = os.getenv("INDEX_TYPE", "flat").lower()
+INDEX_NLIST = int(os.getenv("INDEX_NLIST", "0")) # 0 = 依資料量自動決定
+INDEX_NPROBE = int(os.getenv("INDEX_NPROBE", "16"))
+INDEX_PQ_M = int(os.getenv("INDEX_PQ_M", "48")) # 需整除向量維度 (MiniLM 為 384)
+INDEX_PQ_NBITS = int(os.getenv("INDEX_PQ_NBITS", "8"))
+INDEX_HNSW_M = int(os.getenv("INDEX_HNSW_M", "32"))
+INDEX_EF_CONSTRUCTION = int(os.getenv("INDEX_EF_CONSTRUCTION", "80"))
+INDEX_EF_SEARCH = int(os.getenv("INDEX_EF_SEARCH", "64"))
+
+# FAISS 建議每個群至少 39 個訓練點
+MIN_POINTS_PER_LIST = 39
+
+def auto_nlist(n_vectors):
+    """常見經驗值：nlist ≈ 4·sqrt(N)，並確保每個群有足夠的訓練資料"""
+    nlist = int(4 * math.sqrt(max(n_vectors, 1)))
+    return max(1, min(nlist, n_vectors // MIN_POINTS_PER_LIST))
+
+def build_search_index(vectors, index_type=INDEX_TYPE, nlist=INDEX_NLIST, nprobe=INDEX_NPROBE,
+                       pq_m=INDEX_PQ_M, pq_nbits=INDEX_PQ_NBITS, hnsw_m=INDEX_HNSW_M,
+                       ef_construction=INDEX_EF_CONSTRUCTION, ef_search=INDEX_EF_SEARCH):
+    """
+    依 index_type 訓練並建立搜尋索引 (L2 距離，與 LangChain FAISS 預設一致)。
+    nprobe/efSearch 會寫進索引檔，serving 端 faiss.read_index 後直接生效。
+    資料量太少無法訓練 IVF 時退回 flat。
+    回傳 (index, 說明文字)
+    """
+    n, d = vectors.shape
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f"未知的 INDEX_TYPE: {index_type} (可用: {', '.join(INDEX_TYPES)})")
+
+    if index_type == "hnsw":
+        index = faiss.IndexHNSWFlat(d, hnsw_m)
+        index.hnsw.efConstruction = ef_construction
+        index.hnsw.efSearch = ef_search
+        index.add(vectors)
+        return index, f"HNSW{hnsw_m},Flat (efSearch={ef_search})"
+
+    if index_type in ("ivf", "ivfpq"):
+        nlist = nlist or auto_nlist(n)
+        if n >= nlist * MIN_POINTS_PER_LIST and nlist > 1:
+            spec = f"IVF{nlist},Flat" if index_type == "ivf" else f"IVF{nlist},PQ{pq_m}x{pq_nbits}"
+            index = faiss.index_factory(d, spec, faiss.METRIC_L2)
+            index.train(vectors)
+            index.add(vectors)
+            index.nprobe = min(nprobe, nlist)
+            return index, f"{spec} (nprobe={index.nprobe})"
+        index_type = "flat"
+        note = f"資料量 {n} 不足以訓練 IVF，改用 "
+    else:
+        note = ""
+
+    index = faiss.IndexFlatL2(d)
+    index.add(vectors)
+    return index, f"{note}Flat (精確搜尋)"
+
+def set_search_params(index, nprobe=None, ef_search=None):
+    """(serving 端) 覆寫索引檔中的搜尋參數"""
+    ivf = faiss.try_extract_index_ivf(index)
+    if nprobe and ivf is not None:
+        ivf.nprobe = nprobe
+    if ef_search and isinstance(index, faiss.IndexHNSW):
+        index.hnsw.efSearch = ef_search
@@ -0,0 +1,126 @@
+import os
+import re
+import time
+import threading
+from collections import OrderedDict
+import numpy as np
+from app.core.metrics import FuncMetric
+
+# 回答快取設定 (可用環境變數調整)
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "512"))
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", "3600"))
+# 語意相似門檻 (cosine)，未設定時只做完全相同問題的比對
+_similarity = os.getenv("ANSWER_CACHE_SIMILARITY", "")
+ANSWER_CACHE_SIMILARITY = float(_similarity) if _similarity else None
+
+_TRAILING_PUNCT = "?？。.!！、,，;；:： "
+
+def normalize_query(query):
+    """正規化問題：轉小寫、合併空白、去掉結尾標點 ("What is EGFR status?" == "what is egfr status")"""
+    return re.sub(r"\s+", " ", query.strip().lower()).rstrip(_TRAILING_PUNCT)
+
+class AnswerCache:
+    """
+    回答快取 (TTL + LRU)。
+    key = (病歷 source, 索引版本, 正規化後的問題)；
+    若有設定 similarity_threshold，完全比對失敗時會再用問題向量找同一病歷下的近似問題。
+    """
+
+    def __init__(self, max_entries=ANSWER_CACHE_SIZE, ttl_seconds=ANSWER_CACHE_TTL,
+                 similarity_threshold=ANSWER_CACHE_SIMILARITY):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.similarity_threshold = similarity_threshold
+        self._entries = OrderedDict() # key -> (expires_at, value, vector)
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "semantic_hits": 0, "misses": 0,
+                      "evictions": 0, "expirations": 0, "invalidations": 0}
+
+    @property
+    def semantic_enabled(self):
+        return self.similarity_threshold is not None
+
+    def _key(self, source, index_version, query):
+        return (source or "", index_version, normalize_query(query))
+
+    def _alive(self, key, entry, now):
+        if entry[0] >= now:
+            return True
+        del self._entries[key]
+        self.stats["expirations"] += 1
+        return False
+
+    def get(self, source, index_version, query, query_vector=None):
+        """查快取；命中回傳先前存下的值，否則回傳 None"""
+        key = self._key(source, index_version, query)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self._alive(key, entry, now):
+                self._entries.move_to_end(key)
+                self.stats["hits"] += 1
+                return entry[1]
+
+            if self.semantic_enabled and query_vector is not None:
+                match = self._nearest(key[0], index_version, query_vector, now)
+                if match is not None:
+                    self._entries.move_to_end(match)
+                    self.stats["hits"] += 1
+                    self.stats["semantic_hits"] += 1
+                    return self._entries[match][1]
+
+            self.stats["misses"] += 1
+            return None
+
+    def _nearest(self, source, index_version, query_vector, now):
+        """在同一病歷、同一索引版本的問題中找 cosine 最高且超過門檻的那一筆"""
+        keys, vectors = [], []
+        for key, entry in list(self._entries.items()):
+            if key[0] != source or key[1] != index_version or entry[2] is None:
+                continue
+            if self._alive(key, entry, now):
+                keys.append(key)
+                vectors.append(entry[2])
+        if not keys:
+            return None
+        scores = np.stack(vectors) @ _unit(query_vector)
+        best = int(np.argmax(scores))
+        return keys[best] if scores[best] >= self.similarity_threshold else None
+
+    def put(self, source, index_version, query, value, query_vector=None):
+        key = self._key(source, index_version, query)
+        vector = _unit(query_vector) if query_vector is not None else None
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl_seconds, value, vector)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.stats["evictions"] += 1
+
+    def invalidate(self):
+        """清空全部快取 (索引重建後呼叫)"""
+        with self._lock:
+            if self._entries:
+                self.stats["invalidations"] += 1
+            self._entries.clear()
+
+    def __len__(self):
+        """目前的快取筆數 (含尚未清除的過期項目)"""
+        with self._lock:
+            return len(self._entries)
+
+    def hit_rate(self):
+        total = self.stats["hits"] + self.stats["misses"]
+        return self.stats["hits"] / total if total else 0.0
+
+def _unit(vector):
+    v = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(v)
+    return v / norm if norm else v
+
+# 全域共用的回答快取
+answer_cache = AnswerCache()
+
+FuncMetric("rag_answer_cache_events_total", "Answer cache hits/semantic_hits/misses/evictions/expirations/invalidations.",
+           lambda: [({"event": name}, value) for name, value in answer_cache.stats.items()], kind="counter")
+FuncMetric("rag_answer_cache_entries", "Number of entries in the answer cache.", lambda: len(answer_cache))
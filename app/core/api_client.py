@@ -0,0 +1,138 @@
+import os
+import time
+import random
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+
+# 前端 (Streamlit) 呼叫後端 API 用的 HTTP Client：
+# - 連線池：同一個 Session 重複使用 keep-alive 連線，不必每個請求重新建立 TCP/TLS
+# - 重試：429 / 503 (後端忙碌或尚未就緒) 與連線失敗時，依 Retry-After 或指數退避 + jitter 重試
+# - 斷路器：連續失敗達門檻後直接快速失敗一段時間，不讓請求在已經吃不消的後端上越堆越多
+API_POOL_SIZE = int(os.getenv("API_POOL_SIZE", "10"))
+API_RETRIES = int(os.getenv("API_RETRIES", "3"))
+API_BACKOFF_SECONDS = float(os.getenv("API_BACKOFF_SECONDS", "0.5"))
+API_BACKOFF_MAX_SECONDS = float(os.getenv("API_BACKOFF_MAX_SECONDS", "8"))
+BREAKER_FAILURES = int(os.getenv("API_BREAKER_FAILURES", "5"))
+BREAKER_RESET_SECONDS = float(os.getenv("API_BREAKER_RESET_SECONDS", "15"))
+RETRY_STATUSES = (429, 503)
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    """斷路器開啟中，請求沒有送出 (retry_in = 幾秒後會再試探後端)"""
+
+    def __init__(self, retry_in):
+        super().__init__(f"後端暫時無法使用，{retry_in:.0f} 秒後再試")
+        self.retry_in = retry_in
+
+class CircuitBreaker:
+    """
+    closed -> (連續 failure_threshold 次失敗) -> open -> (reset_seconds 後) -> half_open
+    half_open 只放行一個試探請求：成功回到 closed，失敗再次 open。
+    """
+
+    def __init__(self, failure_threshold=BREAKER_FAILURES, reset_seconds=BREAKER_RESET_SECONDS):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def before_request(self):
+        """請求送出前呼叫；斷路器開啟時丟出 CircuitOpenError"""
+        with self._lock:
+            if self.state == "closed":
+                return
+            remaining = self.opened_at + self.reset_seconds - time.monotonic()
+            if self.state == "open" and remaining <= 0:
+                self.state = "half_open"
+            if self.state == "half_open" and not self._probing:
+                self._probing = True
+                return
+            raise CircuitOpenError(max(remaining, 0.0))
+
+    def record_success(self):
+        with self._lock:
+            self.state, self.failures, self._probing = "closed", 0, False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == "half_open" or self.failures >= self.failure_threshold:
+                if self.state != "open":
+                    print(f"⚡ 斷路器開啟：連續 {self.failures} 次失敗，{self.reset_seconds:.0f} 秒內不再送出請求")
+                self.state, self.opened_at, self._probing = "open", time.monotonic(), False
+
+class ApiClient:
+    """
+    後端 API 的共用 Client (thread-safe，Streamlit 以 st.cache_resource 讓所有 session/rerun 共用)。
+    用法：client.get("/ready")、client.post("/chat/stream", json=..., stream=True)
+    """
+
+    def __init__(self, base_url, pool_size=API_POOL_SIZE, retries=API_RETRIES,
+                 backoff=API_BACKOFF_SECONDS, backoff_max=API_BACKOFF_MAX_SECONDS, breaker=None):
+        self.base_url = base_url.rstrip("/")
+        self.retries = retries
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.breaker = breaker or CircuitBreaker()
+        self.session = requests.Session()
+        # 重試由 request() 自己處理 (需要配合斷路器與 Retry-After)，adapter 不再重試
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def _delay(self, attempt, response=None):
+        """下一次重試前的等待秒數：優先採用 Retry-After，否則指數退避 + full jitter"""
+        if response is not None:
+            retry_after = response.headers.get("Retry-After", "")
+            try:
+                return min(float(retry_after), self.backoff_max)
+            except ValueError:
+                pass
+        return random.uniform(0, min(self.backoff * (2 ** attempt), self.backoff_max))
+
+    def request(self, method, path, retry=True, timeout=(3, 10), **kwargs):
+        """
+        送出請求並回傳 Response (非 2xx 也直接回傳，由呼叫端判斷)。
+        :param retry: False 時只送一次 (例如 /ready 的 503 代表尚未就緒，不是過載)
+        失敗時丟出 requests 的例外；斷路器開啟時丟出 CircuitOpenError (皆為 ConnectionError 的子類別或 Timeout)。
+        """
+        url = f"{self.base_url}{path}"
+        attempts = self.retries + 1 if retry else 1
+        for attempt in range(attempts):
+            self.breaker.before_request()
+            try:
+                response = self.session.request(method, url, timeout=timeout, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                self.breaker.record_failure()
+                # POST 已送出但等不到回應時後端可能仍在處理，不重送 (避免重複的 LLM 呼叫)
+                sent = isinstance(e, requests.exceptions.ReadTimeout) and method not in ("GET", "HEAD")
+                if attempt == attempts - 1 or sent:
+                    raise
+                time.sleep(self._delay(attempt))
+                continue
+            except Exception:
+                self.breaker.record_failure() # 其他錯誤也要結束 half_open 的試探
+                raise
+
+            if retry and response.status_code in RETRY_STATUSES:
+                self.breaker.record_failure()
+                if attempt < attempts - 1:
+                    delay = self._delay(attempt, response)
+                    response.close() # 把連線還給連線池
+                    time.sleep(delay)
+                    continue
+            else:
+                self.breaker.record_success()
+            return response
+
+    def get(self, path, **kwargs):
+        return self.request("GET", path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request("POST", path, **kwargs)
+
+    def close(self):
+        self.session.close()
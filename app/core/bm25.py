@@ -0,0 +1,214 @@
+import os
+import re
+import json
+import mmap
+from collections import Counter
+import numpy as np
+
+# BM25 稀疏索引的檔案 (與 FAISS 索引放在同一個資料夾)
+# - bm25_offsets.npy : 每個詞的 postings 在下面三個陣列中的起點 (長度 V+1)
+# - bm25_docs.npy    : postings 的文件編號 (= FAISS 向量位置，int32)；同一個詞內依 (source, 文件) 排序
+# - bm25_tfs.npy     : 對應的詞頻 (uint16)
+# - bm25_postsrc.npy : 對應文件的 source 代碼 (int32)；分區查詢以二分搜尋直接取出該 source 的區段
+# - bm25_doclen.npy  : 每個文件的詞數 (int32)
+# - bm25_docsrc.npy  : 每個文件所屬 source 的代碼 (int32)
+# - bm25_idf.npy     : 每個詞的 idf (float32)
+# - bm25_terms.bin   : 詞彙表：依 UTF-8 bytes 排序的詞接在一起 (詞編號 = 排序位置)
+# - bm25_term_ends.npy : 每個詞在 bm25_terms.bin 中的結束 offset (int64)
+# - bm25_meta.json   : source 字典、參數
+# 全部以 mmap 開啟：每個 worker 不必各自建立詞彙 dict，查詞以二分搜尋
+BM25_META_FILE = "bm25_meta.json"
+BM25_TERMS_FILE = "bm25_terms.bin"
+_ARRAYS = ("offsets", "docs", "tfs", "doclen", "docsrc", "postsrc", "idf", "term_ends")
+
+K1 = 1.2
+B = 0.75
+
+# 基因/變異名稱常帶 - 或 . (EML4-ALK、c.68_69delAG)，整串當一個詞，也拆成子詞
+_ASCII_TERM = re.compile(r"[0-9a-z]+(?:[-._][0-9a-z]+)*")
+_CJK_RUN = re.compile(r"[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uac00-\ud7af]+")
+
+def tokenize(text):
+    """切詞：小寫英數詞 (複合詞同時保留整串與子詞) + 中日韓文字 bigram"""
+    text = text.lower()
+    terms = []
+    for m in _ASCII_TERM.finditer(text):
+        term = m.group(0)
+        terms.append(term)
+        if any(c in term for c in "-._"):
+            terms.extend(p for p in re.split(r"[-._]", term) if p)
+    for run in _CJK_RUN.findall(text):
+        if len(run) == 1:
+            terms.append(run)
+        else:
+            terms.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return terms
+
+def has_bm25(db_path):
+    """db_path 是否有 BM25 索引"""
+    return os.path.exists(os.path.join(db_path, BM25_META_FILE))
+
+class TermTable:
+    """排序好的詞彙表 (UTF-8 blob + 結束 offset)：term -> 詞編號 以二分搜尋查找，不建立 dict"""
+
+    def __init__(self, blob, ends):
+        self.blob = blob
+        self.ends = ends
+
+    @classmethod
+    def from_terms(cls, terms):
+        """terms 需已排序 (str 依 code point 排序，與 UTF-8 bytes 的順序相同)"""
+        encoded = [t.encode("utf-8") for t in terms]
+        ends = np.cumsum([len(t) for t in encoded], dtype=np.int64) if encoded else np.empty(0, dtype=np.int64)
+        return cls(b"".join(encoded), ends)
+
+    def __len__(self):
+        return len(self.ends)
+
+    def _term(self, i):
+        start = int(self.ends[i - 1]) if i > 0 else 0
+        return self.blob[start:int(self.ends[i])]
+
+    def get(self, term):
+        """詞編號；不在詞彙表中時回傳 None"""
+        key = term.encode("utf-8")
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._term(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo if lo < len(self) and self._term(lo) == key else None
+
+    def __getitem__(self, term):
+        i = self.get(term)
+        if i is None:
+            raise KeyError(term)
+        return i
+
+    def __contains__(self, term):
+        return self.get(term) is not None
+
+class BM25Index:
+    """以 CSR 陣列儲存的 BM25 倒排索引 (文件編號 = FAISS 向量位置)"""
+
+    def __init__(self, vocab, sources, offsets, docs, tfs, doclen, docsrc, postsrc, idf):
+        self.vocab = vocab
+        self.sources = sources
+        self.source_codes = {src: i for i, src in enumerate(sources)}
+        self.offsets, self.docs, self.tfs = offsets, docs, tfs
+        self.doclen, self.docsrc, self.postsrc = doclen, docsrc, postsrc
+        self.idf = idf # 對所有查詢都一樣，建立索引時預先算好
+        self.n_docs = len(doclen)
+        self.avgdl = float(doclen.mean()) if self.n_docs else 0.0
+
+    @property
+    def term_ends(self):
+        return self.vocab.ends
+
+    @classmethod
+    def build(cls, texts, sources):
+        """texts/sources 依 FAISS 向量位置排列"""
+        source_list = sorted({s for s in sources if s is not None})
+        source_codes = {s: i for i, s in enumerate(source_list)}
+        postings = {}
+        doclen = np.zeros(len(texts), dtype=np.int32)
+        for doc_id, text in enumerate(texts):
+            counts = Counter(tokenize(text))
+            doclen[doc_id] = sum(counts.values())
+            for term, tf in counts.items():
+                postings.setdefault(term, []).append((doc_id, min(tf, 65535)))
+
+        vocab = {term: i for i, term in enumerate(sorted(postings))}
+        offsets = np.zeros(len(vocab) + 1, dtype=np.int64)
+        for term, i in vocab.items():
+            offsets[i + 1] = len(postings[term])
+        np.cumsum(offsets, out=offsets)
+        docs = np.empty(offsets[-1], dtype=np.int32)
+        tfs = np.empty(offsets[-1], dtype=np.uint16)
+        for term, i in vocab.items():
+            plist = postings[term]
+            docs[offsets[i]:offsets[i + 1]] = [d for d, _ in plist]
+            tfs[offsets[i]:offsets[i + 1]] = [tf for _, tf in plist]
+        docsrc = np.asarray([source_codes.get(s, -1) for s in sources], dtype=np.int32)
+        # 每個詞內依 (source, 文件編號) 排序：同一個 source 的 postings 連在一起
+        term_ids = np.repeat(np.arange(len(vocab)), np.diff(offsets))
+        postsrc = docsrc[docs]
+        order = np.lexsort((docs, postsrc, term_ids))
+        docs, tfs, postsrc = docs[order], tfs[order], postsrc[order]
+        df = np.diff(offsets).astype(np.float64)
+        idf = np.log(1.0 + (len(texts) - df + 0.5) / (df + 0.5)).astype(np.float32)
+        return cls(TermTable.from_terms(sorted(postings)), source_list, offsets, docs, tfs, doclen, docsrc,
+                   postsrc, idf)
+
+    def save(self, db_path):
+        for name in _ARRAYS:
+            path = os.path.join(db_path, f"bm25_{name}.npy")
+            with open(path + ".tmp", "wb") as f:
+                np.save(f, getattr(self, name))
+            os.replace(path + ".tmp", path)
+        terms_path = os.path.join(db_path, BM25_TERMS_FILE)
+        with open(terms_path + ".tmp", "wb") as f:
+            f.write(self.vocab.blob)
+        os.replace(terms_path + ".tmp", terms_path)
+        meta_path = os.path.join(db_path, BM25_META_FILE)
+        with open(meta_path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump({"k1": K1, "b": B, "sources": self.sources}, f, ensure_ascii=False)
+        os.replace(meta_path + ".tmp", meta_path)
+
+    @classmethod
+    def load(cls, db_path):
+        """載入 (陣列以 mmap 唯讀開啟)；不存在時回傳 None"""
+        meta_path = os.path.join(db_path, BM25_META_FILE)
+        if not os.path.exists(meta_path):
+            return None
+        with open(meta_path, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        arrays = {name: np.load(os.path.join(db_path, f"bm25_{name}.npy"), mmap_mode="r") for name in _ARRAYS}
+        with open(os.path.join(db_path, BM25_TERMS_FILE), "rb") as f:
+            # 空檔案無法 mmap
+            terms = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(f.fileno()).st_size else b""
+        vocab = TermTable(terms, arrays.pop("term_ends"))
+        return cls(vocab, meta["sources"], **arrays)
+
+    def _postings(self, t, source_code):
+        """詞 t 的 (文件編號, 詞頻)；指定 source 時只讀該 source 的區段 (二分搜尋，成本與該 source 的 postings 數成正比)"""
+        start, end = int(self.offsets[t]), int(self.offsets[t + 1])
+        if source_code is None:
+            return self.docs[start:end], self.tfs[start:end]
+        codes = self.postsrc[start:end]
+        lo = start + int(np.searchsorted(codes, source_code, side="left"))
+        hi = start + int(np.searchsorted(codes, source_code, side="right"))
+        return self.docs[lo:hi], self.tfs[lo:hi]
+
+    def search(self, query, k, selected_source=None):
+        """回傳 BM25 分數最高的 k 個文件編號 (依分數排序)；可限定單一 source"""
+        term_ids = [t for t in map(self.vocab.get, dict.fromkeys(tokenize(query))) if t is not None]
+        if not term_ids or k <= 0:
+            return np.empty(0, dtype=np.int64)
+        source_code = None
+        if selected_source:
+            source_code = self.source_codes.get(selected_source)
+            if source_code is None:
+                return np.empty(0, dtype=np.int64)
+
+        doc_parts, score_parts = [], []
+        for t in term_ids:
+            docs, tfs = self._postings(t, source_code)
+            tfs = tfs.astype(np.float32)
+            norm = K1 * (1.0 - B + B * self.doclen[docs] / self.avgdl)
+            doc_parts.append(docs)
+            score_parts.append(self.idf[t] * tfs * (K1 + 1.0) / (tfs + norm))
+
+        docs = np.concatenate(doc_parts)
+        if len(docs) == 0:
+            return np.empty(0, dtype=np.int64)
+        unique_docs, inverse = np.unique(docs, return_inverse=True)
+        scores = np.bincount(inverse, weights=np.concatenate(score_parts))
+        if len(scores) > k:
+            top = np.argpartition(-scores, k - 1)[:k]
+        else:
+            top = np.arange(len(scores))
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return unique_docs[top].astype(np.int64)
@@ -0,0 +1,168 @@
+import os
+import re
+import math
+from langchain_core.documents import Document
+from app.core.highlight import extract_keywords, sentence_spans
+
+# 檢索結果放進 Prompt 前的 context 組裝：
+# 1. 同一份病歷同一頁、彼此重疊或相鄰的 chunk 合併成一段 (RecursiveCharacterTextSplitter 的 overlap 只送一次)
+# 2. 同一份病歷中內容幾乎相同的段落 (例如每頁重複的表頭) 與重複的句子只保留一次
+#    (不跨病歷去重：不同病人的報告即使內容相近也是不同的事實)
+# 3. 超過 token 預算時，依「關鍵字命中 + 檢索排名」挑出分數最高的句子，按原文順序放入預算內
+# 回傳的 Document 就是實際送進 Prompt 的內容，/chat 的 sources 也由它產生 (沒被放進 Prompt 的片段不會列出)
+CONTEXT_TOKEN_BUDGET = int(os.getenv("RAG_CONTEXT_TOKENS", "1000")) # 0 = 不限制 (仍會合併與去重)
+CONTEXT_DEDUP_THRESHOLD = float(os.getenv("RAG_CONTEXT_DEDUP_THRESHOLD", "0.9"))
+# 判定兩個 chunk 重疊所需的最少重疊字元數 (太短容易誤判)
+MIN_OVERLAP_CHARS = 20
+MAX_OVERLAP_CHARS = 400 # 大於 ingest 的 CHUNK_OVERLAP 即可
+
+_CJK_CHAR = re.compile(r"[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uac00-\ud7af]")
+_WORD = re.compile(r"\w+")
+
+# 累計的組裝統計 (/metrics)
+context_stats = {"chunks_in": 0, "chunks_out": 0, "tokens_in": 0, "tokens_out": 0,
+                 "merged": 0, "duplicates": 0, "sentences_dropped": 0}
+
+def estimate_tokens(text):
+    """估計 LLM token 數 (不需要 tokenizer)：中日韓文字每字約 1 個 token，其餘約 4 個字元 1 個 token"""
+    cjk = len(_CJK_CHAR.findall(text))
+    return cjk + math.ceil((len(text) - cjk) / 4)
+
+def _overlap(left, right):
+    """left 的結尾與 right 的開頭重疊的字元數 (splitter 的 overlap)；沒有重疊回傳 0"""
+    limit = min(len(left), len(right), MAX_OVERLAP_CHARS)
+    for size in range(limit, MIN_OVERLAP_CHARS - 1, -1):
+        if left.endswith(right[:size]):
+            return size
+    return 0
+
+def _merge_texts(texts):
+    """
+    把同一頁的 chunk 文字合併成不重疊的段落清單 [(text, 來源 chunk 的 index 集合), ...]。
+    chunk 沒有起始位置資訊，所以用文字比對：一段的結尾是另一段的開頭就接起來，被包含的直接吸收。
+    """
+    segments = [(text, {i}) for i, text in enumerate(texts)]
+    merged = True
+    while merged and len(segments) > 1:
+        merged = False
+        for a in range(len(segments)):
+            for b in range(len(segments)):
+                if a == b:
+                    continue
+                (left, left_ids), (right, right_ids) = segments[a], segments[b]
+                if right in left:
+                    text = left
+                else:
+                    size = _overlap(left, right)
+                    if not size:
+                        continue
+                    text = left + right[size:]
+                segments[a] = (text, left_ids | right_ids)
+                del segments[b]
+                merged = True
+                break
+            if merged:
+                break
+    return segments
+
+def _shingles(text):
+    words = _WORD.findall(text.lower())
+    return {" ".join(words[i:i + 3]) for i in range(max(len(words) - 2, 1))}
+
+def _is_near_duplicate(shingles, kept):
+    for other in kept:
+        union = len(shingles | other)
+        if union and len(shingles & other) / union >= CONTEXT_DEDUP_THRESHOLD:
+            return True
+    return False
+
+def _normalize_sentence(sentence):
+    return " ".join(_WORD.findall(sentence.lower()))
+
+def assemble_context(query, docs, budget=None):
+    """
+    把檢索到的 docs (依相關度排序) 組成要放進 Prompt 的 Document 清單。
+    每個輸出 Document 的 metadata 沿用 source/page，並重新計算 sentence_spans；
+    metadata["chunks"] 為合併進來的原始 chunk 數。
+    :param budget: token 預算 (None 使用 RAG_CONTEXT_TOKENS，0 = 不限制)
+    """
+    budget = CONTEXT_TOKEN_BUDGET if budget is None else budget
+    docs = [d for d in docs if isinstance(d, Document)]
+    if not docs:
+        return []
+
+    # 1. 依 (source, page) 分組合併；段落的排名取組成 chunk 中最好的那個
+    groups = {}
+    for rank, doc in enumerate(docs):
+        key = (doc.metadata.get("source"), doc.metadata.get("page"))
+        groups.setdefault(key, []).append((rank, doc))
+    segments = []
+    for members in groups.values():
+        for text, ids in _merge_texts([doc.page_content for _, doc in members]):
+            rank, doc = min((members[i] for i in ids), key=lambda m: m[0])
+            segments.append((rank, text, doc, len(ids)))
+    segments.sort(key=lambda s: s[0])
+
+    # 2. 去除同一份病歷中近似重複的段落
+    kept, kept_shingles = [], {}
+    for segment in segments:
+        shingles = _shingles(segment[1])
+        same_source = kept_shingles.setdefault(segment[2].metadata.get("source"), [])
+        if _is_near_duplicate(shingles, same_source):
+            context_stats["duplicates"] += 1
+            continue
+        kept.append(segment)
+        same_source.append(shingles)
+
+    # 3. 斷句並去除重複句，依分數在預算內挑句子
+    keywords = [k.lower() for k in extract_keywords(query)]
+    sentences = [] # (score, segment_idx, sentence_idx, start, end, tokens)
+    seen = set()
+    for seg_idx, (rank, text, doc, _) in enumerate(kept):
+        for sent_idx, (start, end) in enumerate(sentence_spans(text)):
+            sentence = text[start:end]
+            normalized = (doc.metadata.get("source"), _normalize_sentence(sentence))
+            if normalized in seen:
+                context_stats["sentences_dropped"] += 1
+                continue
+            seen.add(normalized)
+            lowered = sentence.lower()
+            hits = sum(1 for k in keywords if k in lowered)
+            # 成本多算 1 個 token 給句子之間的分隔 (換行或 " ... ")
+            sentences.append((hits + 1.0 / (1 + rank), seg_idx, sent_idx, start, end, estimate_tokens(sentence) + 1))
+
+    if budget > 0:
+        selected, used = [], 0
+        for sentence in sorted(sentences, key=lambda s: s[0], reverse=True):
+            if used + sentence[5] <= budget:
+                selected.append(sentence)
+                used += sentence[5]
+        context_stats["sentences_dropped"] += len(sentences) - len(selected)
+    else:
+        selected = sentences
+
+    # 4. 依原文順序組回各段落 (連續的句子保留原本的分隔，跳過的地方以 " ... " 標示)
+    by_segment = {}
+    for _, seg_idx, sent_idx, start, end, _ in selected:
+        by_segment.setdefault(seg_idx, []).append((sent_idx, start, end))
+    results = []
+    for seg_idx in sorted(by_segment):
+        _, text, doc, chunk_count = kept[seg_idx]
+        parts, previous = [], None
+        for sent_idx, start, end in sorted(by_segment[seg_idx]):
+            if previous is not None:
+                parts.append(text[previous[1]:start] if sent_idx == previous[0] + 1 else " ... ")
+            parts.append(text[start:end])
+            previous = (sent_idx, end)
+        content = "".join(parts)
+        metadata = {k: v for k, v in doc.metadata.items() if k != "sentence_spans"}
+        metadata["sentence_spans"] = sentence_spans(content)
+        metadata["chunks"] = chunk_count
+        results.append(Document(page_content=content, metadata=metadata))
+
+    context_stats["chunks_in"] += len(docs)
+    context_stats["chunks_out"] += len(results)
+    context_stats["merged"] += sum(s[3] - 1 for s in segments)
+    context_stats["tokens_in"] += sum(estimate_tokens(d.page_content) for d in docs)
+    context_stats["tokens_out"] += sum(estimate_tokens(d.page_content) for d in results)
+    return results
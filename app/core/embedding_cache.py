@@ -0,0 +1,153 @@
+import os
+import json
+import hashlib
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+# 磁碟 Embedding 快取的預設位置 (相對於專案根目錄)
+EMBED_CACHE_PATH = os.getenv("EMBED_CACHE_PATH", ".cache/embeddings")
+
+KEY_BYTES = 16 # sha256 前 16 bytes 作為 key，碰撞機率可忽略
+
+def cache_key(embedding_id, text):
+    """快取 key = hash(向量來源 (模型|後端|精度，見 embeddings.embedding_id), chunk 文字)"""
+    h = hashlib.sha256()
+    h.update(embedding_id.encode("utf-8"))
+    h.update(b"\0")
+    h.update(text.encode("utf-8"))
+    return h.digest()[:KEY_BYTES]
+
+class EmbeddingCache:
+    """
+    磁碟上的 Embedding 快取 (單一寫入者，append-only)。
+    - keys.bin    : 每筆 16 bytes 的 key，順序即為列號
+    - vectors.f32 : float32 向量矩陣 (列數 x 維度)，以 memmap 讀取
+    - meta.json   : 向量來源 (模型|後端|精度) 與向量維度
+    每個向量來源各自一個資料夾：換 EMBEDDING_BACKEND (例如 fp32 -> int8) 不會讀到另一種精度的向量。
+    """
+
+    def __init__(self, embedding_id, cache_dir=EMBED_CACHE_PATH):
+        self.embedding_id = embedding_id
+        slug = "".join(c if c.isalnum() or c in "-_." else "_" for c in embedding_id)
+        self.path = os.path.join(cache_dir, slug)
+        self.dim = None
+        self._rows = {}
+        self._vectors = None
+        self._load()
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    def _load(self):
+        if not os.path.exists(self._file("meta.json")):
+            return
+        with open(self._file("meta.json"), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta.get("model") != self.embedding_id:
+            return
+        self.dim = meta["dim"]
+
+        with open(self._file("keys.bin"), "rb") as f:
+            raw_keys = f.read()
+        vec_bytes = os.path.getsize(self._file("vectors.f32"))
+        # 向量先寫、key 後寫；中途中斷時以兩者中較短的為準，
+        # 並把較長的檔案截斷到同樣列數 (否則之後追加的 key 會對到殘留的向量列)
+        count = min(len(raw_keys) // KEY_BYTES, vec_bytes // (4 * self.dim))
+        if len(raw_keys) != count * KEY_BYTES:
+            os.truncate(self._file("keys.bin"), count * KEY_BYTES)
+        if vec_bytes != count * 4 * self.dim:
+            os.truncate(self._file("vectors.f32"), count * 4 * self.dim)
+        self._rows = {raw_keys[i * KEY_BYTES:(i + 1) * KEY_BYTES]: i for i in range(count)}
+        self._remap(count)
+
+    def _remap(self, count):
+        if count == 0:
+            self._vectors = None
+            return
+        self._vectors = np.memmap(self._file("vectors.f32"), dtype=np.float32,
+                                  mode="r", shape=(count, self.dim))
+
+    def __len__(self):
+        return len(self._rows)
+
+    def get(self, key):
+        row = self._rows.get(key)
+        if row is None:
+            return None
+        return self._vectors[row]
+
+    def put_many(self, keys, vectors):
+        """追加新向量 (已存在的 key 會被略過)"""
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if len(keys) == 0:
+            return
+        if self.dim is None:
+            self.dim = int(vectors.shape[1])
+            os.makedirs(self.path, exist_ok=True)
+            for name in ("keys.bin", "vectors.f32"):
+                open(self._file(name), "wb").close()
+            with open(self._file("meta.json"), "w", encoding="utf-8") as f:
+                json.dump({"model": self.embedding_id, "dim": self.dim}, f)
+
+        fresh = [i for i, k in enumerate(keys) if k not in self._rows]
+        if not fresh:
+            return
+        start = len(self._rows)
+        with open(self._file("vectors.f32"), "ab") as f:
+            f.write(np.ascontiguousarray(vectors[fresh]).tobytes())
+        with open(self._file("keys.bin"), "ab") as f:
+            f.write(b"".join(keys[i] for i in fresh))
+        for offset, i in enumerate(fresh):
+            self._rows[keys[i]] = start + offset
+        self._remap(len(self._rows))
+
+class CachedEmbeddings(Embeddings):
+    """
+    包住原本的 Embeddings：embed_documents 先查磁碟快取，只把沒看過的文字送進模型。
+    同一批內重複的 chunk (例如每份報告都有的表頭) 也只會計算一次。
+    Query 不走快取 (每次提問都不同，快取價值低)。
+    :param factory: 建立真正 Embeddings 的函式；全部命中時完全不會載入模型
+    :param embedding_id: factory 產生的向量來源 (embeddings.embedding_id())，兩者必須一致
+    """
+
+    def __init__(self, factory, embedding_id, cache=None):
+        self._factory = factory
+        self._underlying = None
+        self.embedding_id = embedding_id
+        self.cache = cache if cache is not None else EmbeddingCache(embedding_id)
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def underlying(self):
+        if self._underlying is None:
+            self._underlying = self._factory()
+        return self._underlying
+
+    def embed_documents(self, texts):
+        keys = [cache_key(self.embedding_id, t) for t in texts]
+        results = [None] * len(texts)
+        pending = {} # key -> 第一次出現的位置
+        for i, key in enumerate(keys):
+            cached = self.cache.get(key)
+            if cached is not None:
+                results[i] = cached.tolist()
+                self.hits += 1
+            elif key in pending:
+                self.hits += 1
+            else:
+                pending[key] = i
+                self.misses += 1
+
+        if pending:
+            miss_keys = list(pending)
+            vectors = self.underlying.embed_documents([texts[pending[k]] for k in miss_keys])
+            self.cache.put_many(miss_keys, vectors)
+            computed = dict(zip(miss_keys, vectors))
+            for i, key in enumerate(keys):
+                if results[i] is None:
+                    results[i] = list(computed[key])
+        return results
+
+    def embed_query(self, text):
+        return self.underlying.embed_query(text)
@@ -0,0 +1,219 @@
+import os
+import sys
+import json
+import shutil
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+# Ingest 與檢索共用的 Embedding 後端 (兩邊產生的向量必須相容，才能放進同一個索引)：
+# - torch     : sentence-transformers (PyTorch, fp32)，與既有索引完全一致 (預設)
+# - onnx      : 匯出成 ONNX，以 ONNX Runtime 執行 (fp32)
+# - onnx-int8 : ONNX + dynamic int8 量化，CPU 上最快；向量與 torch 的誤差見 benchmarks/bench_embeddings.py
+# ONNX 模型第一次使用時由 PyTorch 匯出並快取在 EMBEDDING_ONNX_DIR，之後只需要 onnxruntime + tokenizers。
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "all-MiniLM-L6-v2")
+EMBEDDING_BACKENDS = ("torch", "onnx", "onnx-int8")
+# 各後端產生的向量精度 (記在 manifest 與 Embedding 快取 key 中，不同精度的向量不可混在同一個索引)
+EMBEDDING_PRECISIONS = {"torch": "fp32", "onnx": "fp32", "onnx-int8": "int8"}
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "torch").lower()
+# 推論執行緒數 (0 = 由 runtime 決定)；多個 API worker 時建議設成 CPU 數 / worker 數
+EMBEDDING_THREADS = int(os.getenv("EMBEDDING_THREADS", "0"))
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "32"))
+EMBEDDING_ONNX_DIR = os.getenv("EMBEDDING_ONNX_DIR", ".cache/onnx")
+
+ONNX_FILE = "model.onnx"
+ONNX_INT8_FILE = "model.int8.onnx"
+ONNX_CONFIG_FILE = "embedding_config.json"
+ONNX_INPUTS = ("input_ids", "attention_mask", "token_type_ids")
+
+def _model_dir(model_name):
+    """sentence-transformers 模型的本機資料夾 (名稱沒有 org 時視為 sentence-transformers/ 底下的模型)"""
+    if os.path.isdir(model_name):
+        return model_name
+    from huggingface_hub import snapshot_download
+    repo_id = model_name if "/" in model_name else f"sentence-transformers/{model_name}"
+    return snapshot_download(repo_id)
+
+def _onnx_dir(model_name):
+    slug = "".join(c if c.isalnum() or c in "-_." else "_" for c in model_name)
+    return os.path.join(EMBEDDING_ONNX_DIR, slug)
+
+def _sentence_transformer_config(model_dir):
+    """讀取 sentence-transformers 的 pooling / normalize / 最大長度設定，讓 ONNX 輸出與原模型一致"""
+    config = {"max_seq_length": 512, "pooling": "mean", "normalize": False}
+    path = os.path.join(model_dir, "sentence_bert_config.json")
+    if os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as f:
+            config["max_seq_length"] = json.load(f).get("max_seq_length", 512)
+    path = os.path.join(model_dir, "modules.json")
+    if os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as f:
+            modules = json.load(f)
+        for module in modules:
+            if module["type"].endswith("Normalize"):
+                config["normalize"] = True
+            elif module["type"].endswith("Pooling"):
+                with open(os.path.join(model_dir, module["path"], "config.json"), "r", encoding="utf-8") as f:
+                    pooling = json.load(f)
+                if pooling.get("pooling_mode_cls_token"):
+                    config["pooling"] = "cls"
+    return config
+
+def export_onnx(model_name=EMBEDDING_MODEL, out_dir=None, quantize=True):
+    """
+    把 sentence-transformers 模型匯出成 ONNX (動態 batch / 序列長度)，並視需要做 dynamic int8 量化。
+    需要 torch + transformers (只有匯出時需要)；回傳輸出資料夾。
+    """
+    import torch
+    from transformers import AutoModel
+    from tokenizers import Tokenizer
+
+    out_dir = out_dir or _onnx_dir(model_name)
+    model_dir = _model_dir(model_name)
+    os.makedirs(out_dir, exist_ok=True)
+    print(f"📦 匯出 ONNX Embedding 模型: {model_name} -> {out_dir}")
+
+    config = _sentence_transformer_config(model_dir)
+    config["model"] = model_name
+    shutil.copyfile(os.path.join(model_dir, "tokenizer.json"), os.path.join(out_dir, "tokenizer.json"))
+    tokenizer = Tokenizer.from_file(os.path.join(out_dir, "tokenizer.json"))
+    sample = tokenizer.encode_batch(["ONNX export sample", "a longer sample sentence for dynamic axes"])
+    width = max(len(e.ids) for e in sample)
+    dummy = [torch.zeros((len(sample), width), dtype=torch.long) for _ in ONNX_INPUTS]
+    for row, encoding in enumerate(sample):
+        n = len(encoding.ids)
+        dummy[0][row, :n] = torch.tensor(encoding.ids)
+        dummy[1][row, :n] = 1
+
+    class _Encoder(torch.nn.Module):
+        # 以關鍵字參數呼叫 (transformers 各版本 forward 的位置參數順序不同)
+        def __init__(self):
+            super().__init__()
+            self.model = AutoModel.from_pretrained(model_dir)
+
+        def forward(self, input_ids, attention_mask, token_type_ids):
+            return self.model(input_ids=input_ids, attention_mask=attention_mask,
+                              token_type_ids=token_type_ids).last_hidden_state
+
+    model = _Encoder().eval()
+    fp32_path = os.path.join(out_dir, ONNX_FILE)
+    export_kwargs = {}
+    if "dynamo" in torch.onnx.export.__code__.co_varnames:
+        export_kwargs["dynamo"] = False # 使用 TorchScript 匯出器 (支援 dynamic_axes)
+    with torch.no_grad():
+        torch.onnx.export(
+            model, tuple(dummy), fp32_path + ".tmp", input_names=list(ONNX_INPUTS),
+            output_names=["last_hidden_state"], opset_version=14,
+            dynamic_axes={name: {0: "batch", 1: "sequence"} for name in ONNX_INPUTS + ("last_hidden_state",)},
+            **export_kwargs,
+        )
+    os.replace(fp32_path + ".tmp", fp32_path)
+
+    if quantize:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+        int8_path = os.path.join(out_dir, ONNX_INT8_FILE)
+        quantize_dynamic(fp32_path, int8_path + ".tmp", weight_type=QuantType.QInt8)
+        os.replace(int8_path + ".tmp", int8_path)
+
+    with open(os.path.join(out_dir, ONNX_CONFIG_FILE), "w", encoding="utf-8") as f:
+        json.dump(config, f, ensure_ascii=False, indent=2)
+    return out_dir
+
+class OnnxEmbeddings(Embeddings):
+    """
+    以 ONNX Runtime 執行的 sentence-transformers 模型 (mean/CLS pooling + normalize 與原模型相同)。
+    依 token 長度排序後分批 (length bucketing)，每批只 pad 到該批最長的長度，短 chunk 不必陪長 chunk 算 padding。
+    """
+
+    def __init__(self, model_name=EMBEDDING_MODEL, quantized=True, threads=EMBEDDING_THREADS,
+                 batch_size=EMBEDDING_BATCH_SIZE, model_dir=None):
+        import onnxruntime as ort
+        from tokenizers import Tokenizer
+
+        model_dir = model_dir or _onnx_dir(model_name)
+        model_path = os.path.join(model_dir, ONNX_INT8_FILE if quantized else ONNX_FILE)
+        if not os.path.exists(model_path) or not os.path.exists(os.path.join(model_dir, ONNX_CONFIG_FILE)):
+            export_onnx(model_name, model_dir, quantize=quantized)
+        with open(os.path.join(model_dir, ONNX_CONFIG_FILE), "r", encoding="utf-8") as f:
+            self.config = json.load(f)
+
+        self.tokenizer = Tokenizer.from_file(os.path.join(model_dir, "tokenizer.json"))
+        self.tokenizer.no_padding()
+        self.tokenizer.enable_truncation(self.config["max_seq_length"])
+        self.batch_size = batch_size
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads:
+            options.intra_op_num_threads = threads
+            options.inter_op_num_threads = 1
+        self.session = ort.InferenceSession(model_path, options, providers=["CPUExecutionProvider"])
+        self._input_names = {i.name for i in self.session.get_inputs()}
+
+    def _embed(self, texts):
+        if not texts:
+            return np.zeros((0, 0), dtype=np.float32)
+        encodings = self.tokenizer.encode_batch(list(texts))
+        order = np.argsort([len(e.ids) for e in encodings], kind="stable")
+        results = [None] * len(texts)
+        for start in range(0, len(order), self.batch_size):
+            batch = order[start:start + self.batch_size]
+            width = max(len(encodings[i].ids) for i in batch)
+            feeds = {name: np.zeros((len(batch), width), dtype=np.int64) for name in ONNX_INPUTS}
+            for row, i in enumerate(batch):
+                encoding = encodings[i]
+                n = len(encoding.ids)
+                feeds["input_ids"][row, :n] = encoding.ids
+                feeds["attention_mask"][row, :n] = 1
+                feeds["token_type_ids"][row, :n] = encoding.type_ids
+            mask = feeds["attention_mask"]
+            hidden = self.session.run(None, {k: v for k, v in feeds.items() if k in self._input_names})[0]
+
+            if self.config["pooling"] == "cls":
+                pooled = hidden[:, 0]
+            else:
+                weights = mask[..., None].astype(np.float32)
+                pooled = (hidden * weights).sum(axis=1) / np.clip(weights.sum(axis=1), 1e-9, None)
+            if self.config["normalize"]:
+                pooled = pooled / np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+            for row, i in enumerate(batch):
+                results[i] = pooled[row]
+        return np.asarray(results, dtype=np.float32)
+
+    def embed_documents(self, texts):
+        return self._embed(texts).tolist()
+
+    def embed_query(self, text):
+        return self._embed([text])[0].tolist()
+
+def _resolve_backend(backend):
+    backend = (backend or EMBEDDING_BACKEND).lower()
+    if backend not in EMBEDDING_BACKENDS:
+        raise ValueError(f"EMBEDDING_BACKEND 必須是 {', '.join(EMBEDDING_BACKENDS)}，收到 {backend!r}")
+    return backend
+
+def embedding_signature(backend=None, model_name=EMBEDDING_MODEL):
+    """向量的來源：模型 + 後端 + 精度。任何一項不同，產生的向量就不能混用 (manifest 記錄這一組)"""
+    backend = _resolve_backend(backend)
+    return {"model": model_name, "backend": backend, "precision": EMBEDDING_PRECISIONS[backend]}
+
+def embedding_id(backend=None, model_name=EMBEDDING_MODEL):
+    """embedding_signature 的字串形式，作為 Embedding 快取的 key 與資料夾名稱"""
+    signature = embedding_signature(backend, model_name)
+    return f"{signature['model']}|{signature['backend']}|{signature['precision']}"
+
+def create_embeddings(backend=None, model_name=EMBEDDING_MODEL, threads=EMBEDDING_THREADS):
+    """建立 Embedding 後端 (ingest 與 rag 共用)；backend 未指定時使用 EMBEDDING_BACKEND"""
+    backend = _resolve_backend(backend)
+    if backend == "torch":
+        from langchain_huggingface import HuggingFaceEmbeddings
+        if threads:
+            import torch
+            torch.set_num_threads(threads)
+        # sentence-transformers 的 encode 本身就會依長度排序分批
+        return HuggingFaceEmbeddings(model_name=model_name, encode_kwargs={"batch_size": EMBEDDING_BATCH_SIZE})
+    return OnnxEmbeddings(model_name, quantized=backend == "onnx-int8", threads=threads)
+
+if __name__ == "__main__":
+    # 預先匯出 ONNX 模型 (例如在 Docker build 時)，服務啟動時就不需要 torch 匯出
+    # 加上 --no-quantize 只匯出 fp32
+    export_onnx(EMBEDDING_MODEL, quantize="--no-quantize" not in sys.argv)
@@ -0,0 +1,98 @@
+import os
+import time
+import asyncio
+import threading
+from collections import deque
+from typing import Any, Iterator, AsyncIterator, List, Optional
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+# 離線模擬 LLM 的延遲設定 (毫秒)：首個 token 前的等待 + 每個 token 的間隔
+FAKE_LLM_LATENCY_MS = float(os.getenv("FAKE_LLM_LATENCY_MS", "300"))
+FAKE_LLM_TOKEN_MS = float(os.getenv("FAKE_LLM_TOKEN_MS", "10"))
+FAKE_LLM_ANSWER_TOKENS = int(os.getenv("FAKE_LLM_ANSWER_TOKENS", "40"))
+# 模擬供應商配額：每分鐘最多幾次呼叫，超過時與 Gemini 一樣回 429 RESOURCE_EXHAUSTED (0 = 不限制)
+FAKE_LLM_QUOTA_RPM = int(os.getenv("FAKE_LLM_QUOTA_RPM", "0"))
+
+CONTEXT_MARKER = "【病歷摘要】："
+QUESTION_MARKER = "問題："
+
+class FakeResourceExhausted(Exception):
+    """模擬 Gemini 配額用完的錯誤 (訊息格式與 google.api_core 的 429 相同)"""
+
+_quota_calls = deque()
+_quota_lock = threading.Lock()
+
+def _check_quota(quota_rpm):
+    """滑動視窗計算最近 60 秒的呼叫數，超過配額時丟出 FakeResourceExhausted"""
+    if quota_rpm <= 0:
+        return
+    now = time.monotonic()
+    with _quota_lock:
+        while _quota_calls and _quota_calls[0] <= now - 60:
+            _quota_calls.popleft()
+        if len(_quota_calls) >= quota_rpm:
+            retry_in = _quota_calls[0] + 60 - now
+            raise FakeResourceExhausted(
+                f"429 RESOURCE_EXHAUSTED: Quota exceeded for fake-gemini requests per minute. "
+                f"Please retry in {retry_in:.1f}s.")
+        _quota_calls.append(now)
+
+class FakeChatModel(BaseChatModel):
+    """
+    取代 ChatGoogleGenerativeAI 的離線 LLM (benchmark / 壓力測試用)。
+    不呼叫任何外部 API：回答固定由 prompt 中的病歷摘要前 N 個詞組成 (同樣輸入 = 同樣輸出)，
+    並以 sleep 模擬 Gemini 的首字延遲與逐字輸出速度；quota_rpm 可模擬配額用完時的 429。
+    """
+
+    latency_ms: float = FAKE_LLM_LATENCY_MS
+    token_ms: float = FAKE_LLM_TOKEN_MS
+    answer_tokens: int = FAKE_LLM_ANSWER_TOKENS
+    quota_rpm: int = FAKE_LLM_QUOTA_RPM
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-gemini"
+
+    def _tokens(self, messages: List[BaseMessage]) -> List[str]:
+        prompt = "\n".join(str(m.content) for m in messages)
+        context = prompt.split(CONTEXT_MARKER, 1)[-1].split(QUESTION_MARKER, 1)[0]
+        words = context.split()[:self.answer_tokens] or ["病歷中未提及"]
+        return ["[offline] "] + [f"{w} " for w in words]
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                  run_manager=None, **kwargs: Any) -> ChatResult:
+        _check_quota(self.quota_rpm)
+        tokens = self._tokens(messages)
+        time.sleep((self.latency_ms + self.token_ms * len(tokens)) / 1000)
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content="".join(tokens)))])
+
+    async def _agenerate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                         run_manager=None, **kwargs: Any) -> ChatResult:
+        _check_quota(self.quota_rpm)
+        tokens = self._tokens(messages)
+        await asyncio.sleep((self.latency_ms + self.token_ms * len(tokens)) / 1000)
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content="".join(tokens)))])
+
+    def _stream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                run_manager=None, **kwargs: Any) -> Iterator[ChatGenerationChunk]:
+        _check_quota(self.quota_rpm)
+        time.sleep(self.latency_ms / 1000)
+        for token in self._tokens(messages):
+            time.sleep(self.token_ms / 1000)
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=token))
+            if run_manager:
+                run_manager.on_llm_new_token(token, chunk=chunk)
+            yield chunk
+
+    async def _astream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                       run_manager=None, **kwargs: Any) -> AsyncIterator[ChatGenerationChunk]:
+        _check_quota(self.quota_rpm)
+        await asyncio.sleep(self.latency_ms / 1000)
+        for token in self._tokens(messages):
+            await asyncio.sleep(self.token_ms / 1000)
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=token))
+            if run_manager:
+                await run_manager.on_llm_new_token(token, chunk=chunk)
+            yield chunk
@@ -0,0 +1,106 @@
+import re
+from bisect import bisect_right
+
+# 斷句規則：英文句點/問號/驚嘆號後的空白、中文句號/問號/驚嘆號之後，或換行
+_SENTENCE_BREAK = re.compile(r"(?<=[.!?])\s+|(?<=[。！？])|\n")
+
+# 關鍵字切詞：英數詞 (可含 - . / 例如 EML4-ALK、c.68_69delAG) 或連續的中日韓文字
+_ASCII_TOKEN = re.compile(r"[0-9A-Za-z][0-9A-Za-z_\-./]*[0-9A-Za-z]|[0-9A-Za-z]")
+_CJK_RUN = re.compile(r"[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uac00-\ud7af]+")
+
+def sentence_spans(text):
+    """
+    回傳每個句子 (去除前後空白後) 在 text 中的 [start, end] 位置。
+    Ingest 時預先算好存進 chunk metadata，查詢時就不必重新斷句。
+    """
+    spans = []
+    start = 0
+    for m in _SENTENCE_BREAK.finditer(text):
+        _append_span(text, start, m.start(), spans)
+        start = m.end()
+    _append_span(text, start, len(text), spans)
+    return spans
+
+def _append_span(text, start, end, spans):
+    while start < end and text[start].isspace():
+        start += 1
+    while end > start and text[end - 1].isspace():
+        end -= 1
+    if start < end:
+        spans.append([start, end])
+
+def extract_keywords(query):
+    """
+    從問題中取出關鍵字 (忽略太短的字)。
+    英文依單字切；中文沒有空白，改用連續兩字 (bigram) 作為關鍵字。
+    """
+    keywords = []
+    for token in query.split():
+        if len(token) > 1 and not _CJK_RUN.search(token):
+            keywords.append(token)
+            continue
+        # 混合中英文的 token (例如 "EGFR突變") 拆開處理
+        keywords.extend(t for t in _ASCII_TOKEN.findall(token) if len(t) > 1)
+        for run in _CJK_RUN.findall(token):
+            if len(run) == 1:
+                continue
+            keywords.extend(run[i:i + 2] for i in range(len(run) - 1))
+    # 去重但保留順序
+    return list(dict.fromkeys(keywords))
+
+class KeywordMatcher:
+    """
+    每個問題編譯一次的關鍵字比對器 (單一 case-insensitive alternation)。
+    同一個問題的所有檢索片段共用，一次掃描就同時完成「找關鍵句」與「高亮」。
+    """
+
+    def __init__(self, query):
+        self.keywords = extract_keywords(query)
+        if self.keywords:
+            # 長的關鍵字優先，避免 "EGFR" 搶走 "EGFR-TKIs" 的位置
+            alternation = "|".join(re.escape(k) for k in sorted(self.keywords, key=len, reverse=True))
+            self.pattern = re.compile(alternation, re.IGNORECASE)
+        else:
+            self.pattern = None
+
+    def extract(self, text, spans=None):
+        """
+        只回傳包含關鍵字的句子 (加上 ** 高亮)，以 " ... " 串接；
+        完全沒對到關鍵字時回傳前 2 句作為摘要。
+        :param spans: ingest 時預先算好的句子位置，沒有的話現場斷句
+        """
+        if spans is None:
+            spans = sentence_spans(text)
+        if not spans:
+            return " ..."
+
+        matches_by_sentence = {}
+        if self.pattern is not None:
+            starts = [s for s, _ in spans]
+            for m in self.pattern.finditer(text):
+                idx = bisect_right(starts, m.start()) - 1
+                if idx < 0 or m.end() > spans[idx][1]:
+                    continue
+                hits = matches_by_sentence.setdefault(idx, [])
+                if hits and hits[-1][1] == m.start():
+                    # 相鄰的關鍵字 (例如中文 bigram) 合併成一段高亮
+                    hits[-1][1] = m.end()
+                else:
+                    hits.append([m.start(), m.end()])
+
+        if not matches_by_sentence:
+            # 純語意相關、沒有精確關鍵字：回傳前 2 句就好，不要整坨丟出來
+            fallback = " ".join(text[s:e] for s, e in spans[:2])
+            return f"{fallback} ..."
+
+        selected = []
+        for idx in sorted(matches_by_sentence):
+            start, end = spans[idx]
+            parts, cursor = [], start
+            for hit_start, hit_end in matches_by_sentence[idx]:
+                parts.append(text[cursor:hit_start])
+                parts.append(f"**{text[hit_start:hit_end]}**")
+                cursor = hit_end
+            parts.append(text[cursor:end])
+            selected.append("".join(parts))
+        return " ... ".join(selected)
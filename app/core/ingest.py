@@ -1,10 +1,23 @@
 import os
 import sys
+import json
+import hashlib
+from collections import deque
+from contextlib import closing
+from concurrent.futures import ProcessPoolExecutor
 from dotenv import load_dotenv
-from langchain_community.document_loaders import PyPDFLoader
 from langchain_text_splitters import RecursiveCharacterTextSplitter
-from langchain_huggingface import HuggingFaceEmbeddings
 from langchain_community.vectorstores import FAISS
+from app.core.embedding_cache import CachedEmbeddings
+from app.core.embeddings import create_embeddings, embedding_id, embedding_signature
+from app.core.store import has_store, load_store, save_store
+from app.core.highlight import sentence_spans
+from app.core.page_cache import cache_pages, has_pages, iter_pages, prune_pages
+from app.core.bm25 import BM25Index, has_bm25
+from app.core.ann import INDEX_TYPE, build_search_index
+from app.core.snapshots import (
+    abort_snapshot, begin_snapshot, current_snapshot_path, gc_snapshots, publish_snapshot,
+)
 
 # 1. 設定環境
 load_dotenv()
@@ -14,12 +27,127 @@ load_dotenv()
 DATA_PATH = "data/" 
 DB_PATH = "faiss_index"
 
-def create_vector_db():
+# 增量索引用的清單檔 (記錄每個 PDF 的內容雜湊與對應的 Chunk ID)，每個快照各有一份
+MANIFEST_FILE = "manifest.json"
+MANIFEST_FORMAT = 1
+
+# 平行解析設定：PDF 解析/切割在多個 Process 進行，Chunk 以固定批次送進 Embedding
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", os.cpu_count() or 1))
+EMBED_BATCH_SIZE = int(os.getenv("INGEST_EMBED_BATCH", "256"))
+CHUNK_SIZE = 1000
+CHUNK_OVERLAP = 200
+
+def file_sha256(path, block_size=1 << 20):
+    """計算檔案內容雜湊 (分塊讀取，避免大檔一次載入記憶體)"""
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            h.update(block)
+    return h.hexdigest()
+
+def load_manifest(db_path=DB_PATH):
+    """讀取目前快照的索引清單，不存在或格式不符時回傳 None (代表需要完整重建)"""
+    snapshot_path = current_snapshot_path(db_path)
+    if snapshot_path is None:
+        return None
+    manifest_path = os.path.join(snapshot_path, MANIFEST_FILE)
+    if not os.path.exists(manifest_path):
+        return None
+    try:
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if manifest.get("format") != MANIFEST_FORMAT:
+        return None
+    return manifest
+
+def save_manifest(manifest, snapshot_path):
+    """先寫暫存檔再 rename，避免中途失敗留下半份清單"""
+    manifest_path = os.path.join(snapshot_path, MANIFEST_FILE)
+    tmp_path = manifest_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, manifest_path)
+
+def _manifest_signature(manifest):
+    """清單記錄的向量來源 (舊版清單沒有記錄後端/精度，視為不相容)"""
+    return {"model": manifest.get("embedding_model"), "backend": manifest.get("embedding_backend"),
+            "precision": manifest.get("embedding_precision")}
+
+def _format_signature(signature):
+    return f"{signature['model']} ({signature['backend']}, {signature['precision']})"
+
+def _list_pdf_sources():
+    """回傳要索引的 PDF 路徑清單 (路徑字串即為 metadata 中的 source)"""
+    if os.path.isfile(DATA_PATH):
+        return [DATA_PATH]
+    pdf_files = sorted(f for f in os.listdir(DATA_PATH) if f.endswith(".pdf"))
+    return [os.path.join(DATA_PATH, f) for f in pdf_files]
+
+def _chunk_id(src, file_hash, index):
+    """
+    Chunk ID 由 (路徑 + 檔案雜湊) 的雜湊 + 序號組成，內容不變 ID 就不變。
+    路徑也要算進去：內容完全相同的兩個 PDF (例如複製的報告) 不能拿到相同的 ID，否則 FAISS 會拒絕寫入。
+    """
+    prefix = hashlib.sha256(f"{src}\0{file_hash}".encode("utf-8")).hexdigest()[:16]
+    return f"{prefix}-{index:05d}"
+
+def _iter_chunks(src, file_hash, text_splitter, stats):
+    """
+    逐頁讀取 (頁面快取或 PDF) 並切割，逐一產出 chunk；幾百頁的報告也不會整份留在記憶體。
+    逐頁切割與一次切割全部頁面的結果相同 (splitter 本來就是一頁一頁切)。
+    :param stats: 累計讀到的頁數 stats["pages"]
+    """
+    for page in iter_pages(src, file_hash):
+        stats["pages"] += 1
+        for chunk in text_splitter.split_documents([page]):
+            # 預先斷句，查詢時做關鍵句萃取就不必重新切句子
+            chunk.metadata["sentence_spans"] = sentence_spans(chunk.page_content)
+            yield chunk
+
+def _iter_extracted(sources, hashes, workers=INGEST_WORKERS):
+    """
+    依序產出 (src, 頁面快取是否命中)，產出時該檔案的頁面已可從快取串流讀取。
+    多個 Worker Process 平行解析 PDF 並寫入頁面快取 (只回傳頁數，不把內容傳回主 Process)；
+    同時在途的檔案數量上限為 workers * 2。只有一個 worker 時不預先解析，由 _iter_chunks 邊解析邊切割。
+    """
+    if workers <= 1 or len(sources) <= 1:
+        for src in sources:
+            yield src, has_pages(hashes[src])
+        return
+
+    with ProcessPoolExecutor(max_workers=min(workers, len(sources))) as pool:
+        pending = deque()
+        todo = iter(sources)
+        for src in todo:
+            pending.append((src, pool.submit(cache_pages, src, hashes[src])))
+            if len(pending) >= workers * 2:
+                break
+        while pending:
+            src, future = pending.popleft()
+            _, hit = future.result()
+            yield src, hit
+            nxt = next(todo, None)
+            if nxt is not None:
+                pending.append((nxt, pool.submit(cache_pages, nxt, hashes[nxt])))
+
+CANCELLED_MESSAGE = "⏹️ Ingest 已取消，既有索引維持不變"
+
+def create_vector_db(incremental=True, index_type=None, progress=None, cancel_event=None):
     """
     讀取 PDF 並建立 FAISS 向量資料庫。
+    :param incremental: True 時只處理新增/變更的 PDF，並刪除已移除檔案的向量；
+                        False 時忽略既有索引，全部重建。
+    :param index_type: 搜尋索引類型 flat/ivf/ivfpq/hnsw (預設讀環境變數 INDEX_TYPE)
+    :param progress: (選用) 進度回報 progress(stage, **counters)，背景 ingest job 使用
+    :param cancel_event: (選用) 有 is_set() 的物件；被設定時在下一個檢查點停止 (發布新快照前都可取消，服務中的索引不受影響)
     回傳值: (success: bool, message: str)
     """
+    index_type = (index_type or INDEX_TYPE).lower()
     log_messages = [] # 用來收集執行過程的訊息
+    report = progress or (lambda stage, **counters: None)
+    cancelled = lambda: cancel_event is not None and cancel_event.is_set()
     
     log_messages.append(f"📂 檢查資料來源路徑: {DATA_PATH} ...")
     
@@ -29,63 +157,210 @@ def create_vector_db():
         print(error_msg)
         return False, error_msg
 
-    # 2. 智慧載入
-    documents = []
-    
+    sources = _list_pdf_sources()
+    if not sources:
+        return False, "⚠️ 資料夾內沒有 PDF 檔案，請先確認 data/ 目錄。"
+
+    # 2. 比對清單，找出需要處理的檔案
+    manifest = load_manifest()
+    snapshot_path = current_snapshot_path(DB_PATH)
+    index_exists = snapshot_path is not None and has_store(snapshot_path)
+    # 向量來源 (模型 + 後端 + 精度) 不同就不能沿用既有向量，例如 EMBEDDING_BACKEND 從 torch 換成 onnx-int8
     try:
-        if os.path.isfile(DATA_PATH):
-            # 單一檔案模式
-            loader = PyPDFLoader(DATA_PATH)
-            documents.extend(loader.load())
-            log_messages.append(f"  - 載入單一檔案: {DATA_PATH}")
-            
-        elif os.path.isdir(DATA_PATH):
-            # 資料夾模式 (掃描所有 PDF)
-            log_messages.append(f"  - 掃描資料夾中...")
-            pdf_files = [f for f in os.listdir(DATA_PATH) if f.endswith(".pdf")]
-            
-            if not pdf_files:
-                return False, "⚠️ 資料夾內沒有 PDF 檔案，請先確認 data/ 目錄。"
-                
-            for file in pdf_files:
-                pdf_path = os.path.join(DATA_PATH, file)
-                loader = PyPDFLoader(pdf_path)
-                documents.extend(loader.load())
-                log_messages.append(f"  - 載入: {file}")
-    except Exception as e:
+        signature = embedding_signature()
+    except ValueError as e:
+        return False, f"❌ {str(e)}"
+    signature_changed = manifest is not None and _manifest_signature(manifest) != signature
+    if not incremental or manifest is None or not index_exists or signature_changed:
+        if incremental and signature_changed:
+            log_messages.append(f"  - Embedding 設定改變 ({_format_signature(_manifest_signature(manifest))} -> "
+                                f"{_format_signature(signature)})，全部重新 Embedding")
+        elif incremental:
+            log_messages.append("  - 找不到可用的索引清單，改為完整重建")
+        # 版本號持續遞增 (完整重建也一樣)，讓下游快取能判斷索引是否換過
+        last_version = manifest.get("index_version", 0) if manifest else 0
+        manifest = {"format": MANIFEST_FORMAT, "embedding_model": signature["model"],
+                    "embedding_backend": signature["backend"], "embedding_precision": signature["precision"],
+                    "index_version": last_version, "files": {}}
+        index_exists = False
+
+    old_files = manifest["files"]
+    try:
+        current_hashes = {src: file_sha256(src) for src in sources}
+    except OSError as e:
         return False, f"❌ 讀取 PDF 失敗: {str(e)}"
-    
-    if not documents:
-        return False, "⚠️ 沒讀到任何內容，請檢查 PDF 是否加密或空白。"
 
-    log_messages.append(f"✅ PDF 讀取成功，共 {len(documents)} 頁")
+    to_add = [src for src in sources if old_files.get(src, {}).get("sha256") != current_hashes[src]]
+    to_remove = [src for src in old_files if src not in current_hashes or src in to_add]
+
+    log_messages.append(
+        f"  - 共 {len(sources)} 個 PDF：新增/變更 {len(to_add)}、"
+        f"移除/過期 {len(to_remove)}、未變更 {len(sources) - len(to_add)}"
+    )
+    report("scan", files_total=len(to_add), files_removed=len(to_remove), files_done=0,
+           chunks_parsed=0, chunks_embedded=0)
+
+    bm25_exists = index_exists and has_bm25(snapshot_path)
+    same_index_type = manifest.get("index_type", "flat") == index_type
+    # 舊版格式 (直接存在 faiss_index/ 底下) 一律重寫成目前格式的快照
+    is_current = snapshot_path != DB_PATH and index_exists
+    if index_exists and bm25_exists and same_index_type and is_current and not to_add and not to_remove:
+        log_messages.append("✅ 索引已是最新狀態，不需要重新 Embedding")
+        final_msg = "\n".join(log_messages)
+        print(final_msg)
+        return True, final_msg
 
-    # 3. 切割文字
-    text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
-    docs = text_splitter.split_documents(documents)
-    log_messages.append(f"🔪 文字切割完成：共產生 {len(docs)} 個片段 (Chunks)")
+    # 3. 準備 Embedding (先查磁碟快取，真的有未命中才載入模型) 與既有索引，先刪除過期向量
+    try:
+        embeddings = CachedEmbeddings(create_embeddings, embedding_id())
+    except Exception as e:
+        return False, f"❌ Embedding 快取載入失敗: {str(e)}"
+    log_messages.append(f"🧠 Embedding 模型: {_format_signature(signature)} (快取內已有 {len(embeddings.cache)} 筆向量)")
 
-    # 4. 轉成向量
-    log_messages.append("🧠 正在載入 Embedding 模型 (all-MiniLM-L6-v2)...")
+    vector_store = None
     try:
-        embeddings = HuggingFaceEmbeddings(model_name="all-MiniLM-L6-v2")
+        if index_exists:
+            vector_store = load_store(snapshot_path, embeddings, lazy=False)
+            stale_ids = [cid for src in to_remove for cid in old_files[src]["chunk_ids"]]
+            if stale_ids:
+                vector_store.delete(stale_ids)
+                log_messages.append(f"  - 刪除 {len(stale_ids)} 個過期向量")
     except Exception as e:
-        return False, f"❌ Embedding 模型載入失敗: {str(e)}"
+        return False, f"❌ 載入既有索引失敗: {str(e)}"
+
+    # 4. 平行解析新增或變更的 PDF (頁面快取命中則跳過解析)，逐頁切割並以批次串流進 Embedding
+    log_messages.append(f"⚙️ 平行解析 {len(to_add)} 個 PDF (workers={INGEST_WORKERS}, batch={EMBED_BATCH_SIZE})...")
+    new_entries = {}
+    batch_docs, batch_ids = [], []
+    total_chunks = 0
+    embedded_chunks = 0
+    page_cache_hits = 0
+    text_splitter = RecursiveCharacterTextSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP)
+
+    def flush():
+        nonlocal vector_store, embedded_chunks
+        if not batch_docs:
+            return
+        if vector_store is None:
+            vector_store = FAISS.from_documents(batch_docs, embeddings, ids=batch_ids)
+        else:
+            vector_store.add_documents(batch_docs, ids=batch_ids)
+        embedded_chunks += len(batch_docs)
+        report("embed", chunks_embedded=embedded_chunks)
+        batch_docs.clear()
+        batch_ids.clear()
 
-    # 5. 建立並儲存資料庫 (FAISS)
-    log_messages.append(f"💾 正在建立向量索引並存檔至 {DB_PATH}...")
     try:
-        vector_store = FAISS.from_documents(docs, embeddings)
-        vector_store.save_local(DB_PATH)
+        with closing(_iter_extracted(to_add, current_hashes)) as extracted:
+            for files_done, (src, cached) in enumerate(extracted, 1):
+                file_hash = current_hashes[src]
+                stats = {"pages": 0}
+                ids = []
+                with closing(_iter_chunks(src, file_hash, text_splitter, stats)) as chunks:
+                    for chunk in chunks:
+                        if cancelled():
+                            return False, CANCELLED_MESSAGE
+                        ids.append(_chunk_id(src, file_hash, len(ids)))
+                        batch_docs.append(chunk)
+                        batch_ids.append(ids[-1])
+                        if len(batch_docs) >= EMBED_BATCH_SIZE:
+                            flush()
+                page_cache_hits += cached
+                new_entries[src] = {"sha256": file_hash, "pages": stats["pages"], "chunk_ids": ids}
+                log_messages.append(f"  - 載入: {os.path.basename(src)} ({stats['pages']} 頁, {len(ids)} 個片段"
+                                    f"{'，頁面快取' if cached else ''})")
+                total_chunks += len(ids)
+                report("parse", files_done=files_done, current_file=os.path.basename(src),
+                       chunks_parsed=total_chunks)
     except Exception as e:
+        return False, f"❌ 讀取 PDF 或 Embedding 失敗: {str(e)}"
+
+    if vector_store is None and not batch_docs:
+        return False, "⚠️ 沒讀到任何內容，請檢查 PDF 是否加密或空白。"
+
+    log_messages.append(f"🔪 文字切割完成：共產生 {total_chunks} 個新片段 (Chunks)，"
+                        f"{page_cache_hits}/{len(to_add)} 個 PDF 由頁面快取讀取 (未重新解析)")
+
+    # 5. 寫入剩餘批次，存成新的快照資料夾 (服務中的舊快照完全不動)
+    log_messages.append(f"💾 正在更新向量索引並寫入新快照 ({DB_PATH}/snapshots)...")
+    staging = None
+    try:
+        flush()
+        search_index = None
+        if index_type != "flat":
+            # 增量更新都在 flat 索引上完成，存檔前再訓練 IVF/HNSW 搜尋索引
+            report("index")
+            log_messages.append(f"🏗️ 正在訓練 {index_type} 搜尋索引...")
+            all_vectors = vector_store.index.reconstruct_n(0, vector_store.index.ntotal)
+            search_index, index_desc = build_search_index(all_vectors, index_type)
+            log_messages.append(f"  - 搜尋索引: {index_desc}")
+        if cancelled():
+            return False, CANCELLED_MESSAGE
+        report("save")
+        staging = begin_snapshot(DB_PATH)
+        save_store(vector_store, staging, search_index)
+    except Exception as e:
+        if staging is not None:
+            abort_snapshot(staging)
         return False, f"❌ FAISS 儲存失敗: {str(e)}"
 
+    # 6. 建立 BM25 稀疏索引 (文件編號 = FAISS 向量位置)，給混合檢索使用
+    #    只需切詞、不需模型，整個語料重建的成本遠低於 Embedding
+    report("bm25")
+    try:
+        texts, doc_sources = [], []
+        for pos in range(len(vector_store.index_to_docstore_id)):
+            doc = vector_store.docstore.search(vector_store.index_to_docstore_id[pos])
+            texts.append(doc.page_content)
+            doc_sources.append(doc.metadata.get("source"))
+        bm25 = BM25Index.build(texts, doc_sources)
+        bm25.save(staging)
+        log_messages.append(f"🔤 BM25 稀疏索引完成：{len(bm25.vocab)} 個詞、{len(bm25.docs)} 筆 postings")
+    except Exception as e:
+        abort_snapshot(staging)
+        return False, f"❌ BM25 索引建立失敗: {str(e)}"
+
+    log_messages.append(
+        f"🗃️ Embedding 快取：命中 {embeddings.hits}、未命中 {embeddings.misses} "
+        f"(只有未命中的片段送進模型)"
+    )
+
+    # 7. 寫入清單並發布快照：CURRENT 換掉的那一刻，服務端才會看到新版本 (取消只能在這之前)
+    if cancelled():
+        abort_snapshot(staging)
+        return False, CANCELLED_MESSAGE
+    for src in to_remove:
+        old_files.pop(src, None)
+    old_files.update(new_entries)
+    manifest["index_version"] += 1
+    manifest["index_type"] = index_type
+    try:
+        save_manifest(manifest, staging)
+        snapshot_name = publish_snapshot(DB_PATH, staging, manifest["index_version"])
+    except Exception as e:
+        abort_snapshot(staging)
+        return False, f"❌ 快照發布失敗: {str(e)}"
+    removed = gc_snapshots(DB_PATH)
+    prune_pages(current_hashes.values()) # 只保留目前 PDF 的頁面快取
+    report("done", index_version=manifest["index_version"])
+    log_messages.append(
+        f"✅ 索引版本 v{manifest['index_version']} (快照 {snapshot_name})：共 {vector_store.index.ntotal} 個向量 "
+        f"(本次新增 {total_chunks} 個片段)"
+    )
+    if removed:
+        log_messages.append(f"🧹 已清除舊快照：{', '.join(removed)}")
+
     final_msg = "\n".join(log_messages)
     print(final_msg) # 保留終端機輸出方便除錯
     return True, final_msg
 
 if __name__ == "__main__":
     # 如果直接執行此腳本，只印出結果
-    success, msg = create_vector_db()
+    # 加上 --full 可忽略既有索引，強制全部重建
+    # 加上 --index-type ivfpq (或 ivf/hnsw/flat) 可指定搜尋索引類型
+    index_type = None
+    if "--index-type" in sys.argv:
+        index_type = sys.argv[sys.argv.index("--index-type") + 1]
+    success, msg = create_vector_db(incremental="--full" not in sys.argv, index_type=index_type)
     if not success:
-        sys.exit(1)
\ No newline at end of file
+        sys.exit(1)
@@ -0,0 +1,296 @@
+import os
+import json
+import time
+import uuid
+import queue
+import threading
+import multiprocessing
+from collections import OrderedDict
+from app.core.snapshots import pid_alive
+
+# 背景 Ingest Job：在獨立的 worker process 執行 create_vector_db (不佔用 API 的 event loop/GIL，
+# 也不會在前端 process 再載入一份 Embedding 模型)，進度經由 Queue 回報給 API process。
+# 同一時間只允許一個 job (都寫同一個 faiss_index)。
+# 多個 uvicorn worker 時，job 狀態另外寫到 INGEST_JOBS_DIR，任何一個 worker 都能查詢/取消：
+# - <job_id>.json   : 最新狀態 (由啟動該 job 的 worker 更新)
+# - <job_id>.cancel : 其他 worker 收到的取消要求，由負責的 worker 轉給 ingest process
+# - ACTIVE          : 執行中的 job id 與負責的 worker pid (以 O_EXCL 建立，跨 worker 互斥)
+JOB_HISTORY_SIZE = 20
+TERMINAL_STATES = ("succeeded", "failed", "cancelled")
+INGEST_JOBS_DIR = os.getenv("INGEST_JOBS_DIR", ".cache/ingest_jobs")
+ACTIVE_FILE = "ACTIVE"
+
+def _ingest_worker(incremental, index_type, events, cancel_event):
+    """(Worker Process) 執行 ingest，把進度與最終結果放進 events"""
+    from app.core.ingest import create_vector_db
+
+    def progress(stage, **counters):
+        events.put(("progress", {"stage": stage, **counters}))
+
+    try:
+        success, log = create_vector_db(incremental=incremental, index_type=index_type,
+                                        progress=progress, cancel_event=cancel_event)
+    except Exception as e:
+        success, log = False, f"❌ Ingest 發生未預期錯誤: {str(e)}"
+    events.put(("result", {"success": success, "log": log}))
+
+class IngestJob:
+    def __init__(self, incremental, index_type):
+        self.id = uuid.uuid4().hex[:12]
+        self.incremental = incremental
+        self.index_type = index_type
+        self.status = "running" # running -> reloading -> succeeded / failed / cancelled
+        self.progress = {"stage": "starting"}
+        self.log = ""
+        self.error = None
+        self.index_version = None
+        self.created_at = time.time()
+        self.finished_at = None
+        self.cancel_event = None
+        self.process = None
+
+    @classmethod
+    def from_dict(cls, data):
+        """由其他 worker 寫出的狀態檔還原 (唯讀，沒有 process)"""
+        job = cls(data["incremental"], data["index_type"])
+        job.id, job.status, job.progress = data["job_id"], data["status"], data["progress"]
+        job.log, job.error, job.index_version = data["log"], data["error"], data["index_version"]
+        job.created_at, job.finished_at = data["created_at"], data["finished_at"]
+        return job
+
+    def to_dict(self):
+        return {
+            "job_id": self.id, "status": self.status, "incremental": self.incremental,
+            "index_type": self.index_type, "progress": dict(self.progress), "log": self.log,
+            "error": self.error, "index_version": self.index_version,
+            "created_at": self.created_at, "finished_at": self.finished_at,
+        }
+
+class IngestJobManager:
+    """
+    管理背景 ingest job：submit / get / cancel。
+    :param on_success: job 成功後在 API process 呼叫 (例如重新載入索引，熱抽換進服務中)
+    """
+
+    def __init__(self, on_success=None, history_size=JOB_HISTORY_SIZE, state_dir=INGEST_JOBS_DIR):
+        self.on_success = on_success
+        self.history_size = history_size
+        self.state_dir = state_dir
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+        # spawn：不繼承 API process 的 Thread/FAISS/Tokenizer 狀態，fork 在這些情況下並不安全
+        self._ctx = multiprocessing.get_context("spawn")
+
+    def submit(self, incremental=True, index_type=None):
+        """啟動新的 ingest job，回傳 (job, None)；已有 job 在執行時回傳 (None, 執行中的 job)"""
+        with self._lock:
+            running = next((j for j in self._jobs.values() if j.status not in TERMINAL_STATES), None)
+            if running is not None:
+                return None, running
+            job = IngestJob(incremental, index_type)
+            running = self._claim_active(job)
+            if running is not None:
+                return None, running
+            events = self._ctx.Queue()
+            job.cancel_event = self._ctx.Event()
+            job.process = self._ctx.Process(
+                target=_ingest_worker, args=(incremental, index_type, events, job.cancel_event),
+                name=f"ingest-{job.id}",
+            )
+            try:
+                job.process.start()
+            except Exception:
+                self._release_active(job)
+                raise
+            self._jobs[job.id] = job
+            self._save(job)
+            while len(self._jobs) > self.history_size:
+                oldest = next(iter(self._jobs))
+                if self._jobs[oldest].status not in TERMINAL_STATES:
+                    break
+                self._jobs.pop(oldest)
+
+        threading.Thread(target=self._monitor, args=(job, events), name=f"ingest-monitor-{job.id}",
+                         daemon=True).start()
+        print(f"🛠️ Ingest job {job.id} 已啟動 (pid={job.process.pid})")
+        return job, None
+
+    def get(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+        return job if job is not None else self._load(job_id)
+
+    def list_jobs(self):
+        """所有 worker 的 job (新的在前)"""
+        with self._lock:
+            jobs = {job.id: job for job in self._jobs.values()}
+        for name in self._state_files():
+            job_id = name[:-len(".json")]
+            if job_id not in jobs:
+                job = self._load(job_id)
+                if job is not None:
+                    jobs[job_id] = job
+        return sorted(jobs.values(), key=lambda j: j.created_at, reverse=True)[:self.history_size]
+
+    def cancel(self, job_id):
+        """要求取消 (worker 在下一個檢查點停止)；回傳 job，找不到時回傳 None"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is None:
+            # 由其他 worker 負責的 job：留下取消要求，由它的 monitor 轉給 ingest process
+            job = self._load(job_id)
+            if job is not None and job.status == "running":
+                self._write(f"{job_id}.cancel", "")
+                job.progress["cancel_requested"] = True
+            return job
+        if job.status == "running":
+            job.cancel_event.set()
+            job.progress["cancel_requested"] = True
+            self._save(job)
+        return job
+
+    # --- 跨 worker 共用的狀態檔 ---
+    def _path(self, name):
+        return os.path.join(self.state_dir, name)
+
+    def _write(self, name, text):
+        os.makedirs(self.state_dir, exist_ok=True)
+        tmp = self._path(f"{name}.{os.getpid()}.tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(tmp, self._path(name))
+
+    def _save(self, job):
+        try:
+            self._write(f"{job.id}.json", json.dumps(job.to_dict(), ensure_ascii=False))
+        except OSError as e:
+            print(f"⚠️ 無法寫入 ingest job 狀態: {str(e)}")
+
+    def _load(self, job_id):
+        if not job_id.isalnum():
+            return None
+        try:
+            with open(self._path(f"{job_id}.json"), "r", encoding="utf-8") as f:
+                job = IngestJob.from_dict(json.load(f))
+        except (OSError, ValueError, KeyError):
+            return None
+        if job.status not in TERMINAL_STATES and self._active_owner(job.id) is None:
+            # 負責的 worker 已不存在 (例如被重啟)，這個 job 不會再更新
+            job.status, job.error = "failed", "負責此 job 的 API worker 已結束"
+        return job
+
+    def _state_files(self):
+        try:
+            return [name for name in os.listdir(self.state_dir) if name.endswith(".json")]
+        except OSError:
+            return []
+
+    def _active_owner(self, job_id):
+        """ACTIVE 指向 job_id 且負責的 worker 仍存活時回傳其 pid"""
+        try:
+            with open(self._path(ACTIVE_FILE), "r", encoding="utf-8") as f:
+                active_id, pid = f.read().split()
+        except (OSError, ValueError):
+            return None
+        return int(pid) if active_id == job_id and pid_alive(int(pid)) else None
+
+    def _claim_active(self, job):
+        """跨 worker 取得執行權；已有其他 worker 的 job 執行中時回傳該 job"""
+        os.makedirs(self.state_dir, exist_ok=True)
+        for _ in range(2):
+            try:
+                fd = os.open(self._path(ACTIVE_FILE), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                try:
+                    with open(self._path(ACTIVE_FILE), "r", encoding="utf-8") as f:
+                        active_id, pid = f.read().split()
+                except (OSError, ValueError):
+                    active_id, pid = None, "0"
+                if pid_alive(int(pid)):
+                    return self._load(active_id) or self._placeholder(active_id)
+                # 負責的 worker 已不存在：清掉殘留的 ACTIVE 再試一次
+                try:
+                    os.remove(self._path(ACTIVE_FILE))
+                except OSError:
+                    pass
+                continue
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                f.write(f"{job.id} {os.getpid()}")
+            return None
+        return self._placeholder(job.id) # 與其他 worker 同時搶 ACTIVE，保守回報為執行中
+
+    @staticmethod
+    def _placeholder(job_id):
+        """其他 worker 剛取得執行權、狀態檔還沒寫出時的替代資訊"""
+        job = IngestJob(None, None)
+        job.id = job_id or "unknown"
+        return job
+
+    def _release_active(self, job):
+        if self._active_owner(job.id) == os.getpid():
+            try:
+                os.remove(self._path(ACTIVE_FILE))
+            except OSError:
+                pass
+
+    def _prune(self):
+        """只保留最近 history_size 個 job 的狀態檔"""
+        jobs = [self._load(name[:-len(".json")]) for name in self._state_files()]
+        jobs = sorted((j for j in jobs if j is not None), key=lambda j: j.created_at, reverse=True)
+        for job in jobs[self.history_size:]:
+            if job.status in TERMINAL_STATES:
+                for name in (f"{job.id}.json", f"{job.id}.cancel"):
+                    try:
+                        os.remove(self._path(name))
+                    except OSError:
+                        pass
+
+    def _monitor(self, job, events):
+        """(API process 的背景 Thread) 接收 worker 的進度，結束後視結果熱抽換索引"""
+        result = None
+        while result is None:
+            if not job.cancel_event.is_set() and os.path.exists(self._path(f"{job.id}.cancel")):
+                self.cancel(job.id)
+            try:
+                kind, payload = events.get(timeout=0.5)
+            except queue.Empty:
+                if not job.process.is_alive():
+                    try:
+                        kind, payload = events.get(timeout=1.0) # worker 結束前最後放進去的訊息
+                    except queue.Empty:
+                        break
+                else:
+                    continue
+            if kind == "progress":
+                job.progress.update(payload)
+                self._save(job)
+            else:
+                result = payload
+        job.process.join()
+
+        if result is None:
+            job.status, job.error = "failed", f"Ingest worker 異常結束 (exit code {job.process.exitcode})"
+        elif job.cancel_event.is_set() and not result["success"]:
+            job.status, job.log = "cancelled", result["log"]
+        elif not result["success"]:
+            job.status, job.log, job.error = "failed", result["log"], result["log"].splitlines()[-1]
+        else:
+            job.log = result["log"]
+            job.index_version = job.progress.get("index_version")
+            job.status = "reloading"
+            self._save(job)
+            try:
+                if self.on_success is not None:
+                    self.on_success()
+                job.status = "succeeded"
+            except Exception as e:
+                job.status, job.error = "failed", f"索引已更新，但重新載入失敗: {str(e)}"
+        job.finished_at = time.time()
+        self._save(job)
+        self._release_active(job)
+        try:
+            os.remove(self._path(f"{job.id}.cancel"))
+        except OSError:
+            pass
+        self._prune()
+        print(f"🛠️ Ingest job {job.id} 結束：{job.status}")
@@ -0,0 +1,270 @@
+import os
+import re
+import math
+import time
+import heapq
+import asyncio
+import itertools
+from contextlib import asynccontextmanager
+from langchain_core.runnables import Runnable
+from app.core.metrics import FuncMetric
+
+# LLM 階段的准入控制 (Admission Control)，放在 Gemini 呼叫之前：
+# - 並發上限：同時進行的 LLM 呼叫數 (Semaphore)
+# - Token Bucket：每分鐘請求數 (對應 Gemini 的 RPM 配額)，允許 LLM_BURST 的瞬間突發
+# - 有上限的優先佇列：interactive (UI 的 /chat、/chat/stream) 永遠排在 batch (/chat/batch) 前面，
+#   每個 lane 各自有排隊上限 (只計算同級或更優先的請求)，大量 batch 不會把 interactive 擠出佇列
+# - 依截止時間卸載：預估等待超過上限或排隊逾時就直接拒絕 (HTTP 429 + Retry-After)，不讓請求越堆越多
+# - 供應商回 429 (配額用完) 時暫停放行一段時間，並同樣轉成 429 + Retry-After
+# 以上都是每個 API worker process 各自計算；多 worker 時 LLM_RATE_PER_MINUTE 請設成總配額 / worker 數。
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "8"))
+LLM_RATE_PER_MINUTE = float(os.getenv("LLM_RATE_PER_MINUTE", "0")) # 0 = 不限速
+LLM_BURST = int(os.getenv("LLM_BURST", "0")) # 0 = 與 LLM_MAX_CONCURRENCY 相同
+LLM_QUEUE_SIZE = int(os.getenv("LLM_QUEUE_SIZE", "64"))
+LLM_BATCH_QUEUE_SIZE = int(os.getenv("LLM_BATCH_QUEUE_SIZE", "0")) # 0 = 與 LLM_QUEUE_SIZE 相同
+LLM_MAX_WAIT_SECONDS = float(os.getenv("LLM_MAX_WAIT_SECONDS", "10"))
+LLM_BATCH_MAX_WAIT_SECONDS = float(os.getenv("LLM_BATCH_MAX_WAIT_SECONDS", "120"))
+# 供應商回 429 但沒有說要等多久時的暫停秒數
+LLM_RATE_LIMIT_BACKOFF_SECONDS = float(os.getenv("LLM_RATE_LIMIT_BACKOFF_SECONDS", "10"))
+
+# 優先順序 (數字小的先)
+LANES = {"interactive": 0, "batch": 1}
+
+_RETRY_IN = re.compile(r"retry (?:in|after) ([0-9.]+)\s*s|retry_delay\s*\{\s*seconds:\s*([0-9]+)", re.IGNORECASE)
+
+class OverloadedError(Exception):
+    """LLM 階段忙碌，請求被拒絕 (reason = queue_full / deadline / provider_rate_limit)"""
+
+    def __init__(self, reason, retry_after):
+        super().__init__(f"LLM 忙碌中 ({reason})，請 {math.ceil(retry_after)} 秒後再試")
+        self.reason = reason
+        self.retry_after = retry_after
+
+    @property
+    def retry_after_header(self):
+        return str(max(1, math.ceil(self.retry_after)))
+
+def is_rate_limit_error(error):
+    """是否為 LLM 供應商的配額/限速錯誤 (Gemini 的 429 RESOURCE_EXHAUSTED 常被包在其他例外裡，一路往上找)"""
+    seen = set()
+    while error is not None and id(error) not in seen:
+        seen.add(id(error))
+        text = str(error)
+        if (type(error).__name__ in ("ResourceExhausted", "TooManyRequests", "RateLimitError")
+                or "RESOURCE_EXHAUSTED" in text or "429" in text.split(" ", 1)[0]):
+            return True
+        error = error.__cause__ or error.__context__
+    return False
+
+def _provider_retry_after(error):
+    match = _RETRY_IN.search(str(error))
+    if match:
+        return float(match.group(1) or match.group(2))
+    return LLM_RATE_LIMIT_BACKOFF_SECONDS
+
+class LLMScheduler:
+    """
+    asyncio 版的 LLM 呼叫排程器 (同一個 event loop 內使用)。
+    用法：
+        async with llm_scheduler.slot("interactive"):
+            await llm.ainvoke(...)
+    或把 LLM 包成 ScheduledRunnable(llm, "interactive") 放進 Chain (只有 LLM 這一步佔名額)。
+    拿不到執行名額時丟出 OverloadedError (由 API 轉成 429 + Retry-After)。
+    """
+
+    def __init__(self, max_concurrency=LLM_MAX_CONCURRENCY, rate_per_minute=LLM_RATE_PER_MINUTE,
+                 burst=LLM_BURST, queue_size=LLM_QUEUE_SIZE, batch_queue_size=LLM_BATCH_QUEUE_SIZE, max_wait=None):
+        self.max_concurrency = max_concurrency
+        self.rate = rate_per_minute / 60.0 # 每秒補充的 token 數
+        self.burst = burst or max_concurrency
+        # 各 lane 的排隊上限：計算的是排在它前面或同級的請求數 (batch 另有自己的上限，interactive 不受 batch 影響)
+        self.queue_size = {"interactive": queue_size, "batch": batch_queue_size or queue_size}
+        # 各 lane 最多排隊幾秒 (interactive 有人在等畫面，batch 可以等久一點)
+        self.max_wait = {"interactive": LLM_MAX_WAIT_SECONDS, "batch": LLM_BATCH_MAX_WAIT_SECONDS, **(max_wait or {})}
+        self.running = 0
+        self.tokens = float(self.burst)
+        self._refilled_at = time.monotonic()
+        self._paused_until = 0.0
+        self._queue = [] # heap of [priority, seq, future, lane]
+        self._seq = itertools.count()
+        self._timer = None
+        self._service_seconds = 1.0 # LLM 呼叫耗時的移動平均，用來估計排隊時間
+        self.stats = {(lane, event): 0 for lane in LANES
+                      for event in ("admitted", "queued", "shed_queue_full", "shed_deadline", "rate_limited")}
+
+    # --- Token Bucket ---
+    def _refill(self, now):
+        if self.rate > 0:
+            self.tokens = min(self.burst, self.tokens + (now - self._refilled_at) * self.rate)
+        self._refilled_at = now
+
+    def _can_start(self, now):
+        if self.running >= self.max_concurrency or now < self._paused_until:
+            return False
+        self._refill(now)
+        return self.rate <= 0 or self.tokens >= 1
+
+    def _start(self, lane):
+        self.running += 1
+        if self.rate > 0:
+            self.tokens -= 1
+        self.stats[(lane, "admitted")] += 1
+
+    def estimate_wait(self, ahead):
+        """前面還有 ahead 個請求排隊時，預估要等幾秒才輪到 (取並發與速率兩個限制中較慢的)"""
+        now = time.monotonic()
+        self._refill(now)
+        paused = max(self._paused_until - now, 0.0)
+        by_concurrency = 0.0
+        if self.running + ahead >= self.max_concurrency:
+            by_concurrency = (ahead // self.max_concurrency + 1) * self._service_seconds
+        by_rate = max(ahead + 1 - self.tokens, 0.0) / self.rate if self.rate > 0 else 0.0
+        return paused + max(by_concurrency, by_rate)
+
+    # --- 佇列 ---
+    def _ahead(self, priority):
+        return sum(1 for entry in self._queue if entry[0] <= priority)
+
+    def _remove(self, entry):
+        if entry in self._queue:
+            self._queue.remove(entry)
+            heapq.heapify(self._queue)
+
+    def _dispatch(self):
+        """依優先順序放行排隊中的請求；因速率或暫停而放不出去時，排一個計時器稍後再試"""
+        now = time.monotonic()
+        while self._queue and self._can_start(now):
+            _, _, future, lane = heapq.heappop(self._queue)
+            self._start(lane)
+            future.set_result(True)
+        if self._queue and self._timer is None and self.running < self.max_concurrency:
+            delay = max(self._paused_until - now, 0.0)
+            if self.rate > 0 and self.tokens < 1:
+                delay = max(delay, (1 - self.tokens) / self.rate)
+            self._timer = asyncio.get_running_loop().call_later(max(delay, 0.001), self._on_timer)
+
+    def _on_timer(self):
+        self._timer = None
+        self._dispatch()
+
+    def _shed(self, lane, reason, retry_after):
+        self.stats[(lane, f"shed_{reason}")] += 1
+        raise OverloadedError(reason, retry_after)
+
+    async def _acquire(self, lane, max_wait):
+        priority = LANES[lane]
+        if not self._ahead(priority) and self._can_start(time.monotonic()):
+            self._start(lane)
+            return
+        ahead = self._ahead(priority)
+        if ahead >= self.queue_size[lane]:
+            self._shed(lane, "queue_full", self.estimate_wait(ahead))
+        estimate = self.estimate_wait(ahead)
+        if estimate > max_wait:
+            self._shed(lane, "deadline", estimate)
+
+        future = asyncio.get_running_loop().create_future()
+        entry = [priority, next(self._seq), future, lane]
+        heapq.heappush(self._queue, entry)
+        self.stats[(lane, "queued")] += 1
+        self._dispatch()
+        try:
+            # 不用 wait_for：它在「剛被放行的同時被取消」時會吞掉 CancelledError (Python 3.11)
+            await asyncio.wait((future,), timeout=max_wait)
+        except asyncio.CancelledError:
+            # 呼叫端放棄 (例如斷線)：還在排隊就移出佇列，已經拿到名額就還回去
+            if future.done() and not future.cancelled():
+                self._release()
+            else:
+                self._remove(entry)
+                future.cancel()
+            raise
+        if not future.done():
+            # 排隊逾時 (逾時的同一刻剛好輪到時照常執行)
+            self._remove(entry)
+            future.cancel()
+            self._shed(lane, "deadline", self.estimate_wait(self._ahead(priority)))
+
+    def _release(self):
+        self.running -= 1
+        self._dispatch()
+
+    def pause(self, seconds):
+        """供應商回報限速：seconds 秒內不放行新的呼叫，並清空已累積的突發額度"""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self.tokens = 0.0
+
+    @asynccontextmanager
+    async def slot(self, lane="interactive", max_wait=None):
+        """取得一個 LLM 執行名額 (排隊等待最多 max_wait 秒，未指定時依 lane 的預設值)"""
+        if lane not in LANES:
+            raise ValueError(f"lane 必須是 {', '.join(LANES)}")
+        await self._acquire(lane, self.max_wait[lane] if max_wait is None else max_wait)
+        started = time.monotonic()
+        try:
+            yield
+        except Exception as e:
+            if not is_rate_limit_error(e):
+                raise
+            retry_after = _provider_retry_after(e)
+            self.stats[(lane, "rate_limited")] += 1
+            self.pause(retry_after)
+            print(f"🚦 LLM 供應商限速，{retry_after:.0f} 秒內暫停送出新的呼叫")
+            raise OverloadedError("provider_rate_limit", retry_after) from e
+        finally:
+            self._service_seconds = 0.8 * self._service_seconds + 0.2 * (time.monotonic() - started)
+            self._release()
+
+    def queued(self, lane=None):
+        return sum(1 for entry in self._queue if lane is None or entry[3] == lane)
+
+class ScheduledRunnable(Runnable):
+    """
+    把 LLM (或任何 Runnable) 包起來，只在這一步向排程器取得名額：
+    放進 Chain 後，檢索、context 組裝等前後步驟不佔 LLM 名額，_service_seconds 也只量到 LLM 本身。
+    串流時名額一直保留到最後一個 token。同步呼叫 (invoke/stream) 不經過排程器 (排程器只支援 asyncio)。
+    """
+
+    def __init__(self, runnable, lane="interactive", scheduler=None):
+        if lane not in LANES:
+            raise ValueError(f"lane 必須是 {', '.join(LANES)}")
+        self.runnable = runnable
+        self.lane = lane
+        self.scheduler = scheduler
+
+    @property
+    def InputType(self):
+        return self.runnable.InputType
+
+    @property
+    def OutputType(self):
+        return self.runnable.OutputType
+
+    def _scheduler(self):
+        return self.scheduler if self.scheduler is not None else llm_scheduler
+
+    def invoke(self, input, config=None, **kwargs):
+        return self.runnable.invoke(input, config, **kwargs)
+
+    def stream(self, input, config=None, **kwargs):
+        yield from self.runnable.stream(input, config, **kwargs)
+
+    async def ainvoke(self, input, config=None, **kwargs):
+        async with self._scheduler().slot(self.lane):
+            return await self.runnable.ainvoke(input, config, **kwargs)
+
+    async def astream(self, input, config=None, **kwargs):
+        # Chain 中的 atransform 會先把輸入收齊再呼叫 astream，所以只要覆寫這裡
+        async with self._scheduler().slot(self.lane):
+            async for chunk in self.runnable.astream(input, config, **kwargs):
+                yield chunk
+
+# 全域共用的 LLM 排程器
+llm_scheduler = LLMScheduler()
+
+FuncMetric("rag_llm_running", "LLM calls currently running.", lambda: llm_scheduler.running)
+FuncMetric("rag_llm_queued", "LLM calls waiting for admission, by lane.",
+           lambda: [({"lane": lane}, llm_scheduler.queued(lane)) for lane in LANES])
+FuncMetric("rag_llm_scheduler_events_total", "LLM admission events (admitted/queued/shed/rate_limited) by lane.",
+           lambda: [({"lane": lane, "event": event}, value) for (lane, event), value in llm_scheduler.stats.items()],
+           kind="counter")
@@ -0,0 +1,132 @@
+import math
+import threading
+
+# 極簡的 Prometheus 指標 registry (text exposition format 0.0.4)，不依賴 prometheus_client
+# - Counter / Histogram：由程式主動累加
+# - FuncMetric：抓取 (/metrics) 時才呼叫函式取值，適合索引大小、快取計數等既有狀態
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_registry = []
+_registry_lock = threading.Lock()
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in labels) + "}"
+
+def _format_value(value):
+    if value is None:
+        return "NaN"
+    value = float(value)
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(value) if not value.is_integer() else str(int(value))
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        with _registry_lock:
+            _registry.append(self)
+
+    def _labels(self, values):
+        if len(values) != len(self.labelnames):
+            raise ValueError(f"{self.name} 需要 labels {self.labelnames}")
+        return tuple(zip(self.labelnames, values))
+
+    def header(self):
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._values = {}
+
+    def inc(self, *labelvalues, amount=1.0):
+        key = self._labels(labelvalues)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def collect(self):
+        with self._lock:
+            items = list(self._values.items())
+        return [f"{self.name}{_format_labels(labels)} {_format_value(v)}" for labels, v in items]
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._values = {} # labels -> [各 bucket 計數..., sum, count]
+
+    def observe(self, value, *labelvalues):
+        key = self._labels(labelvalues)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[i] += 1
+                    break
+            state[-2] += value
+            state[-1] += 1
+
+    def collect(self):
+        with self._lock:
+            items = [(labels, list(state)) for labels, state in self._values.items()]
+        lines = []
+        for labels, state in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, state):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_format_labels(labels + (('le', _format_value(bound)),))} {cumulative}")
+            lines.append(f"{self.name}_bucket{_format_labels(labels + (('le', '+Inf'),))} {state[-1]}")
+            lines.append(f"{self.name}_sum{_format_labels(labels)} {_format_value(state[-2])}")
+            lines.append(f"{self.name}_count{_format_labels(labels)} {state[-1]}")
+        return lines
+
+class FuncMetric(_Metric):
+    """
+    抓取時才取值的指標。
+    fn() 回傳單一數值，或 [(labels dict, 數值), ...]；回傳 None 時不輸出。
+    """
+
+    def __init__(self, name, documentation, fn, kind="gauge"):
+        super().__init__(name, documentation)
+        self.kind = kind
+        self.fn = fn
+
+    def collect(self):
+        value = self.fn()
+        if value is None:
+            return []
+        if isinstance(value, (list, tuple)):
+            return [f"{self.name}{_format_labels(tuple(labels.items()))} {_format_value(v)}" for labels, v in value]
+        return [f"{self.name} {_format_value(value)}"]
+
+def render():
+    """輸出所有指標 (Prometheus text format)"""
+    with _registry_lock:
+        metrics = list(_registry)
+    lines = []
+    for metric in metrics:
+        try:
+            samples = metric.collect()
+        except Exception as e:
+            # 單一指標取值失敗不影響其他指標 (例如索引還沒載入)
+            print(f"⚠️ 指標 {metric.name} 取值失敗: {str(e)}")
+            continue
+        lines.extend(metric.header())
+        lines.extend(samples)
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,67 @@
+import os
+import json
+from langchain_core.documents import Document
+
+# PDF 逐頁文字抽取的磁碟快取 (key = 檔案內容 sha256 + 頁碼)：
+# - 內容沒變的 PDF 重新 ingest 時不必再跑 pypdf 解析 (最慢的一步)
+# - 每個檔案一個 JSONL，一行一頁 {"page", "text", "metadata"}，可以逐頁串流讀回，不必整份載入記憶體
+# - 先寫 .tmp，整份抽取完才 rename；中途失敗或被中斷的檔案下次會重新抽取
+PAGE_CACHE_PATH = os.getenv("PAGE_CACHE_PATH", ".cache/pages")
+PAGE_CACHE_FORMAT = 1 # 抽取方式或格式改變時遞增，舊快取自動失效
+
+def _cache_file(file_hash, cache_dir=PAGE_CACHE_PATH):
+    return os.path.join(cache_dir, f"{file_hash}.v{PAGE_CACHE_FORMAT}.jsonl")
+
+def has_pages(file_hash, cache_dir=PAGE_CACHE_PATH):
+    return os.path.exists(_cache_file(file_hash, cache_dir))
+
+def _load_pdf_pages(src):
+    """逐頁解析 PDF (PyPDFLoader.lazy_load：一次只抽取一頁，metadata 與 load() 相同)"""
+    from langchain_community.document_loaders import PyPDFLoader
+    return PyPDFLoader(src).lazy_load()
+
+def iter_pages(src, file_hash, cache_dir=PAGE_CACHE_PATH):
+    """
+    逐頁產出 Document。快取命中時從 JSONL 串流讀回；未命中時邊解析邊寫入快取。
+    metadata["source"] 一律改成目前的路徑 (同樣內容的檔案可能被改名或移動)。
+    """
+    path = _cache_file(file_hash, cache_dir)
+    if os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                record = json.loads(line)
+                yield Document(page_content=record["text"], metadata={**record["metadata"], "source": src})
+        return
+
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for page in _load_pdf_pages(src):
+                record = {"page": page.metadata.get("page"), "text": page.page_content, "metadata": page.metadata}
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+                yield page
+        os.replace(tmp_path, path)
+    finally:
+        # 例外或呼叫端提前停止 (GeneratorExit) 時不留下半份快取
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def cache_pages(src, file_hash, cache_dir=PAGE_CACHE_PATH):
+    """(Worker Process) 確保 src 的逐頁文字已在快取中，回傳 (頁數, 是否原本就在快取)"""
+    if has_pages(file_hash, cache_dir):
+        with open(_cache_file(file_hash, cache_dir), "r", encoding="utf-8") as f:
+            return sum(1 for _ in f), True
+    return sum(1 for _ in iter_pages(src, file_hash, cache_dir)), False
+
+def prune_pages(keep_hashes, cache_dir=PAGE_CACHE_PATH):
+    """刪除不在 keep_hashes 中的快取檔 (已刪除或已變更的 PDF)，回傳刪除數量"""
+    if not os.path.isdir(cache_dir):
+        return 0
+    keep = {os.path.basename(_cache_file(h, cache_dir)) for h in keep_hashes}
+    removed = 0
+    for name in os.listdir(cache_dir):
+        if name.endswith(".jsonl") and name not in keep:
+            os.remove(os.path.join(cache_dir, name))
+            removed += 1
+    return removed
@@ -1,11 +1,35 @@
 import os
+import json
+import time
+import asyncio
+import threading
+import contextvars
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict, defaultdict
+from typing import List, Optional
+import numpy as np
+import faiss
 from dotenv import load_dotenv
-from langchain_google_genai import ChatGoogleGenerativeAI
-from langchain_huggingface import HuggingFaceEmbeddings
-from langchain_community.vectorstores import FAISS
 from langchain_core.prompts import ChatPromptTemplate
-from langchain.chains.combine_documents import create_stuff_documents_chain
-from langchain.chains import create_retrieval_chain
+from langchain_core.retrievers import BaseRetriever
+from langchain_core.callbacks import (
+    AsyncCallbackManagerForRetrieverRun,
+    CallbackManagerForRetrieverRun,
+)
+from langchain_core.documents import Document
+from app.core.batching import MicroBatcher
+from app.core.store import has_store, load_store, load_source_positions, load_vectors
+from app.core.snapshots import CURRENT_FILE, current_snapshot_path, gc_snapshots, pin_snapshot, unpin_snapshot
+from app.core.ann import set_search_params
+from app.core.embeddings import create_embeddings, embedding_signature
+from app.core.bm25 import BM25Index
+from app.core.context import assemble_context, context_stats
+from app.core.llm_scheduler import ScheduledRunnable
+from app.core.metrics import FuncMetric
+from app.core.tracing import StageTimingCallback, current_trace, observe_stage, span
+
+# 註：LangChain/Gemini/HuggingFace 等較重的套件改在第一次使用時才 import，縮短 API 冷啟動時間
 
 # 1. 載入環境變數
 load_dotenv()
@@ -14,73 +38,609 @@ load_dotenv()
 vector_store = None
 llm = None
 embeddings = None
+bm25_index = None
+store_vectors = None # 原始向量 (mmap)，分區子索引由此建立
 
-def initialize_rag_components():
-    """初始化核心組件 (只執行一次)"""
-    global vector_store, llm, embeddings
-    
-    if vector_store is not None:
-        return # 已經初始化過，直接跳過
+# (選用) 覆寫 IVF 的 nprobe / HNSW 的 efSearch；未設定時沿用 ingest 寫進索引檔的值
+SEARCH_NPROBE = int(os.getenv("RAG_NPROBE", "0"))
+SEARCH_EF = int(os.getenv("RAG_EF_SEARCH", "0"))
+
+# LLM 後端：gemini (預設) 或 fake (離線模擬，benchmark/壓力測試用，見 app/core/fake_llm.py)
+LLM_BACKEND = os.getenv("RAG_LLM", "gemini").lower()
+
+# 啟動狀態 (提供 /ready 使用)，timings 記錄冷啟動各階段耗時 (秒)
+rag_status = {"ready": False, "error": None, "timings": {}}
+
+DB_PATH = "faiss_index"
+
+# 目前載入的快照資料夾與索引版本 (對應 ingest 寫入快照 manifest.json 的 index_version)
+snapshot_path = None
+index_version = None
+_pointer_mtime = None
+_pointer_snapshot = None
+
+# 背景監看 CURRENT 指標的間隔 (秒)；ingest 發布新快照後在背景載入，請求不必等待。0 = 關閉 (改由請求觸發)
+RELOAD_POLL_SECONDS = float(os.getenv("RAG_RELOAD_POLL_SECONDS", "2"))
+
+# 已組好的 RAG Chain 快取 (LRU)，key = (source, k)。
+# Chain 本身不含索引狀態 (檢索一律經過當下的 ServingIndex)，索引熱抽換後照樣可用，不需要失效；
+# 請求 (Thread Pool) 與背景 watcher 可能同時存取，以鎖保護
+CHAIN_CACHE_SIZE = int(os.getenv("RAG_CHAIN_CACHE_SIZE", "64"))
+_chain_cache = OrderedDict()
+_chain_cache_lock = threading.Lock()
+chain_cache_stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+# Query Embedding 與 FAISS 搜尋屬於 CPU 工作，丟到有上限的 Thread Pool，不佔住 event loop
+RETRIEVAL_WORKERS = int(os.getenv("RAG_RETRIEVAL_WORKERS", "4"))
+_retrieval_executor = ThreadPoolExecutor(max_workers=RETRIEVAL_WORKERS, thread_name_prefix="rag-retrieval")
+
+# 每個 source (病歷檔) 在 FAISS 中的向量位置 (倒排索引)
+source_positions = {}
+
+class ServingIndex:
+    """
+    一次載入的完整快照 (FAISS store + 倒排位置 + BM25 + 原始向量；舊格式另有按需建立的分區子索引)。
+    重新載入時整組一次替換，進行中的檢索會繼續用它開始時拿到的那一組，不會新舊混用。
+    refs = 正在使用它的檢索數；被換下 (retired) 且 refs 歸零後才釋放檔案並交給 GC 刪除快照。
+    """
+
+    def __init__(self, path, store, positions, sparse, vectors):
+        self.path = path
+        self.store = store
+        self.positions = positions
+        self.sparse = sparse
+        self.vectors = vectors
+        self.partitions = {}
+        self.refs = 0
+        self.retired = False
+
+_serving = None
+_serving_lock = threading.Lock()
+
+def _acquire_serving():
+    with _serving_lock:
+        serving = _serving
+        serving.refs += 1
+    return serving
+
+def _release_serving(serving):
+    with _serving_lock:
+        serving.refs -= 1
+        done = serving.retired and serving.refs == 0
+    if done:
+        _dispose_later(serving)
+
+def _swap_serving(new):
+    """換上新快照；舊快照等進行中的檢索結束後才釋放"""
+    global _serving
+    with _serving_lock:
+        old, _serving = _serving, new
+        if old is None:
+            return
+        old.retired = True
+        done = old.refs == 0
+    if done:
+        _dispose_later(old)
+
+def _dispose_later(serving):
+    threading.Thread(target=_dispose, args=(serving,), name="rag-snapshot-gc", daemon=True).start()
+
+def _dispose(serving):
+    """(背景 Thread) 關閉舊快照的檔案、解除 pin，再清除沒有任何 Process 使用的舊快照"""
+    close = getattr(serving.store.docstore, "close", None)
+    if close is not None:
+        close()
+    serving.partitions.clear()
+    if serving.path != snapshot_path: # 同一個快照被重新載入時，pin 由新的那一組沿用
+        unpin_snapshot(serving.path)
+    removed = gc_snapshots(DB_PATH)
+    if removed:
+        print(f"🧹 [RAG] 已清除舊快照：{', '.join(removed)}")
+
+def _build_source_positions(store):
+    """掃描一次 docstore，建立 source -> 向量位置 的倒排索引"""
+    positions = {}
+    for pos, doc_id in store.index_to_docstore_id.items():
+        doc = store.docstore.search(doc_id)
+        if isinstance(doc, Document):
+            positions.setdefault(doc.metadata.get("source"), []).append(pos)
+    return {src: np.asarray(p, dtype=np.int64) for src, p in positions.items()}
+
+def _get_partition(serving, source):
+    """
+    取得單一病歷的向量 (只包含該檔案，精確搜尋)，回傳 (向量矩陣或子索引, 全域位置)。
+    - 有 vectors.npy (mmap) 時：同一個檔案的 chunk 在索引中是連續的，直接切出 view，
+      不複製資料，所有 worker process 共用 page cache；不連續時才臨時取出該病歷的列。
+    - 舊格式沒有原始向量：從全域索引 reconstruct 建立子索引並快取。
+    """
+    positions = serving.positions.get(source)
+    if positions is None or len(positions) == 0:
+        return None
+    if serving.vectors is not None:
+        first, last = int(positions[0]), int(positions[-1])
+        if last - first + 1 == len(positions):
+            return serving.vectors[first:last + 1], positions
+        return serving.vectors[positions], positions
+
+    partition = serving.partitions.get(source)
+    if partition is None:
+        sub_index = faiss.IndexFlatL2(serving.store.index.d)
+        sub_index.add(serving.store.index.reconstruct_batch(positions))
+        partition = (sub_index, positions)
+        serving.partitions[source] = partition
+    return partition
+
+# 混合檢索 (BM25 + 向量) 設定：兩邊各取 fetch_k 筆，再用 Reciprocal Rank Fusion 合併
+HYBRID_ENABLED = os.getenv("RAG_HYBRID", "1") != "0"
+HYBRID_FETCH_K = int(os.getenv("RAG_HYBRID_FETCH_K", "20"))
+RRF_K = int(os.getenv("RAG_RRF_K", "60"))
+
+def _search_vectors(serving, vectors, k, selected_source=None):
+    """
+    以一次 FAISS 呼叫搜尋多個問題向量，回傳每個問題命中的全域向量位置 (依距離排序)。
+    有指定 source 時只搜尋該病歷的分區 (成本與該病歷大小成正比，不受總語料量影響)，
+    否則搜尋全域索引。
+    """
+    if selected_source:
+        partition = _get_partition(serving, selected_source)
+        if partition is None:
+            return [[] for _ in range(len(vectors))]
+        index, positions = partition
+    else:
+        index, positions = serving.store.index, None
+
+    if isinstance(index, np.ndarray):
+        top_k = min(k, len(index))
+        _, hits = faiss.knn(vectors, index, top_k)
+    else:
+        top_k = min(k, index.ntotal)
+        if top_k == 0:
+            return [[] for _ in range(len(vectors))]
+        _, hits = index.search(vectors, top_k)
+
+    results = []
+    for row in hits:
+        row = row[row != -1]
+        results.append([int(p) for p in (positions[row] if positions is not None else row)])
+    return results
+
+def reciprocal_rank_fusion(rankings, k, rrf_k=RRF_K):
+    """RRF：score(d) = Σ 1 / (rrf_k + rank)，回傳分數最高的 k 個位置"""
+    scores = {}
+    for ranking in rankings:
+        for rank, pos in enumerate(ranking):
+            scores[pos] = scores.get(pos, 0.0) + 1.0 / (rrf_k + rank + 1)
+    return sorted(scores, key=scores.get, reverse=True)[:k]
+
+def _position_to_document(serving, pos):
+    return serving.store.docstore.search(serving.store.index_to_docstore_id[pos])
+
+def search_documents_batch(requests, traces=(), query_vectors=None):
+    """
+    批次檢索：requests 為 [(query, k, selected_source), ...]。
+    全部問題只做一次 Embedding forward pass，同一個 source 的問題合併成一次 FAISS 搜尋。
+    有 BM25 索引時，再與稀疏檢索結果 (同樣套用 source 過濾) 以 RRF 融合。
+    :param traces: 這批請求各自的 trace，各步驟耗時 (整批一起計) 會記到每一個 trace
+    :param query_vectors: 與 requests 對應、呼叫端已算好的問題向量 (None 表示需要計算)
+    """
+    if not requests:
+        return []
+    serving = _acquire_serving() # 整批使用同一組索引 (期間即使熱抽換也不受影響)
+    try:
+        return _search_with(serving, requests, traces, query_vectors)
+    finally:
+        _release_serving(serving)
+
+def _embed_queries(requests, traces, query_vectors=None):
+    """問題向量：已提供的直接沿用，其餘的一次 forward pass 算完"""
+    query_vectors = list(query_vectors or [None] * len(requests))
+    missing = [i for i, vector in enumerate(query_vectors) if vector is None]
+    if missing:
+        started = time.perf_counter()
+        computed = embeddings.embed_documents([requests[i][0] for i in missing])
+        # 全部都要計算時 traces 可能是整批共用的一個 trace；部分沿用時 traces 與 requests 一一對應
+        observe_stage("embed", time.perf_counter() - started,
+                      traces if len(missing) == len(requests) else [traces[i] for i in missing])
+        for i, vector in zip(missing, computed):
+            query_vectors[i] = vector
+    return np.asarray(query_vectors, dtype=np.float32)
+
+def _search_with(serving, requests, traces, query_vectors=None):
+    vectors = _embed_queries(requests, traces, query_vectors)
+    sparse = serving.sparse if HYBRID_ENABLED else None
+
+    groups = defaultdict(list)
+    for i, (_, _, source) in enumerate(requests):
+        groups[source or None].append(i)
+
+    ranked_lists = [None] * len(requests)
+    dense_sec = sparse_sec = 0.0
+    for source, idxs in groups.items():
+        k_max = max(requests[i][1] for i in idxs)
+        fetch_k = max(k_max, HYBRID_FETCH_K) if sparse is not None else k_max
+        started = time.perf_counter()
+        dense_lists = _search_vectors(serving, vectors[idxs], fetch_k, source)
+        dense_sec += time.perf_counter() - started
+        for i, dense in zip(idxs, dense_lists):
+            query, k, _ = requests[i]
+            if sparse is not None:
+                started = time.perf_counter()
+                lexical = sparse.search(query, fetch_k, source).tolist()
+                sparse_sec += time.perf_counter() - started
+                ranked_lists[i] = reciprocal_rank_fusion([dense, lexical], k)
+            else:
+                ranked_lists[i] = dense[:k]
+    observe_stage("vector_search", dense_sec, traces)
+    if sparse is not None:
+        observe_stage("bm25_search", sparse_sec, traces)
+
+    started = time.perf_counter()
+    results = [[_position_to_document(serving, pos) for pos in ranked] for ranked in ranked_lists]
+    observe_stage("docstore", time.perf_counter() - started, traces)
+    return results
+
+def _search_traced_batch(items):
+    """微批次的 batch_fn：items 為 [((query, k, selected_source), trace, query_vector), ...]"""
+    return search_documents_batch([request for request, _, _ in items], [trace for _, trace, _ in items],
+                                  [vector for _, _, vector in items])
+
+# 微批次：同時進來的單一檢索請求，在短時間窗內合併成一批 (設為 0 可關閉)
+BATCH_WINDOW_MS = float(os.getenv("RAG_BATCH_WINDOW_MS", "3"))
+BATCH_MAX_SIZE = int(os.getenv("RAG_BATCH_MAX_SIZE", "64"))
+retrieval_batcher = MicroBatcher(_search_traced_batch, BATCH_WINDOW_MS, BATCH_MAX_SIZE,
+                                 name="rag-retrieval-batcher")
+
+def search_documents(query, k=3, selected_source=None, embedding=None):
+    """單一問題的向量檢索 (Thread 中呼叫)；embedding 為已算好的問題向量時不再重算"""
+    trace = current_trace()
+    if BATCH_WINDOW_MS > 0:
+        return retrieval_batcher.submit(((query, k, selected_source), trace, embedding))
+    return search_documents_batch([(query, k, selected_source)], (trace,), [embedding])[0]
+
+async def asearch_documents(query, k=3, selected_source=None, embedding=None):
+    """單一問題的向量檢索 (async)；等待期間不佔用 event loop 與 Thread Pool"""
+    if BATCH_WINDOW_MS > 0:
+        future = retrieval_batcher.submit_future(((query, k, selected_source), current_trace(), embedding))
+        return await asyncio.wrap_future(future)
+    loop = asyncio.get_running_loop()
+    # run_in_executor 不會帶 contextvars，這裡先取出 trace 直接傳入
+    results = await loop.run_in_executor(
+        _retrieval_executor, search_documents_batch, [(query, k, selected_source)], (current_trace(),), [embedding]
+    )
+    return results[0]
+
+# 呼叫端已算好的問題向量 (例如查語意回答快取時)，Chain 裡的 Retriever 直接沿用，不再 Embedding 一次
+_query_vector = contextvars.ContextVar("rag_query_vector", default=None)
+
+@contextmanager
+def use_query_vector(query, vector):
+    """區塊內對 query 的檢索沿用 vector (None 時照常計算)"""
+    token = _query_vector.set((query, vector) if vector is not None else None)
+    try:
+        yield
+    finally:
+        _query_vector.reset(token)
+
+def _provided_query_vector(query):
+    provided = _query_vector.get()
+    return provided[1] if provided is not None and provided[0] == query else None
+
+def build_context(query, docs, trace=None):
+    """檢索結果 -> 實際放進 Prompt 的內容 (合併重疊 chunk、去重、套用 token 預算，見 app/core/context.py)"""
+    with span("context", trace):
+        return assemble_context(query, docs)
+
+class PartitionedRetriever(BaseRetriever):
+    """
+    依 source 選擇分區子索引或全域索引的 Retriever。
+    回傳的是組裝後的 context (Chain 的 context 輸出與 /chat 的 sources 都來自它)。
+    """
+    k: int = 3
+    selected_source: Optional[str] = None
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        return build_context(query, search_documents(query, self.k, self.selected_source,
+                                                     _provided_query_vector(query)))
+
+    async def _aget_relevant_documents(
+        self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        return build_context(query, await asearch_documents(query, self.k, self.selected_source,
+                                                            _provided_query_vector(query)))
+
+def _read_current_snapshot():
+    """
+    CURRENT 目前指向的快照資料夾 (舊版格式為 DB_PATH 本身，沒有索引時為 None)。
+    先比對 CURRENT 的 mtime，沒變就不重新讀取 (每次檢查只花一次 stat)。
+    """
+    global _pointer_mtime, _pointer_snapshot
+    try:
+        mtime = os.stat(os.path.join(DB_PATH, CURRENT_FILE)).st_mtime_ns
+    except OSError:
+        return current_snapshot_path(DB_PATH)
+    if mtime != _pointer_mtime:
+        _pointer_snapshot, _pointer_mtime = current_snapshot_path(DB_PATH), mtime
+    return _pointer_snapshot
+
+def _read_manifest(path):
+    try:
+        with open(os.path.join(path, "manifest.json"), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def _check_embedding_signature(manifest):
+    """問題向量與索引向量必須來自同一個模型/後端/精度，不一致時提醒 (檢索品質會下降)"""
+    expected = embedding_signature()
+    built = {key: manifest.get(f"embedding_{key}") for key in ("model", "backend", "precision")}
+    if built["backend"] is not None and built != expected:
+        print(f"⚠️ 警告：索引以 {built['model']} ({built['backend']}, {built['precision']}) 建立，"
+              f"但目前設定為 {expected['model']} ({expected['backend']}, {expected['precision']})，"
+              f"請改回相同設定或重新 ingest")
+
+# 索引重新載入時要通知的回呼 (例如回答快取)
+_reload_listeners = []
+
+def register_reload_listener(callback):
+    """註冊索引重新載入後要執行的回呼，用來讓外部快取一起失效"""
+    _reload_listeners.append(callback)
+
+def get_index_version():
+    """目前服務中的索引版本"""
+    return index_version
+
+def get_indexed_sources():
+    """目前服務中的索引包含的 source 路徑"""
+    return set(source_positions)
+
+async def aget_rag_chain(selected_source=None, k=3):
+    """
+    async 版 get_rag_chain：初始化或熱抽換期間會等 _init_lock (模型與索引載入可能要好幾秒)，
+    放到預設 Thread Pool 等，不卡住 event loop (/health、/ready 與其他請求照常回應)
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, get_rag_chain, selected_source, k)
+
+async def aembed_query(text):
+    """在檢索 Thread Pool 中計算問題向量 (不佔住 event loop)"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_retrieval_executor, embeddings.embed_query, text)
+
+# 背景預熱與請求可能同時觸發初始化，用鎖確保只載入一次
+_init_lock = threading.RLock()
+
+def initialize_rag_components(force_reload=False):
+    """
+    初始化核心組件 (只執行一次)
+    :param force_reload: True 時重新載入向量資料庫 (Embedding 模型與 LLM 沿用)
+    """
+    loaded_snapshot = snapshot_path
+    with _init_lock:
+        if vector_store is not None and (not force_reload or snapshot_path != loaded_snapshot):
+            return # 已經初始化過 (或等鎖期間別人已重新載入)，直接跳過
+        _initialize(force_reload)
+    _start_reload_watcher()
+
+def _initialize(force_reload):
+    global vector_store, llm, embeddings, source_positions, index_version, bm25_index, store_vectors, snapshot_path
 
     print("正在初始化 Medi-Insight RAG 組件 ...")
+    timings = {}
     
     # 準備 Embeddings
-    embeddings = HuggingFaceEmbeddings(model_name="all-MiniLM-L6-v2")
+    if embeddings is None:
+        started = time.perf_counter()
+        embeddings = create_embeddings()
+        timings["embedding_model"] = time.perf_counter() - started
     
-    # 載入向量資料庫
-    DB_PATH = "faiss_index"
-    if os.path.exists(DB_PATH):
-        print(f"📂 載入本地資料庫: {DB_PATH}")
-        vector_store = FAISS.load_local(
-            DB_PATH, 
-            embeddings, 
-            allow_dangerous_deserialization=True
-        )
+    # 載入 CURRENT 指向的快照 (FAISS 索引與欄式 docstore 都以 mmap 唯讀開啟，只組出命中的 chunk)
+    target = _read_current_snapshot()
+    if target is not None and has_store(target):
+        print(f"📂 載入本地資料庫: {target}")
+        started = time.perf_counter()
+        pin_snapshot(target) # 載入期間與使用期間都不讓 GC 刪除
+        try:
+            manifest = _read_manifest(target)
+            version = manifest.get("index_version")
+            _check_embedding_signature(manifest)
+            store = load_store(target, embeddings)
+            positions = load_source_positions(target)
+            if positions is None:
+                positions = _build_source_positions(store)
+            sparse = BM25Index.load(target)
+            vectors = load_vectors(target)
+            set_search_params(store.index, SEARCH_NPROBE, SEARCH_EF)
+        except Exception:
+            if target != snapshot_path:
+                unpin_snapshot(target)
+            raise
+        timings["index_load"] = time.perf_counter() - started
+
+        # 換上新快照 (整組一次替換，分區子索引跟著新的一組重建)
+        _swap_serving(ServingIndex(target, store, positions, sparse, vectors))
+        vector_store, source_positions, index_version = store, positions, version
+        bm25_index, store_vectors, snapshot_path = sparse, vectors, target
+        for callback in _reload_listeners:
+            callback()
+        print(f"🗂️ 已建立分區索引：{len(source_positions)} 個病歷檔 (索引版本 v{index_version}，"
+              f"BM25 {'已載入' if bm25_index is not None else '未建立'})")
     else:
         print("⚠️ 警告：找不到 faiss_index 資料夾！請先執行 ingest。")
+        rag_status["error"] = "faiss_index not found"
         return
 
     # 設定 LLM
-    llm = ChatGoogleGenerativeAI(model="models/gemini-flash-latest", temperature=0)
-    print("✅ RAG 組件初始化完成！")
+    if llm is None:
+        started = time.perf_counter()
+        llm = _create_llm()
+        timings["llm_client"] = time.perf_counter() - started
+
+    rag_status["timings"].update({name: round(sec, 3) for name, sec in timings.items()})
+    rag_status["ready"], rag_status["error"] = True, None
+    print(f"✅ RAG 組件初始化完成！({', '.join(f'{n}={sec:.2f}s' for n, sec in timings.items())})")
+
+def _create_llm():
+    if LLM_BACKEND == "fake":
+        from app.core.fake_llm import FakeChatModel
+        print("🧪 使用離線模擬 LLM (RAG_LLM=fake)")
+        return FakeChatModel()
+    from langchain_google_genai import ChatGoogleGenerativeAI
+    return ChatGoogleGenerativeAI(model="models/gemini-flash-latest", temperature=0)
+
+# Prompt 不隨請求改變，建立一次即可
+RAG_PROMPT = ChatPromptTemplate.from_template("""
+    你是一位專業的醫療 AI 助理。請根據底下的【病歷摘要】來回答醫師的問題。
+    注意：你只能回答與該病歷相關的資訊。
+    如果不確定或資料不在摘要中，請回答「病歷中未提及」。
+
+    【病歷摘要】：
+    {context}
+
+    問題：{input}
+    """)
 
-def get_rag_chain(selected_source=None):
+_qa_chains = {} # lane -> (llm, chain)
+
+def get_qa_chain(lane="interactive"):
     """
-    動態建立 RAG Chain
-    :param selected_source: 完整檔案路徑 (例如 'data/patient_report_002.pdf')
+    LLM 階段 (Prompt + Gemini) 的 Chain，與檢索無關，同一個 lane 的請求共用一份。
+    只有 LLM 這一步經過排程器 (ScheduledRunnable)：檢索與 context 組裝不佔 LLM 名額。
     """
-    # 確保組件已初始化
+    cached = _qa_chains.get(lane)
+    if cached is None or cached[0] is not llm:
+        from langchain.chains.combine_documents import create_stuff_documents_chain
+        cached = _qa_chains[lane] = (llm, create_stuff_documents_chain(ScheduledRunnable(llm, lane), RAG_PROMPT))
+    return cached[1]
+
+def refresh_index():
+    """尚未初始化時初始化；CURRENT 指向新的快照時重新載入"""
     if vector_store is None:
         initialize_rag_components()
-        if vector_store is None: return None # 真的沒救了
+    elif _read_current_snapshot() != snapshot_path:
+        print("🔄 [RAG] 偵測到新的索引快照，重新載入向量資料庫")
+        initialize_rag_components(force_reload=True)
+
+_watcher_started = False
+
+def _start_reload_watcher():
+    """索引載入成功後啟動 (只啟動一次) 背景 Thread，定期檢查 CURRENT 並在背景熱抽換"""
+    global _watcher_started
+    if RELOAD_POLL_SECONDS <= 0 or vector_store is None:
+        return
+    with _init_lock:
+        if _watcher_started:
+            return
+        _watcher_started = True
+    threading.Thread(target=_watch_snapshots, name="rag-snapshot-watcher", daemon=True).start()
+
+def _watch_snapshots():
+    while True:
+        time.sleep(RELOAD_POLL_SECONDS)
+        try:
+            refresh_index()
+        except Exception as e:
+            # 新快照載入失敗時繼續用舊的，下一輪再試
+            print(f"❌ [RAG] 背景重新載入失敗: {str(e)}")
+
+def get_rag_chain(selected_source=None, k=3):
+    """
+    取得 RAG Chain (同一組 source/k 的 Chain 會被快取重複使用)
+    :param selected_source: 完整檔案路徑 (例如 'data/patient_report_002.pdf')
+    :param k: 檢索的片段數量
+    """
+    # 確保組件已初始化；新快照平常由背景 watcher 載入，關閉 watcher 時才在請求中檢查
+    if vector_store is None or not _watcher_started:
+        refresh_index()
+    if vector_store is None: return None # 真的沒救了
+
+    cache_key = (selected_source, k)
+    with _chain_cache_lock:
+        rag_chain = _chain_cache.get(cache_key)
+        if rag_chain is not None:
+            _chain_cache.move_to_end(cache_key)
+            chain_cache_stats["hits"] += 1
+            return rag_chain
+        chain_cache_stats["misses"] += 1
 
     # 1. 設定檢索器 (Retriever) 與過濾器
-    search_kwargs = {"k": 3}
-    
     if selected_source:
-        # 💡 關鍵：Metadata Filtering
-        # 告訴 FAISS 只搜尋 source 欄位等於 selected_source 的向量
-        search_kwargs["filter"] = {"source": selected_source}
-        print(f"🔍 [RAG] 啟用過濾模式: 只搜尋 {selected_source}")
+        # 💡 關鍵：分區檢索
+        # 只搜尋 selected_source 這份病歷的向量，而不是全域搜尋後再過濾
+        print(f"🔍 [RAG] 啟用分區模式: 只搜尋 {selected_source}")
     else:
         print("🔍 [RAG] 全域搜尋模式 (搜尋所有病歷)")
 
-    retriever = vector_store.as_retriever(search_kwargs=search_kwargs)
+    retriever = PartitionedRetriever(k=k, selected_source=selected_source)
 
-    # 2. 設定 Prompt
-    prompt = ChatPromptTemplate.from_template("""
-    你是一位專業的醫療 AI 助理。請根據底下的【病歷摘要】來回答醫師的問題。
-    注意：你只能回答與該病歷相關的資訊。
-    如果不確定或資料不在摘要中，請回答「病歷中未提及」。
+    # 2. 組合 Chain
+    from langchain.chains import create_retrieval_chain
+    rag_chain = create_retrieval_chain(retriever, get_qa_chain())
 
-    【病歷摘要】：
-    {context}
+    with _chain_cache_lock:
+        _chain_cache[cache_key] = rag_chain
+        if len(_chain_cache) > CHAIN_CACHE_SIZE:
+            _chain_cache.popitem(last=False)
+            chain_cache_stats["evictions"] += 1
+    
+    return rag_chain
 
-    問題：{input}
-    """)
+# /chat/batch 單一請求同時送進 LLM 排程器的題數上限 (其餘在這裡等，不佔排程器的佇列)
+BATCH_LLM_CONCURRENCY = int(os.getenv("RAG_BATCH_LLM_CONCURRENCY", "8"))
 
-    # 3. 組合 Chain
-    qa_chain = create_stuff_documents_chain(llm, prompt)
-    rag_chain = create_retrieval_chain(retriever, qa_chain)
-    
-    return rag_chain
\ No newline at end of file
+async def abatch_answer(requests):
+    """
+    批次問答：requests 為 [(query, k, selected_source), ...]。
+    先以一次 Embedding + 批次 FAISS 完成全部檢索，再把 LLM 階段平行展開。
+    LLM 呼叫走排程器的 batch lane (排在 UI 的互動請求之後，名額只在 LLM 呼叫期間佔用)。
+    回傳 [(context_docs, answer 或 Exception), ...]
+    """
+    trace = current_trace()
+    loop = asyncio.get_running_loop()
+    with span("retrieval", trace):
+        docs_lists = await loop.run_in_executor(
+            _retrieval_executor, search_documents_batch, requests, (trace,)
+        )
+    docs_lists = [build_context(query, docs, trace) for (query, _, _), docs in zip(requests, docs_lists)]
+    config = {"callbacks": [StageTimingCallback(trace)]} if trace is not None else {}
+    qa_chain = get_qa_chain("batch")
+    limit = asyncio.Semaphore(BATCH_LLM_CONCURRENCY)
+
+    async def answer(query, docs):
+        async with limit:
+            return await qa_chain.ainvoke({"input": query, "context": docs}, config=config)
+
+    answers = await asyncio.gather(
+        *(answer(query, docs) for (query, _, _), docs in zip(requests, docs_lists)),
+        return_exceptions=True,
+    )
+    return list(zip(docs_lists, answers))
+
+# --- /metrics：索引與快取狀態 (抓取時才讀取目前的值) ---
+def _index_size():
+    return vector_store.index.ntotal if vector_store is not None else None
+
+FuncMetric("rag_index_vectors", "Number of vectors in the loaded FAISS index.", _index_size)
+FuncMetric("rag_index_sources", "Number of source documents (partitions) in the loaded index.",
+           lambda: len(source_positions) if vector_store is not None else None)
+FuncMetric("rag_index_version", "index_version of the loaded index (from manifest.json).", lambda: index_version)
+FuncMetric("rag_snapshot_inflight", "Retrievals currently using the serving snapshot.",
+           lambda: _serving.refs if _serving is not None else None)
+FuncMetric("rag_ready", "1 when the embedding model, index and LLM are loaded.", lambda: int(rag_status["ready"]))
+FuncMetric("rag_chain_cache_events_total", "RAG chain cache hits/misses/evictions.",
+           lambda: [({"event": name}, value) for name, value in chain_cache_stats.items()], kind="counter")
+FuncMetric("rag_chain_cache_entries", "Number of cached RAG chains.", lambda: len(_chain_cache))
+FuncMetric("rag_context_chunks_total", "Retrieved chunks entering / leaving context assembly.",
+           lambda: [({"stage": "in"}, context_stats["chunks_in"]), ({"stage": "out"}, context_stats["chunks_out"])],
+           kind="counter")
+FuncMetric("rag_context_tokens_total", "Estimated prompt context tokens before / after context assembly.",
+           lambda: [({"stage": "in"}, context_stats["tokens_in"]), ({"stage": "out"}, context_stats["tokens_out"])],
+           kind="counter")
+FuncMetric("rag_context_pruned_total", "Chunks merged, near-duplicate segments and sentences dropped by context assembly.",
+           lambda: [({"kind": name}, context_stats[name]) for name in ("merged", "duplicates", "sentences_dropped")],
+           kind="counter")
+FuncMetric("rag_retrieval_batches_total", "Retrieval micro-batches executed.",
+           lambda: retrieval_batcher.stats["batches"], kind="counter")
+FuncMetric("rag_retrieval_batch_items_total", "Retrieval requests processed by the micro-batcher.",
+           lambda: retrieval_batcher.stats["items"], kind="counter")
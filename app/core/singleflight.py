@@ -0,0 +1,100 @@
+import os
+import asyncio
+from collections import OrderedDict
+
+# 每個 key 的合併計數最多保留幾個 key (LRU)，避免不同問題無限累積
+SINGLEFLIGHT_KEY_STATS = int(os.getenv("SINGLEFLIGHT_KEY_STATS", "256"))
+
+class Flight:
+    """
+    一次進行中的執行：producer 產出的事件依序記錄下來，
+    每個訂閱者 (包含中途才加入的) 都從第一筆開始重播，再跟著即時收到後續事件。
+    """
+
+    def __init__(self):
+        self.events = []
+        self.done = False
+        self.error = None
+        self.task = None
+        self._changed = asyncio.Event()
+
+    def _publish(self, event):
+        self.events.append(event)
+        self._notify()
+
+    def _notify(self):
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    async def subscribe(self):
+        i = 0
+        while True:
+            while i < len(self.events):
+                yield self.events[i]
+                i += 1
+            if self.done:
+                if self.error is not None:
+                    raise self.error
+                return
+            await self._changed.wait()
+
+class SingleFlight:
+    """
+    Single-flight 請求合併 (asyncio，同一個 event loop 內)：
+    同一個 key 同時只執行一次 producer (async generator)，期間進來的相同請求直接訂閱同一次執行的事件。
+    producer 在獨立的 Task 中執行，任何一個訂閱者中途離開 (例如斷線) 都不會中斷其他人。
+    執行結束後 key 即釋放，之後的請求會重新執行 (完成的結果請交給快取)。
+    """
+
+    def __init__(self, key_stats_size=SINGLEFLIGHT_KEY_STATS):
+        self._flights = {}
+        self.key_stats_size = key_stats_size
+        self.key_stats = OrderedDict() # key -> {"flights": 實際執行次數, "coalesced": 被合併的請求數}
+        self.stats = {"flights": 0, "coalesced": 0, "errors": 0}
+
+    def join(self, key, producer_factory):
+        """
+        加入 key 的執行 (沒有進行中的就以 producer_factory() 開始一個新的)。
+        回傳 (事件的 async iterator, 是否為實際執行者)。
+        """
+        flight = self._flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = Flight()
+            self._flights[key] = flight
+            flight.task = asyncio.ensure_future(self._run(key, flight, producer_factory()))
+        self._count(key, "flights" if leader else "coalesced")
+        return flight.subscribe(), leader
+
+    def _count(self, key, field):
+        self.stats[field] += 1
+        counters = self.key_stats.get(key)
+        if counters is None:
+            counters = self.key_stats[key] = {"flights": 0, "coalesced": 0}
+            while len(self.key_stats) > self.key_stats_size:
+                self.key_stats.popitem(last=False)
+        else:
+            self.key_stats.move_to_end(key)
+        counters[field] += 1
+
+    async def _run(self, key, flight, producer):
+        try:
+            async for event in producer:
+                flight._publish(event)
+        except BaseException as e:
+            # 例外交給每個訂閱者各自拋出 (Task 本身不再拋出，避免 "exception was never retrieved")
+            flight.error = e
+            self.stats["errors"] += 1
+        finally:
+            flight.done = True
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+            flight._notify()
+
+    def in_flight(self):
+        return len(self._flights)
+
+    def top_keys(self, limit=20):
+        """被合併最多次的 key 與其計數"""
+        items = sorted(self.key_stats.items(), key=lambda kv: kv[1]["coalesced"], reverse=True)
+        return items[:limit]
@@ -0,0 +1,154 @@
+import os
+import time
+import uuid
+import shutil
+from app.core.store import has_store
+
+# 版本化的索引快照：
+# faiss_index/
+#   CURRENT                 : 目前服務中的快照名稱 (一行文字)，以 rename 原子替換
+#   snapshots/v000013/      : 每次 ingest 產生一個新資料夾 (index.faiss、docstore、BM25、manifest.json ...)
+#   snapshots/.staging-*    : 建立中的快照，完成後才 rename 成正式名稱
+# 快照建好後內容不再修改，服務端可以放心 mmap；切換版本只需要換 CURRENT。
+SNAPSHOTS_DIR = "snapshots"
+CURRENT_FILE = "CURRENT"
+STAGING_PREFIX = ".staging-"
+PIN_PREFIX = ".pin-"
+# 保留最新的幾個快照 (含 CURRENT)，方便回滾；其餘沒有被任何 Process 使用中的快照會被刪除
+SNAPSHOT_KEEP = int(os.getenv("INDEX_SNAPSHOT_KEEP", "2"))
+
+# 舊版 (直接存在 faiss_index/ 底下) 的檔案，遷移到快照格式後清除
+_LEGACY_PREFIXES = ("index.", "docstore.", "vectors.", "partitions.", "bm25_", "manifest.")
+
+def read_current(db_path):
+    """讀取 CURRENT 指向的快照名稱；沒有 (尚未 ingest 或舊版格式) 時回傳 None"""
+    try:
+        with open(os.path.join(db_path, CURRENT_FILE), "r", encoding="utf-8") as f:
+            name = f.read().strip()
+    except OSError:
+        return None
+    return name or None
+
+def current_snapshot_path(db_path):
+    """目前服務中的快照資料夾；舊版格式回傳 db_path 本身，什麼都沒有時回傳 None"""
+    name = read_current(db_path)
+    if name:
+        return os.path.join(db_path, SNAPSHOTS_DIR, name)
+    return db_path if has_store(db_path) else None
+
+def begin_snapshot(db_path):
+    """建立暫存的快照資料夾 (寫完後呼叫 publish_snapshot)"""
+    staging = os.path.join(db_path, SNAPSHOTS_DIR, f"{STAGING_PREFIX}{os.getpid()}-{uuid.uuid4().hex[:8]}")
+    os.makedirs(staging)
+    return staging
+
+def publish_snapshot(db_path, staging, version):
+    """
+    把暫存資料夾改名為正式快照，再原子替換 CURRENT。
+    服務端在 CURRENT 換掉之前看到的都是完整的舊快照，之後看到的都是完整的新快照。
+    回傳快照名稱。
+    """
+    name = f"v{version:06d}"
+    if os.path.exists(os.path.join(db_path, SNAPSHOTS_DIR, name)):
+        name = f"{name}-{int(time.time())}"
+    os.rename(staging, os.path.join(db_path, SNAPSHOTS_DIR, name))
+
+    pointer = os.path.join(db_path, CURRENT_FILE)
+    with open(pointer + ".tmp", "w", encoding="utf-8") as f:
+        f.write(name + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(pointer + ".tmp", pointer)
+    return name
+
+def abort_snapshot(staging):
+    shutil.rmtree(staging, ignore_errors=True)
+
+def pin_snapshot(path):
+    """標記本 Process 正在使用這個快照 (GC 不會刪除)；舊版格式不需要"""
+    if os.path.basename(os.path.dirname(path)) != SNAPSHOTS_DIR:
+        return
+    try:
+        with open(os.path.join(path, f"{PIN_PREFIX}{os.getpid()}"), "w"):
+            pass
+    except OSError:
+        pass
+
+def unpin_snapshot(path):
+    try:
+        os.remove(os.path.join(path, f"{PIN_PREFIX}{os.getpid()}"))
+    except OSError:
+        pass
+
+def pid_alive(pid):
+    """Process 是否仍存在 (pin / 暫存資料夾 / ingest job 的擁有者檢查)"""
+    if os.name == "nt":
+        # Windows 的 os.kill 會直接結束 Process，改用 OpenProcess 探測
+        import ctypes
+        handle = ctypes.windll.kernel32.OpenProcess(0x1000, False, pid) # PROCESS_QUERY_LIMITED_INFORMATION
+        if not handle:
+            return False
+        ctypes.windll.kernel32.CloseHandle(handle)
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+def _is_pinned(path):
+    try:
+        names = os.listdir(path)
+    except OSError:
+        return False
+    for name in names:
+        if name.startswith(PIN_PREFIX):
+            pid = name[len(PIN_PREFIX):]
+            if pid.isdigit() and pid_alive(int(pid)):
+                return True
+            # Process 已不存在 (例如被 kill)，清掉殘留的標記
+            try:
+                os.remove(os.path.join(path, name))
+            except OSError:
+                pass
+    return False
+
+def gc_snapshots(db_path, keep=SNAPSHOT_KEEP):
+    """
+    刪除過舊的快照：CURRENT 與最新的 keep 個一律保留，其餘只在沒有任何 Process 使用 (pin) 時刪除。
+    同時清掉其他 Process 留下的暫存資料夾，以及已遷移的舊版檔案。回傳刪除的快照名稱。
+    """
+    root = os.path.join(db_path, SNAPSHOTS_DIR)
+    current = read_current(db_path)
+    if current is None or not os.path.isdir(root):
+        return []
+
+    snapshots, removed = [], []
+    for name in os.listdir(root):
+        path = os.path.join(root, name)
+        if name.startswith(STAGING_PREFIX):
+            pid = name[len(STAGING_PREFIX):].split("-", 1)[0]
+            if not (pid.isdigit() and pid_alive(int(pid))):
+                shutil.rmtree(path, ignore_errors=True)
+        elif os.path.isdir(path):
+            snapshots.append(name)
+
+    retained = set(sorted(snapshots)[-keep:]) if keep > 0 else set()
+    retained.add(current)
+    for name in snapshots:
+        path = os.path.join(root, name)
+        if name in retained or _is_pinned(path):
+            continue
+        shutil.rmtree(path, ignore_errors=True)
+        if not os.path.exists(path):
+            removed.append(name)
+
+    for name in os.listdir(db_path):
+        if name.startswith(_LEGACY_PREFIXES) and os.path.isfile(os.path.join(db_path, name)):
+            try:
+                os.remove(os.path.join(db_path, name))
+            except OSError:
+                pass # Windows 上舊服務可能還開著檔案，下次再清
+    return removed
@@ -0,0 +1,345 @@
+import os
+import json
+import mmap
+from collections.abc import Mapping
+import numpy as np
+import faiss
+from langchain_core.documents import Document
+
+# 向量資料庫的檔案格式：
+# - index.faiss           : FAISS 搜尋索引 (flat 或 IVF/IVF-PQ/HNSW，可用 mmap 直接讀取)
+# - vectors.npy           : 原始 float32 向量 (依向量位置排列)，供分區搜尋與下次增量 ingest 使用
+# - partitions.npy        : 依 source 分組排列的向量位置 (int64)，以 mmap 開啟
+# - partitions.json       : 每個 source 在 partitions.npy 中的 [start, end) 範圍 (只有 source 數筆)
+# 欄式 docstore (第 i 列 = 向量位置 i)，全部以 mmap 開啟，查詢時只組出命中的 k 個 Document：
+# - docstore.text.bin     : 所有 chunk 文字接在一起的 UTF-8 blob
+# - docstore.ids.bin      : 所有 chunk ID 接在一起的 UTF-8 blob (ingest 增量刪除時使用)
+# - docstore.columns.npy  : 每列的 text_end / id_end / spans_end (累計 offset) 與
+#                           source / page_label (字串字典編號，-1 = 無)、page (-1 = 無)
+# - docstore.spans.npy    : 所有 chunk 的句子範圍 (M x 2 int32)，以 spans_end 切出各列
+# - docstore.meta.json    : 字串字典 (sources、page_labels)、每個 source 共用的其他 metadata，
+#                           以及少數與共用值不同的 chunk metadata
+INDEX_FILE = "index.faiss"
+VECTORS_FILE = "vectors.npy"
+PARTITIONS_FILE = "partitions.json"
+PARTITION_POSITIONS_FILE = "partitions.npy"
+TEXT_FILE = "docstore.text.bin"
+IDS_FILE = "docstore.ids.bin"
+COLUMNS_FILE = "docstore.columns.npy"
+SPANS_FILE = "docstore.spans.npy"
+DOCSTORE_META_FILE = "docstore.meta.json"
+DOCSTORE_FORMAT = 1
+# 舊版格式：index.pkl (pickle，已不再支援，下次 ingest 時改寫)
+LEGACY_PICKLE_FILE = "index.pkl"
+
+COLUMNS_DTYPE = np.dtype([
+    ("text_end", "<i8"), ("id_end", "<i8"), ("spans_end", "<i8"),
+    ("source", "<i4"), ("page", "<i4"), ("page_label", "<i4"),
+])
+# 以欄位儲存的 metadata key，其餘 key 歸到每個 source 共用的 metadata
+_COLUMN_KEYS = ("source", "page", "page_label", "sentence_spans")
+
+def _write_docstore(vector_store, db_path):
+    """把 docstore 依向量位置寫成欄式格式，回傳 (寫出的暫存檔路徑, source -> 向量位置清單)"""
+    count = len(vector_store.index_to_docstore_id)
+    columns = np.zeros(count, dtype=COLUMNS_DTYPE)
+    sources, source_codes, source_metadata = [], {}, []
+    page_labels, label_codes = [], {}
+    spans, extra = [], {}
+    partitions = {}
+    text_end = id_end = 0
+
+    text_path = os.path.join(db_path, TEXT_FILE)
+    ids_path = os.path.join(db_path, IDS_FILE)
+    with open(text_path + ".tmp", "wb") as text_file, open(ids_path + ".tmp", "wb") as ids_file:
+        for pos in range(count):
+            doc_id = vector_store.index_to_docstore_id[pos]
+            doc = vector_store.docstore.search(doc_id)
+            metadata = doc.metadata
+
+            text = doc.page_content.encode("utf-8")
+            text_file.write(text)
+            text_end += len(text)
+            encoded_id = doc_id.encode("utf-8")
+            ids_file.write(encoded_id)
+            id_end += len(encoded_id)
+
+            source = metadata.get("source")
+            code = source_codes.get(source)
+            if code is None:
+                code = source_codes[source] = len(sources)
+                sources.append(source)
+                source_metadata.append({k: v for k, v in metadata.items() if k not in _COLUMN_KEYS})
+            label = metadata.get("page_label")
+            label_code = -1
+            if label is not None:
+                label_code = label_codes.get(label)
+                if label_code is None:
+                    label_code = label_codes[label] = len(page_labels)
+                    page_labels.append(label)
+            spans.extend(metadata.get("sentence_spans") or ())
+
+            # 同一個 source 的其他 metadata 通常完全相同；不同時才逐筆記下
+            rest = {k: v for k, v in metadata.items() if k not in _COLUMN_KEYS}
+            if rest != source_metadata[code]:
+                extra[str(pos)] = rest
+            columns[pos] = (text_end, id_end, len(spans), code, metadata.get("page", -1), label_code)
+            partitions.setdefault(source, []).append(pos)
+
+    columns_path = os.path.join(db_path, COLUMNS_FILE)
+    with open(columns_path + ".tmp", "wb") as f:
+        np.save(f, columns)
+    spans_path = os.path.join(db_path, SPANS_FILE)
+    with open(spans_path + ".tmp", "wb") as f:
+        np.save(f, np.asarray(spans, dtype=np.int32).reshape(-1, 2))
+    meta_path = os.path.join(db_path, DOCSTORE_META_FILE)
+    with open(meta_path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump({"format": DOCSTORE_FORMAT, "count": count, "sources": sources, "page_labels": page_labels,
+                   "source_metadata": source_metadata, "extra": extra}, f, ensure_ascii=False)
+    return [text_path, ids_path, columns_path, spans_path, meta_path], partitions
+
+def save_store(vector_store, db_path, search_index=None):
+    """
+    把 LangChain FAISS store 存成可 mmap 的格式 (每個檔案先寫暫存檔再 rename)。
+    :param search_index: 另外訓練好的搜尋索引 (IVF/HNSW 等)；None 時直接存 store 的 flat 索引
+    """
+    os.makedirs(db_path, exist_ok=True)
+    index_path = os.path.join(db_path, INDEX_FILE)
+    faiss.write_index(search_index if search_index is not None else vector_store.index, index_path + ".tmp")
+
+    vectors_path = os.path.join(db_path, VECTORS_FILE)
+    with open(vectors_path + ".tmp", "wb") as f:
+        np.save(f, vector_store.index.reconstruct_n(0, vector_store.index.ntotal))
+
+    docstore_paths, partitions = _write_docstore(vector_store, db_path)
+    ranges, start = [], 0
+    for source, positions in partitions.items():
+        ranges.append([source, start, start + len(positions)])
+        start += len(positions)
+    positions_path = os.path.join(db_path, PARTITION_POSITIONS_FILE)
+    with open(positions_path + ".tmp", "wb") as f:
+        np.save(f, np.asarray([pos for positions in partitions.values() for pos in positions], dtype=np.int64))
+    partitions_path = os.path.join(db_path, PARTITIONS_FILE)
+    with open(partitions_path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(ranges, f, ensure_ascii=False)
+
+    for path in [index_path, vectors_path, positions_path, partitions_path] + docstore_paths:
+        os.replace(path + ".tmp", path)
+    # 舊版格式的檔案已不再使用
+    legacy = os.path.join(db_path, LEGACY_PICKLE_FILE)
+    if os.path.exists(legacy):
+        os.remove(legacy)
+
+class PositionIds:
+    """
+    唯讀的 向量位置 -> docstore id 對照 (id 就是位置本身)。
+    取代一個有 N 筆資料的 dict，載入時不需要建立任何 Python 物件。
+    """
+
+    def __init__(self, count):
+        self._count = count
+
+    def __getitem__(self, pos):
+        if not 0 <= pos < self._count:
+            raise KeyError(pos)
+        return str(pos)
+
+    def __len__(self):
+        return self._count
+
+    def __iter__(self):
+        return iter(range(self._count))
+
+    def keys(self):
+        return range(self._count)
+
+    def values(self):
+        return (str(i) for i in range(self._count))
+
+    def items(self):
+        return ((i, str(i)) for i in range(self._count))
+
+def _mmap_file(path):
+    """以 mmap 唯讀開啟整個檔案，回傳 (file, buffer)；空檔案無法 mmap，改用 b"" """
+    f = open(path, "rb")
+    size = os.fstat(f.fileno()).st_size
+    return f, (mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else b"")
+
+class ColumnarDocstore:
+    """
+    唯讀的欄式 docstore：文字、ID、數值欄位都以 mmap 開啟，載入時不建立任何 Document，
+    search() 時才組出該筆 chunk。search 的參數為向量位置 (字串)。
+    """
+
+    def __init__(self, db_path):
+        with open(os.path.join(db_path, DOCSTORE_META_FILE), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        self._sources = meta["sources"]
+        self._page_labels = meta["page_labels"]
+        self._source_metadata = meta["source_metadata"]
+        self._extra = meta["extra"]
+        self._columns = np.load(os.path.join(db_path, COLUMNS_FILE), mmap_mode="r")
+        self._spans = np.load(os.path.join(db_path, SPANS_FILE), mmap_mode="r")
+        self._text_file, self._text = _mmap_file(os.path.join(db_path, TEXT_FILE))
+        self._ids_file, self._ids = _mmap_file(os.path.join(db_path, IDS_FILE))
+
+    def __len__(self):
+        return len(self._columns)
+
+    @staticmethod
+    def _range(columns, pos, field):
+        return (int(columns[pos - 1][field]) if pos > 0 else 0), int(columns[pos][field])
+
+    def doc_id(self, pos):
+        start, end = self._range(self._columns, pos, "id_end")
+        return self._ids[start:end].decode("utf-8")
+
+    def source(self, pos):
+        code = int(self._columns[pos]["source"])
+        return self._sources[code] if code >= 0 else None
+
+    def search(self, search):
+        pos = int(search)
+        if not 0 <= pos < len(self):
+            return f"ID {search} not found."
+        row = self._columns[pos]
+        start, end = self._range(self._columns, pos, "text_end")
+        text = self._text[start:end].decode("utf-8")
+
+        code = int(row["source"])
+        metadata = dict(self._source_metadata[code])
+        metadata["source"] = self._sources[code]
+        if int(row["page"]) >= 0:
+            metadata["page"] = int(row["page"])
+        if int(row["page_label"]) >= 0:
+            metadata["page_label"] = self._page_labels[int(row["page_label"])]
+        span_start, span_end = self._range(self._columns, pos, "spans_end")
+        if span_end > span_start:
+            metadata["sentence_spans"] = self._spans[span_start:span_end].tolist()
+        extra = self._extra.get(str(pos))
+        if extra is not None:
+            metadata = {**{k: metadata[k] for k in _COLUMN_KEYS if k in metadata}, **extra}
+        return Document(id=self.doc_id(pos), page_content=text, metadata=metadata)
+
+    def close(self):
+        """釋放 mmap 與檔案 (快照要被刪除前呼叫；Windows 上開著的檔案無法刪除)"""
+        for name in ("_text", "_ids"):
+            buffer = getattr(self, name)
+            if isinstance(buffer, mmap.mmap):
+                buffer.close()
+            setattr(self, name, b"")
+        self._text_file.close()
+        self._ids_file.close()
+        self._columns = self._spans = None
+
+    def add(self, texts):
+        raise TypeError("ColumnarDocstore 為唯讀 (read-only docstore)，請用 load_store(..., lazy=False) 載入後再修改")
+
+    def delete(self, ids):
+        raise TypeError("ColumnarDocstore 為唯讀 (read-only docstore)，請用 load_store(..., lazy=False) 載入後再修改")
+
+def open_docstore(db_path):
+    """開啟資料夾中的唯讀欄式 docstore；沒有時回傳 None"""
+    if os.path.exists(os.path.join(db_path, DOCSTORE_META_FILE)):
+        return ColumnarDocstore(db_path)
+    return None
+
+# 依序嘗試的 mmap 讀取方式：
+# - IO_FLAG_MMAP | IO_FLAG_MMAP_IFC : flat / HNSW 的向量 (IndexFlatCodes) 直接對應到檔案
+#   (只用 IO_FLAG_MMAP 時它們仍會被複製進記憶體)；IVF 系列不支援這個組合
+# - IO_FLAG_MMAP                    : IVF / IVF-PQ 的 inverted lists
+_MMAP_FLAGS = tuple(
+    flags | faiss.IO_FLAG_READ_ONLY
+    for flags in (faiss.IO_FLAG_MMAP | getattr(faiss, "IO_FLAG_MMAP_IFC", 0), faiss.IO_FLAG_MMAP)
+)
+
+def read_index_mmap(index_path):
+    """
+    以 mmap 唯讀開啟 FAISS 索引：向量資料留在 page cache，多個 worker process 共用同一份實體記憶體，
+    每個 worker 不會隨語料量增加而多複製一份索引。不支援的索引類型退回一般讀取。
+    """
+    for flags in _MMAP_FLAGS:
+        try:
+            return faiss.read_index(index_path, flags)
+        except RuntimeError:
+            continue
+    return faiss.read_index(index_path)
+
+def has_store(db_path):
+    """資料夾中是否有可載入的向量資料庫"""
+    return os.path.exists(os.path.join(db_path, INDEX_FILE)) and os.path.exists(
+        os.path.join(db_path, DOCSTORE_META_FILE))
+
+def load_store(db_path, embeddings, lazy=True):
+    """
+    載入向量資料庫。
+    :param lazy: True (服務端) 時 FAISS 索引以 mmap 唯讀開啟、docstore 按需讀取；
+                 False (ingest) 時完整載入成可修改的 InMemoryDocstore。
+    """
+    from langchain_community.vectorstores import FAISS
+    from langchain_community.docstore.in_memory import InMemoryDocstore
+
+    if not has_store(db_path):
+        if os.path.exists(os.path.join(db_path, LEGACY_PICKLE_FILE)):
+            # 不再以 pickle 載入 (需要 allow_dangerous_deserialization)，請重新 ingest
+            raise RuntimeError("偵測到舊版 index.pkl 格式，已不再支援，請重新執行 Ingest 重建索引")
+        raise RuntimeError(f"{db_path} 中找不到向量資料庫")
+
+    index_path = os.path.join(db_path, INDEX_FILE)
+    if lazy:
+        index = read_index_mmap(index_path)
+        docstore = open_docstore(db_path)
+        return FAISS(embeddings, index, docstore, PositionIds(len(docstore)))
+
+    # ingest 需要可刪除/新增的 flat 索引：由原始向量重建 (搜尋索引可能是 IVF/HNSW)
+    vectors = load_vectors(db_path)
+    if vectors is not None:
+        index = faiss.IndexFlatL2(vectors.shape[1])
+        index.add(np.ascontiguousarray(vectors))
+    else:
+        index = faiss.read_index(index_path)
+    lazy_docs = open_docstore(db_path)
+    docs, mapping = {}, {}
+    for pos in range(len(lazy_docs)):
+        doc = lazy_docs.search(str(pos))
+        docs[doc.id] = doc
+        mapping[pos] = doc.id
+    lazy_docs.close()
+    return FAISS(embeddings, index, InMemoryDocstore(docs), mapping)
+
+class SourcePositions(Mapping):
+    """
+    source -> 向量位置 (mmap 陣列的切片)。位置陣列留在 page cache 由所有 worker 共用，
+    每個 worker 自己的記憶體只有 source 數筆的範圍，不隨向量數量增加。
+    """
+
+    def __init__(self, ranges, positions):
+        self._ranges = {source: (start, end) for source, start, end in ranges}
+        self._positions = positions
+
+    def __getitem__(self, source):
+        start, end = self._ranges[source]
+        return self._positions[start:end]
+
+    def __iter__(self):
+        return iter(self._ranges)
+
+    def __len__(self):
+        return len(self._ranges)
+
+def load_source_positions(db_path):
+    """讀取預先算好的 source -> 向量位置 對照 (位置陣列以 mmap 唯讀開啟)"""
+    path = os.path.join(db_path, PARTITIONS_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        ranges = json.load(f)
+    positions = np.load(os.path.join(db_path, PARTITION_POSITIONS_FILE), mmap_mode="r")
+    return SourcePositions(ranges, positions)
+
+def load_vectors(db_path):
+    """以 mmap 唯讀開啟原始向量 (N x d float32)；舊格式沒有這個檔案時回傳 None"""
+    path = os.path.join(db_path, VECTORS_FILE)
+    if not os.path.exists(path):
+        return None
+    return np.load(path, mmap_mode="r")
@@ -0,0 +1,144 @@
+import os
+import json
+import time
+import contextvars
+from contextlib import contextmanager
+from langchain_core.callbacks import BaseCallbackHandler
+from app.core.metrics import Counter, Histogram
+
+# 每個請求的分階段計時 (span)。stage 名稱：
+# - cache_lookup : 查回答快取 (啟用語意比對時含問題 Embedding)
+# - retrieval    : 整段檢索 (含微批次排隊等待)
+#   - embed / vector_search / bm25_search / docstore : 檢索內部各步驟 (批次執行，每批記一次)
+# - prompt       : 把檢索片段塞進 Prompt
+# - llm          : LLM 呼叫 (llm_first_token 為收到第一個 token 的時間)
+# - highlight    : 關鍵句萃取與高亮 (format_sources)
+STAGE_SECONDS = Histogram("rag_stage_seconds", "Latency of each RAG pipeline stage in seconds.", ["stage"])
+REQUEST_SECONDS = Histogram("rag_request_seconds", "End-to-end request latency in seconds.", ["endpoint"])
+REQUESTS_TOTAL = Counter("rag_requests_total", "Requests handled, by endpoint and status.", ["endpoint", "status"])
+
+# 超過此門檻 (毫秒) 的請求會印出完整的 span 分解；0 = 關閉
+SLOW_REQUEST_MS = float(os.getenv("SLOW_REQUEST_MS", "0"))
+
+_current_trace = contextvars.ContextVar("rag_trace", default=None)
+
+class Trace:
+    """單一請求的計時紀錄：stage -> [累計秒數, 次數]"""
+
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.started = time.perf_counter()
+        self.spans = {}
+        self.attributes = {}
+
+    def add(self, stage, seconds):
+        total = self.spans.setdefault(stage, [0.0, 0])
+        total[0] += seconds
+        total[1] += 1
+
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    def breakdown_ms(self):
+        return {stage: round(sec * 1000, 2) if n == 1 else {"ms": round(sec * 1000, 2), "n": n}
+                for stage, (sec, n) in self.spans.items()}
+
+def start_trace(endpoint, **attributes):
+    """開始一個請求的計時，並設為目前 context 的 trace (async Task / 複製 context 的 Thread 都看得到)"""
+    trace = Trace(endpoint)
+    trace.attributes.update(attributes)
+    _current_trace.set(trace)
+    return trace
+
+def current_trace():
+    return _current_trace.get()
+
+def observe_stage(stage, seconds, traces=()):
+    """記錄一次階段耗時到 histogram，並累加到相關請求的 trace"""
+    STAGE_SECONDS.observe(seconds, stage)
+    for trace in traces:
+        if trace is not None:
+            trace.add(stage, seconds)
+
+@contextmanager
+def span(stage, trace=None):
+    """計時區塊；trace 未指定時使用目前 context 的 trace"""
+    trace = trace or current_trace()
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(stage, time.perf_counter() - started, (trace,))
+
+def finish_trace(trace, status="ok"):
+    """結束請求：記錄總耗時，超過 SLOW_REQUEST_MS 時印出 span 分解"""
+    elapsed = trace.elapsed()
+    REQUEST_SECONDS.observe(elapsed, trace.endpoint)
+    REQUESTS_TOTAL.inc(trace.endpoint, status)
+    if SLOW_REQUEST_MS and elapsed * 1000 >= SLOW_REQUEST_MS:
+        record = {"endpoint": trace.endpoint, "status": status, "total_ms": round(elapsed * 1000, 2),
+                  "spans_ms": trace.breakdown_ms(), **trace.attributes}
+        print(f"🐢 慢請求: {json.dumps(record, ensure_ascii=False)}")
+    return elapsed
+
+class StageTimingCallback(BaseCallbackHandler):
+    """
+    LangChain callback：把 Chain 內部的 retriever / prompt / LLM 計時記到 trace。
+    用法：chain.ainvoke(inputs, config={"callbacks": [StageTimingCallback(trace)]})
+    """
+
+    run_inline = True # 直接在呼叫端執行，不丟到 Thread Pool
+    # 對應到 prompt 階段的 Chain 名稱 (create_stuff_documents_chain 內部)
+    PROMPT_RUNS = ("format_inputs", "ChatPromptTemplate")
+
+    def __init__(self, trace):
+        self.trace = trace
+        self._starts = {}
+        self._first_token = set()
+
+    def _start(self, run_id, stage):
+        self._starts[run_id] = (stage, time.perf_counter())
+
+    def _end(self, run_id):
+        started = self._starts.pop(run_id, None)
+        if started is not None:
+            stage, t0 = started
+            observe_stage(stage, time.perf_counter() - t0, (self.trace,))
+
+    def on_retriever_start(self, serialized, query, *, run_id, **kwargs):
+        self._start(run_id, "retrieval")
+
+    def on_retriever_end(self, documents, *, run_id, **kwargs):
+        self._end(run_id)
+
+    def on_retriever_error(self, error, *, run_id, **kwargs):
+        self._starts.pop(run_id, None)
+
+    def on_chain_start(self, serialized, inputs, *, run_id, **kwargs):
+        if kwargs.get("name") in self.PROMPT_RUNS:
+            self._start(run_id, "prompt")
+
+    def on_chain_end(self, outputs, *, run_id, **kwargs):
+        self._end(run_id)
+
+    def on_chain_error(self, error, *, run_id, **kwargs):
+        self._starts.pop(run_id, None)
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs):
+        self._start(run_id, "llm")
+
+    def on_llm_start(self, serialized, prompts, *, run_id, **kwargs):
+        self._start(run_id, "llm")
+
+    def on_llm_new_token(self, token, *, run_id, **kwargs):
+        if run_id in self._starts and run_id not in self._first_token:
+            self._first_token.add(run_id)
+            observe_stage("llm_first_token", time.perf_counter() - self._starts[run_id][1], (self.trace,))
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        self._first_token.discard(run_id)
+        self._end(run_id)
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        self._first_token.discard(run_id)
+        self._starts.pop(run_id, None)
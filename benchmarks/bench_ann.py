@@ -0,0 +1,108 @@
+"""
+近似最近鄰 (IVF / IVF-PQ / HNSW) 與 flat 精確搜尋的 recall@k 對延遲報告。
+用來挑選大型語料 (數十萬 chunks) 的 INDEX_TYPE / INDEX_NLIST / INDEX_NPROBE / INDEX_EF_SEARCH。
+
+用法 (在專案根目錄執行):
+    python benchmarks/bench_ann.py --n 300000                 # 合成資料 (模擬 MiniLM 384 維、單位長度向量)
+    python benchmarks/bench_ann.py --vectors faiss_index/snapshots/v000001/vectors.npy   # 使用實際 ingest 出來的向量
+    python benchmarks/bench_ann.py --n 300000 --json ann_report.json
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import numpy as np
+import faiss
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.core.ann import auto_nlist, build_search_index, set_search_params
+
+def synthetic_vectors(n, d, clusters, seed=0):
+    """群聚的單位向量 (病歷 chunk 大多彼此相似，比均勻亂數更接近實際分佈)"""
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(clusters, d)).astype(np.float32)
+    vectors = centers[rng.integers(0, clusters, size=n)] + 0.35 * rng.normal(size=(n, d)).astype(np.float32)
+    faiss.normalize_L2(vectors)
+    return vectors
+
+def make_queries(vectors, count, seed=1):
+    rng = np.random.default_rng(seed)
+    queries = vectors[rng.integers(0, len(vectors), size=count)].copy()
+    queries += 0.05 * rng.normal(size=queries.shape).astype(np.float32)
+    faiss.normalize_L2(queries)
+    return queries
+
+def measure(index, queries, k, truth):
+    """一次一個問題 (模擬線上服務)，回傳 (recall@k, 平均延遲 ms, p95 延遲 ms)"""
+    latencies, hits = [], 0
+    for i in range(len(queries)):
+        started = time.perf_counter()
+        _, found = index.search(queries[i:i + 1], k)
+        latencies.append((time.perf_counter() - started) * 1000)
+        hits += len(np.intersect1d(found[0], truth[i]))
+    return hits / truth.size, float(np.mean(latencies)), float(np.percentile(latencies, 95))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--vectors", help="使用現成的 vectors.npy (例如 faiss_index/snapshots/v000001/vectors.npy)")
+    parser.add_argument("--n", type=int, default=200000, help="合成向量數量")
+    parser.add_argument("--d", type=int, default=384)
+    parser.add_argument("--clusters", type=int, default=2000)
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--nlist", type=int, default=0, help="0 = auto (4·sqrt(N))")
+    parser.add_argument("--pq-m", type=int, default=48)
+    parser.add_argument("--threads", type=int, default=1, help="FAISS OpenMP threads (線上服務一次一個 query，預設 1)")
+    parser.add_argument("--json", help="把結果寫成 JSON")
+    args = parser.parse_args()
+
+    faiss.omp_set_num_threads(args.threads)
+    if args.vectors:
+        vectors = np.ascontiguousarray(np.load(args.vectors), dtype=np.float32)
+    else:
+        vectors = synthetic_vectors(args.n, args.d, args.clusters)
+    n, d = vectors.shape
+    queries = make_queries(vectors, args.queries)
+    nlist = args.nlist or auto_nlist(n)
+    print(f"📐 N={n}, d={d}, queries={len(queries)}, k={args.k}, nlist={nlist}")
+
+    configs = [("flat", {}, [None])]
+    configs.append(("ivf", {"nlist": nlist}, [("nprobe", p) for p in (1, 4, 8, 16, 32, 64)]))
+    configs.append(("ivfpq", {"nlist": nlist, "pq_m": args.pq_m}, [("nprobe", p) for p in (4, 16, 32, 64)]))
+    configs.append(("hnsw", {}, [("efSearch", e) for e in (16, 32, 64, 128, 256)]))
+
+    truth = None
+    rows = []
+    for index_type, build_kwargs, sweeps in configs:
+        started = time.perf_counter()
+        index, desc = build_search_index(vectors, index_type, **build_kwargs)
+        build_sec = time.perf_counter() - started
+        size_mb = faiss.serialize_index(index).nbytes / 1e6
+        if truth is None:
+            _, truth = index.search(queries, args.k) # flat = ground truth
+        for sweep in sweeps:
+            if sweep is not None:
+                name, value = sweep
+                set_search_params(index, nprobe=value if name == "nprobe" else None,
+                                  ef_search=value if name == "efSearch" else None)
+            recall, mean_ms, p95_ms = measure(index, queries, args.k, truth)
+            rows.append({
+                "index": desc.split(" (")[0], "param": f"{sweep[0]}={sweep[1]}" if sweep else "-",
+                "recall_at_k": round(recall, 4), "mean_ms": round(mean_ms, 3), "p95_ms": round(p95_ms, 3),
+                "build_s": round(build_sec, 2), "size_mb": round(size_mb, 1),
+            })
+
+    print(f"\n{'index':<22}{'param':<14}{'recall@' + str(args.k):>10}{'mean ms':>10}{'p95 ms':>10}{'build s':>10}{'size MB':>10}")
+    for r in rows:
+        print(f"{r['index']:<22}{r['param']:<14}{r['recall_at_k']:>10.4f}{r['mean_ms']:>10.3f}"
+              f"{r['p95_ms']:>10.3f}{r['build_s']:>10.2f}{r['size_mb']:>10.1f}")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"n": n, "d": d, "k": args.k, "queries": len(queries), "nlist": nlist, "results": rows}, f, indent=2)
+        print(f"\n💾 已寫入 {args.json}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+"""
+Context 組裝 (app/core/context.py) 的效益：檢索結果直接塞進 Prompt vs 合併重疊/去重/token 預算之後。
+以 create_pdf.py 的病歷內容、與 ingest 相同的 splitter 切 chunk，模擬檢索到同一份病歷相鄰/重疊的 chunk
+(分區模式的典型情況)，不足 k 個時混入其他病歷的 chunk，量測：
+- Prompt context 的估計 token 數 (組裝前 / 後)
+- 組裝耗時 p50 / p95
+- sources 仍涵蓋的 (source, page) 比例
+
+用法 (在專案根目錄執行):
+    python benchmarks/bench_context.py
+    python benchmarks/bench_context.py --k 3,6,10 --budget 600
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT)
+
+def report_text(p):
+    """與 create_pdf.py 版面相同的病歷文字 (PyPDFLoader 讀出來的樣子：每行一個欄位)"""
+    lines = ["CONFIDENTIAL MEDICAL REPORT", "ACT Genomics - Precision Medicine Center",
+             f"Patient Name: {p['name']}", f"Patient ID: ACT-2024-{p['id']}", f"DOB: {p['dob']} ({p['gender']})",
+             "--- CLINICAL HISTORY & PATHOLOGY ---", f"History: {p['history']}", f"Diagnosis: {p['pathology']}",
+             "--- DETECTED GENOMIC ALTERATIONS ---"]
+    for i, alt in enumerate(p["alterations"], 1):
+        lines += [f"{i}. {alt['gene']}", f"• VAF/Type: {alt['vaf']}", f"• Significance: {alt['sig']}"]
+    lines += ["--- TREATMENT RECOMMENDATIONS ---", p["treatment_logic"],
+              f"Recommended: {p['drug']}", f"Alternative: {p['alt_drug']}"]
+    return "\n".join(lines)
+
+def build_chunks(count=60, seed=0):
+    """
+    每份病歷一頁，內容為 1~4 次回診的報告 (病人表頭重複、檢測內容不同)，
+    以與 ingest 相同設定的 splitter 切 chunk，回傳 {source: [Document, ...]}
+    """
+    from langchain_core.documents import Document
+    from langchain_text_splitters import RecursiveCharacterTextSplitter
+    from benchmarks.bench_rag import synthetic_patients
+    from app.core.ingest import CHUNK_OVERLAP, CHUNK_SIZE
+
+    rng = random.Random(seed)
+    splitter = RecursiveCharacterTextSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP)
+    chunks = {}
+    templates = synthetic_patients(count, seed + 1)
+    for p in synthetic_patients(count, seed):
+        # 每次回診：同一位病人的表頭 + 不同的檢測內容
+        visits = [{**rng.choice(templates), "name": p["name"], "id": p["id"], "dob": p["dob"], "gender": p["gender"]}
+                  for _ in range(rng.randint(1, 4))]
+        text = "\n".join(report_text(v) for v in visits)
+        page = Document(page_content=text, metadata={"source": f"data/patient_report_{p['id']}.pdf", "page": 0})
+        chunks[page.metadata["source"]] = splitter.split_documents([page])
+    return chunks
+
+def sample_retrievals(chunks, k, count, seed=1):
+    """k 個檢索結果：大多來自同一份病歷的相鄰 chunk，少數來自其他病歷"""
+    rng = random.Random(seed)
+    sources = [s for s, c in chunks.items() if len(c) >= 2]
+    samples = []
+    for _ in range(count):
+        main = chunks[rng.choice(sources)]
+        start = rng.randrange(max(len(main) - k, 0) + 1)
+        docs = list(main[start:start + k])
+        while len(docs) < k:
+            docs.append(rng.choice(chunks[rng.choice(sources)]))
+        rng.shuffle(docs)
+        samples.append(docs)
+    return samples
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--k", default="3,6,10", help="逗號分隔的檢索片段數")
+    parser.add_argument("--budget", type=int, default=None, help="token 預算 (預設沿用 RAG_CONTEXT_TOKENS)")
+    parser.add_argument("--samples", type=int, default=200)
+    parser.add_argument("--output", help="把結果寫成 JSON 檔 (預設印在終端機)")
+    args = parser.parse_args()
+
+    from app.core.context import CONTEXT_TOKEN_BUDGET, assemble_context, estimate_tokens
+    from benchmarks.bench_rag import QUESTION_TEMPLATES
+    budget = CONTEXT_TOKEN_BUDGET if args.budget is None else args.budget
+    chunks = build_chunks()
+    report = {"config": {**vars(args), "budget": budget}, "k": {}}
+
+    for k in [int(x) for x in args.k.split(",") if x.strip()]:
+        tokens_in, tokens_out, latencies, coverage = [], [], [], []
+        for i, docs in enumerate(sample_retrievals(chunks, k, args.samples)):
+            query = QUESTION_TEMPLATES[i % len(QUESTION_TEMPLATES)].format(name="the patient")
+            started = time.perf_counter()
+            context = assemble_context(query, docs, budget)
+            latencies.append((time.perf_counter() - started) * 1000)
+            tokens_in.append(sum(estimate_tokens(d.page_content) for d in docs))
+            tokens_out.append(sum(estimate_tokens(d.page_content) for d in context))
+            pages_in = {(d.metadata["source"], d.metadata["page"]) for d in docs}
+            pages_out = {(d.metadata["source"], d.metadata["page"]) for d in context}
+            assert pages_out <= pages_in, "sources 出現了不在檢索結果中的頁面"
+            coverage.append(len(pages_out) / len(pages_in))
+        result = {
+            "tokens_in_mean": round(float(np.mean(tokens_in)), 1),
+            "tokens_out_mean": round(float(np.mean(tokens_out)), 1),
+            "tokens_out_max": int(np.max(tokens_out)),
+            "reduction": round(1 - float(np.sum(tokens_out)) / float(np.sum(tokens_in)), 3),
+            "page_coverage": round(float(np.mean(coverage)), 3),
+            "assemble_p50_ms": round(float(np.percentile(latencies, 50)), 3),
+            "assemble_p95_ms": round(float(np.percentile(latencies, 95)), 3),
+        }
+        report["k"][k] = result
+        print(f"k={k}: {result}")
+
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output)
+        print(f"💾 已寫入 {args.output}")
+    else:
+        print(output)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+"""
+Embedding 後端比較：torch (sentence-transformers) vs ONNX Runtime (fp32 / int8)。
+- 吞吐量：embed_documents 的 chunks/s，以及單一問題 embed_query 的延遲
+- 相容性：與參考後端 (第一個，預設 torch) 的逐筆 cosine similarity，
+  以及「參考後端建的索引 + 新後端的問題向量」的 top-k 檢索重疊率 (既有索引不重建時的實際情況)
+最小 cosine 低於 --tolerance 時以 exit code 1 結束，可直接放進 CI。
+
+用法 (在專案根目錄執行):
+    python benchmarks/bench_embeddings.py
+    python benchmarks/bench_embeddings.py --backends torch,onnx-int8 --chunks 2000 --threads 4
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT)
+
+def synthetic_chunks(count, seed=0):
+    """以 create_pdf.py 的病歷內容組出長短不一的 chunk (長度分布影響 length bucketing 的效益)"""
+    from create_pdf import patients_data
+    rng = random.Random(seed)
+    sentences = []
+    for p in patients_data:
+        sentences += [f"Patient Name: {p['name']}", f"DOB: {p['dob']} ({p['gender']})",
+                      f"History: {p['history']}", f"Diagnosis: {p['pathology']}",
+                      p["treatment_logic"], f"Recommended: {p['drug']}", f"Alternative: {p['alt_drug']}"]
+        for alt in p["alterations"]:
+            sentences.append(f"{alt['gene']} VAF/Type: {alt['vaf']}. Significance: {alt['sig']}")
+    return [" ".join(rng.choice(sentences) for _ in range(rng.randint(1, 12))) for _ in range(count)]
+
+def bench_backend(backend, chunks, queries, threads, batch_size):
+    from app.core import embeddings as emb
+    emb.EMBEDDING_BATCH_SIZE = batch_size
+    started = time.perf_counter()
+    model = emb.create_embeddings(backend, threads=threads)
+    load_s = time.perf_counter() - started
+    model.embed_documents(chunks[:8]) # 暖機 (第一次呼叫含 graph 最佳化/配置記憶體)
+
+    started = time.perf_counter()
+    doc_vectors = np.asarray(model.embed_documents(chunks), dtype=np.float32)
+    embed_s = time.perf_counter() - started
+
+    latencies = []
+    query_vectors = []
+    for q in queries:
+        started = time.perf_counter()
+        query_vectors.append(model.embed_query(q))
+        latencies.append((time.perf_counter() - started) * 1000)
+    return {
+        "load_s": round(load_s, 3),
+        "embed_s": round(embed_s, 3),
+        "chunks_per_s": round(len(chunks) / embed_s, 1),
+        "query_p50_ms": round(float(np.percentile(latencies, 50)), 2),
+        "query_p95_ms": round(float(np.percentile(latencies, 95)), 2),
+    }, doc_vectors, np.asarray(query_vectors, dtype=np.float32)
+
+def cosine_rows(a, b):
+    a = a / np.clip(np.linalg.norm(a, axis=1, keepdims=True), 1e-12, None)
+    b = b / np.clip(np.linalg.norm(b, axis=1, keepdims=True), 1e-12, None)
+    return (a * b).sum(axis=1)
+
+def topk_overlap(doc_vectors, reference_queries, queries, k):
+    """以參考後端的 chunk 向量為索引，比較參考問題向量與新問題向量的 top-k 命中重疊率"""
+    def topk(q):
+        distances = ((q[:, None, :] - doc_vectors[None, :, :]) ** 2).sum(axis=2)
+        return np.argsort(distances, axis=1)[:, :k]
+    expected, actual = topk(reference_queries), topk(queries)
+    return float(np.mean([len(set(e) & set(a)) / k for e, a in zip(expected, actual)]))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--backends", default="torch,onnx,onnx-int8", help="逗號分隔，第一個為參考後端")
+    parser.add_argument("--chunks", type=int, default=1000, help="合成 chunk 數")
+    parser.add_argument("--threads", type=int, default=0, help="推論執行緒數 (0 = runtime 預設)")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--tolerance", type=float, default=0.99, help="與參考後端的最小 cosine similarity")
+    parser.add_argument("--output", help="把結果寫成 JSON 檔 (預設印在終端機)")
+    args = parser.parse_args()
+
+    from benchmarks.bench_rag import QUESTION_TEMPLATES
+    backends = [b.strip() for b in args.backends.split(",") if b.strip()]
+    chunks = synthetic_chunks(args.chunks)
+    queries = [t.format(name="Chang, Wei-Ming") for t in QUESTION_TEMPLATES] * 8
+    report = {"config": vars(args), "cpu_count": os.cpu_count(), "backends": {}}
+
+    reference = None
+    failed = False
+    for backend in backends:
+        print(f"⏱️ {backend} ...")
+        result, doc_vectors, query_vectors = bench_backend(backend, chunks, queries, args.threads, args.batch_size)
+        if reference is None:
+            reference = (doc_vectors, query_vectors)
+            result["reference"] = True
+        else:
+            cos = cosine_rows(reference[0], doc_vectors)
+            result["cosine_min"] = round(float(cos.min()), 5)
+            result["cosine_mean"] = round(float(cos.mean()), 5)
+            result[f"top{args.top_k}_overlap"] = round(
+                topk_overlap(reference[0], reference[1], query_vectors, args.top_k), 4)
+            result["speedup"] = round(result["chunks_per_s"] / report["backends"][backends[0]]["chunks_per_s"], 2)
+            result["within_tolerance"] = result["cosine_min"] >= args.tolerance
+            failed |= not result["within_tolerance"]
+        report["backends"][backend] = result
+        print(f"  - {result}")
+
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output)
+        print(f"💾 已寫入 {args.output}")
+    else:
+        print(output)
+    if failed:
+        print(f"❌ 有後端與 {backends[0]} 的 cosine similarity 低於 {args.tolerance}")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
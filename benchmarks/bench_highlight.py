@@ -0,0 +1,99 @@
+"""
+關鍵句萃取與高亮的 micro-benchmark。
+比較舊版 (每個關鍵字各自 lower/compile/sub) 與 KeywordMatcher (單一 alternation、一次掃描)。
+
+用法 (在專案根目錄執行):
+    python benchmarks/bench_highlight.py [--chunks 3] [--rounds 2000]
+"""
+import os
+import re
+import sys
+import time
+import argparse
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.core.highlight import KeywordMatcher, sentence_spans
+
+# 模擬 create_pdf.py 產生的病歷片段 (約 1000 字元，與 ingest 的 chunk_size 相同)
+SAMPLE_CHUNK = """CONFIDENTIAL MEDICAL REPORT
+ACT Genomics - Precision Medicine Center
+Patient Name: Chang, Wei-Ming
+Patient ID: ACT-2024-001
+DOB: 1965-04-12 (Male)
+--- CLINICAL HISTORY & PATHOLOGY ---
+History: Smoking (20 pack-years). Persistent cough.
+Diagnosis: Lung Adenocarcinoma. Staging: cT2aN2M0, IIIA.
+--- DETECTED GENOMIC ALTERATIONS ---
+1. EGFR Exon 19 Deletion
+• VAF/Type: 28%
+• Significance: Pathogenic. Sensitizing for EGFR TKIs.
+2. TP53 R273C
+• VAF/Type: 15%
+• Significance: Pathogenic.
+3. PD-L1 Expression (TPS)
+• VAF/Type: 45%
+• Significance: Moderate expression.
+--- TREATMENT RECOMMENDATIONS ---
+EGFR Exon 19 Deletion indicates high sensitivity to EGFR-TKIs.
+Recommended: Osimertinib (Tagrisso) 80mg daily.
+Alternative: Gefitinib or Erlotinib
+建議用藥為 Osimertinib。病人目前無其他用藥紀錄。"""
+
+QUERIES = [
+    "What is the EGFR status of this patient?",
+    "recommended drug and alternative therapy",
+    "TP53 R273C VAF significance",
+    "建議用藥是什麼",
+]
+
+def legacy_extract_key_context(text, query):
+    """舊版 main.py 的實作 (僅供比較)"""
+    keywords = [kw for kw in query.split() if len(kw) > 1]
+    sentences = re.split(r'(?<=[.!?])\s+|\n', text)
+    sentences = [s.strip() for s in sentences if s.strip()]
+    selected_sentences = []
+    found_match = False
+    for sent in sentences:
+        if any(k.lower() in sent.lower() for k in keywords):
+            found_match = True
+            highlighted_sent = sent
+            for kw in keywords:
+                pattern = re.compile(re.escape(kw), re.IGNORECASE)
+                highlighted_sent = pattern.sub(lambda m: f"**{m.group(0)}**", highlighted_sent)
+            selected_sentences.append(highlighted_sent)
+    if found_match:
+        return " ... ".join(selected_sentences)
+    return " ".join(sentences[:2]) + " ..."
+
+def bench(label, fn, rounds):
+    started = time.perf_counter()
+    for _ in range(rounds):
+        fn()
+    per_call = (time.perf_counter() - started) / rounds * 1e6
+    print(f"  {label:<38} {per_call:9.1f} µs / request")
+    return per_call
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chunks", type=int, default=3, help="每個請求的檢索片段數 (k)")
+    parser.add_argument("--rounds", type=int, default=2000)
+    args = parser.parse_args()
+
+    chunks = [SAMPLE_CHUNK] * args.chunks
+    spans = [sentence_spans(c) for c in chunks] # ingest 時預先算好
+
+    for query in QUERIES:
+        print(f"\n🔎 {query!r} (k={args.chunks})")
+        legacy = bench("legacy (per-keyword regex)",
+                       lambda: [legacy_extract_key_context(c, query) for c in chunks], args.rounds)
+
+        def single_pass():
+            matcher = KeywordMatcher(query)
+            return [matcher.extract(c, s) for c, s in zip(chunks, spans)]
+        new = bench("KeywordMatcher + precomputed spans", single_pass, args.rounds)
+        print(f"  speedup: {legacy / new:.2f}x")
+        print(f"  sample : {single_pass()[0][:120]}")
+
+if __name__ == "__main__":
+    main()
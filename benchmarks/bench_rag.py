@@ -0,0 +1,386 @@
+"""
+端對端 benchmark：合成病歷語料 -> ingest 各階段計時 -> /chat 壓力測試。
+LLM 換成離線模擬 (app/core/fake_llm.py)，不需要 GOOGLE_API_KEY 也不會打外部 API，
+結果 (p50/p95/p99 延遲、吞吐量、peak RSS) 以 JSON 輸出，方便比較不同版本。
+
+用法 (在專案根目錄執行):
+    python benchmarks/bench_rag.py --reports 500 --concurrency 1,8,32 --requests 200
+    python benchmarks/bench_rag.py --reports 2000 --index-type hnsw --output bench_hnsw.json
+    # 對已啟動的服務壓測 (服務端請以 RAG_LLM=fake 啟動)：
+    python benchmarks/bench_rag.py --url http://localhost:8000 --skip-ingest
+    # 啟動 N 個 uvicorn worker 壓測，並回報每個 worker 的私有/共用記憶體 (比較 --workers 1,2,4)：
+    python benchmarks/bench_rag.py --reports 2000 --workers 4 --concurrency 32
+
+所有檔案 (data/、faiss_index/、.cache/) 都產生在 --workdir (預設為暫存資料夾)，不會動到專案本身的資料。
+"""
+import os
+import io
+import sys
+import json
+import time
+import random
+import shutil
+import asyncio
+import argparse
+import platform
+import tempfile
+import contextlib
+import subprocess
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT)
+
+SURNAMES = ["Chang", "Lee", "Wang", "Chen", "Lin", "Huang", "Wu", "Liu", "Tsai", "Yang"]
+GIVEN_NAMES = ["Wei-Ming", "Shu-Fen", "Da-Wei", "Mei-Ling", "Chih-Hao", "Ya-Ting", "Chun-Yu", "Hsin-Yi"]
+
+QUESTION_TEMPLATES = [
+    "What is the recommended drug for {name}?",
+    "What genomic alterations were detected?",
+    "What is the staging and diagnosis?",
+    "Is there an alternative treatment option?",
+    "What is the VAF of the pathogenic mutation?",
+    "病人有抽菸史嗎？",
+    "建議的標靶藥物是什麼？",
+]
+
+def peak_rss_mb():
+    """目前為止的 peak RSS (本 Process 與已結束的子 Process，例如 ingest 的解析 worker)"""
+    try:
+        import resource # 只有 Unix 有
+    except ImportError:
+        return _peak_rss_mb_without_resource()
+    scale = 1 / 1024 if platform.system() == "Linux" else 1 / (1024 * 1024) # Linux 單位為 KB，macOS 為 bytes
+    return {
+        "self": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale, 1),
+        "children": round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale, 1),
+    }
+
+def _peak_rss_mb_without_resource():
+    """Windows：有 psutil 時用本 Process 的 peak working set；子 Process 的 peak 無從取得"""
+    try:
+        import psutil
+    except ImportError:
+        return {"self": "n/a", "children": "n/a"}
+    info = psutil.Process().memory_info()
+    peak = getattr(info, "peak_wset", info.rss)
+    return {"self": round(peak / (1024 * 1024), 1), "children": "n/a"}
+
+def percentiles(latencies_ms):
+    if not latencies_ms:
+        return {}
+    arr = np.asarray(latencies_ms)
+    return {
+        "p50_ms": round(float(np.percentile(arr, 50)), 2),
+        "p95_ms": round(float(np.percentile(arr, 95)), 2),
+        "p99_ms": round(float(np.percentile(arr, 99)), 2),
+        "mean_ms": round(float(arr.mean()), 2),
+        "max_ms": round(float(arr.max()), 2),
+    }
+
+# --- 1. 合成語料 ---
+def synthetic_patients(count, seed=0):
+    """以 create_pdf.py 的 patients_data 為範本，產生 count 位病人 (換掉編號與姓名)"""
+    from create_pdf import patients_data
+    rng = random.Random(seed)
+    patients = []
+    for i in range(count):
+        p = dict(patients_data[i % len(patients_data)])
+        p["id"] = f"{i + 1:05d}"
+        p["name"] = f"{rng.choice(SURNAMES)}, {rng.choice(GIVEN_NAMES)}"
+        patients.append(p)
+    return patients
+
+def generate_corpus(patients):
+    from create_pdf import create_pdf_smart
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()): # create_pdf 每個檔案都會 print 一行
+        for p in patients:
+            create_pdf_smart(p)
+    return time.perf_counter() - started
+
+# --- 2. Ingest 各階段計時 ---
+def bench_ingest_stages(index_type, stage_db_path="bench_stages_index"):
+    """
+    單一 Process 依序執行 parse / split / embed / index / save，分別計時
+    (create_vector_db 中這些階段是串流交錯進行的，無法直接拆開)。
+    """
+    from langchain_text_splitters import RecursiveCharacterTextSplitter
+    from langchain_community.vectorstores import FAISS
+    from app.core import ingest
+    from app.core.embeddings import create_embeddings
+    from app.core.ann import build_search_index
+    from app.core.bm25 import BM25Index
+    from app.core.highlight import sentence_spans
+    from app.core.page_cache import iter_pages
+    from app.core.store import save_store
+
+    stages = {}
+    started = time.perf_counter()
+    embeddings = create_embeddings()
+    stages["model_load"] = time.perf_counter() - started
+
+    sources = ingest._list_pdf_sources()
+    hashes = {src: ingest.file_sha256(src) for src in sources}
+    page_cache_dir = stage_db_path + "_pages" # 空的頁面快取：第一次為實際解析 (含寫入快取)，第二次為快取命中
+    started = time.perf_counter()
+    pages = [page for src in sources for page in iter_pages(src, hashes[src], page_cache_dir)]
+    stages["parse"] = time.perf_counter() - started
+    started = time.perf_counter()
+    pages = [page for src in sources for page in iter_pages(src, hashes[src], page_cache_dir)]
+    stages["parse_cached"] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    splitter = RecursiveCharacterTextSplitter(chunk_size=ingest.CHUNK_SIZE, chunk_overlap=ingest.CHUNK_OVERLAP)
+    chunks = splitter.split_documents(pages)
+    for chunk in chunks:
+        chunk.metadata["sentence_spans"] = sentence_spans(chunk.page_content)
+    stages["split"] = time.perf_counter() - started
+
+    texts = [c.page_content for c in chunks]
+    started = time.perf_counter()
+    vectors = []
+    for i in range(0, len(texts), ingest.EMBED_BATCH_SIZE):
+        vectors.extend(embeddings.embed_documents(texts[i:i + ingest.EMBED_BATCH_SIZE]))
+    stages["embed"] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    store = FAISS.from_embeddings(list(zip(texts, vectors)), embeddings,
+                                  metadatas=[c.metadata for c in chunks])
+    search_index = None
+    if index_type != "flat":
+        search_index, _ = build_search_index(np.asarray(vectors, dtype=np.float32), index_type)
+    stages["index"] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    save_store(store, stage_db_path, search_index)
+    BM25Index.build(texts, [c.metadata.get("source") for c in chunks]).save(stage_db_path)
+    stages["save"] = time.perf_counter() - started
+
+    shutil.rmtree(stage_db_path, ignore_errors=True)
+    shutil.rmtree(page_cache_dir, ignore_errors=True)
+    return {
+        "files": len(sources), "pages": len(pages), "chunks": len(chunks),
+        "stages_s": {name: round(sec, 3) for name, sec in stages.items()},
+        "chunks_per_s_embed": round(len(chunks) / stages["embed"], 1) if stages["embed"] else None,
+    }
+
+def bench_ingest_end_to_end(index_type):
+    """
+    實際的 create_vector_db (平行解析 + 串流 Embedding)，完整重建。
+    第一次呼叫時頁面快取是空的；再呼叫一次即為「PDF 未變更、換索引類型/強制重建」的情況 (不必重新解析)。
+    """
+    from app.core.ingest import create_vector_db
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        success, msg = create_vector_db(incremental=False, index_type=index_type)
+    elapsed = time.perf_counter() - started
+    if not success:
+        raise RuntimeError(msg)
+    return round(elapsed, 3)
+
+# --- 3. /chat 壓力測試 ---
+def build_queries(patients, count, global_ratio, seed=1):
+    rng = random.Random(seed)
+    queries = []
+    for _ in range(count):
+        p = rng.choice(patients)
+        body = {"query": rng.choice(QUESTION_TEMPLATES).format(name=p["name"])}
+        if rng.random() >= global_ratio:
+            body["file_name"] = f"patient_report_{p['id']}.pdf"
+        queries.append(body)
+    return queries
+
+async def run_load(client, endpoint, queries, concurrency):
+    """concurrency 個 worker 持續送出請求，直到 queries 全部送完"""
+    latencies, errors, shed = [], 0, 0
+    pending = iter(queries)
+
+    async def worker():
+        nonlocal errors, shed
+        for body in pending:
+            started = time.perf_counter()
+            try:
+                response = await client.post(endpoint, json=body)
+                await response.aread()
+                status = response.status_code
+            except Exception:
+                status = None
+            if status == 200:
+                latencies.append((time.perf_counter() - started) * 1000)
+            elif status == 429: # LLM 排程器卸載 (見 app/core/llm_scheduler.py)
+                shed += 1
+            else:
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    wall = time.perf_counter() - started
+    return {
+        "concurrency": concurrency, "requests": len(queries), "errors": errors, "shed_429": shed,
+        "wall_s": round(wall, 3), "throughput_rps": round(len(latencies) / wall, 2) if wall else None,
+        **percentiles(latencies),
+    }
+
+def start_server(workers, port, timeout):
+    """在 workdir 啟動 uvicorn (多 worker)，等到 /ready 為止"""
+    import httpx
+    cmd = [sys.executable, "-m", "uvicorn", "main:app", "--app-dir", ROOT, "--host", "127.0.0.1",
+           "--port", str(port), "--workers", str(workers), "--log-level", "warning"]
+    env = dict(os.environ)
+    env.setdefault("OMP_NUM_THREADS", str(max(1, (os.cpu_count() or 1) // workers)))
+    server = subprocess.Popen(cmd, env=env, stdout=subprocess.DEVNULL)
+    started = time.perf_counter()
+    ready = 0
+    while time.perf_counter() - started < timeout:
+        if server.poll() is not None:
+            raise RuntimeError(f"uvicorn 已結束 (exit code {server.returncode})")
+        try:
+            # 每個 worker 各自預熱；連續數次都就緒才開始 (請求會被分到不同 worker)
+            ready = ready + 1 if httpx.get(f"http://127.0.0.1:{port}/ready", timeout=2).status_code == 200 else 0
+        except httpx.HTTPError:
+            ready = 0
+        if ready >= workers * 3:
+            print(f"🔥 {workers} 個 worker 就緒 ({time.perf_counter() - started:.2f}s)")
+            return server
+        time.sleep(0.2)
+    server.terminate()
+    raise RuntimeError(f"{timeout}s 內 API 未就緒")
+
+def worker_memory_mb(server_pid):
+    """
+    (Linux) 各 worker process 的記憶體：anon = 私有 (模型、Python 物件)，
+    file = 對應到檔案的頁面 (mmap 的索引/docstore，所有 worker 共用同一份 page cache)
+    """
+    result = []
+    for pid in os.listdir("/proc"):
+        if not pid.isdigit():
+            continue
+        try:
+            with open(f"/proc/{pid}/stat") as f:
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+            if ppid != server_pid:
+                continue
+            with open(f"/proc/{pid}/status") as f:
+                status = dict(line.split(":", 1) for line in f if line.startswith("Rss"))
+        except (OSError, ValueError, IndexError):
+            continue
+        result.append({"pid": int(pid), **{key[3:].lower(): round(int(value.split()[0]) / 1024, 1)
+                                             for key, value in status.items()}})
+    return result
+
+async def bench_load(args, queries_by_level):
+    import httpx
+    if args.url:
+        client = httpx.AsyncClient(base_url=args.url, timeout=args.timeout)
+    else:
+        import main # 在 workdir 中載入 API (讀取 workdir 的 faiss_index)
+        started = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            main.warmup_rag()
+        if not main.rag_status["ready"]:
+            raise RuntimeError(f"RAG 初始化失敗: {main.rag_status['error']}")
+        print(f"🔥 RAG 預熱完成 ({time.perf_counter() - started:.2f}s)")
+        client = httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app),
+                                   base_url="http://bench", timeout=args.timeout)
+
+    results = []
+    async with client:
+        for concurrency, queries in queries_by_level:
+            with contextlib.redirect_stdout(io.StringIO()): # /chat 每個請求都會 print
+                result = await run_load(client, args.endpoint, queries, concurrency)
+            print(f"  - concurrency={concurrency}: p50={result.get('p50_ms')}ms p95={result.get('p95_ms')}ms "
+                  f"p99={result.get('p99_ms')}ms {result['throughput_rps']} req/s, errors={result['errors']}")
+            results.append(result)
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--reports", type=int, default=200, help="合成病歷數量")
+    parser.add_argument("--workdir", help="產生 data/ 與 faiss_index/ 的資料夾 (預設為暫存資料夾，結束後刪除)")
+    parser.add_argument("--index-type", default="flat", help="flat / ivf / ivfpq / hnsw")
+    parser.add_argument("--skip-ingest", action="store_true", help="沿用 workdir 中既有的索引，只做壓力測試")
+    parser.add_argument("--skip-load", action="store_true", help="只測 ingest")
+    parser.add_argument("--concurrency", default="1,8,32", help="逗號分隔的並發數")
+    parser.add_argument("--requests", type=int, default=200, help="每個並發等級送出的請求數")
+    parser.add_argument("--endpoint", default="/chat", help="/chat 或 /chat/stream")
+    parser.add_argument("--global-ratio", type=float, default=0.2, help="不指定病歷 (全域搜尋) 的請求比例")
+    parser.add_argument("--url", help="對已啟動的 API 壓測 (預設在本 Process 內直接呼叫 ASGI app)")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="啟動 N 個 uvicorn worker 並對它壓測 (0 = 在本 Process 內直接呼叫 ASGI app)")
+    parser.add_argument("--port", type=int, default=8765, help="--workers 模式使用的埠號")
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--llm-latency-ms", type=float, default=300.0, help="模擬 LLM 首字延遲")
+    parser.add_argument("--llm-token-ms", type=float, default=10.0, help="模擬 LLM 每個 token 的間隔")
+    parser.add_argument("--answer-cache", action="store_true", help="保留回答快取 (預設關閉，量測真實路徑)")
+    parser.add_argument("--embedding-backend", help="torch / onnx / onnx-int8 (預設沿用 EMBEDDING_BACKEND)")
+    parser.add_argument("--output", help="把結果寫成 JSON 檔 (預設印在終端機)")
+    args = parser.parse_args()
+
+    # 必須在 import app.core.* 之前設定 (這些設定在 import 時讀取)
+    os.environ["RAG_LLM"] = "fake"
+    os.environ["FAKE_LLM_LATENCY_MS"] = str(args.llm_latency_ms)
+    os.environ["FAKE_LLM_TOKEN_MS"] = str(args.llm_token_ms)
+    if not args.answer_cache:
+        os.environ["ANSWER_CACHE_SIZE"] = "0"
+    if args.embedding_backend:
+        os.environ["EMBEDDING_BACKEND"] = args.embedding_backend
+
+    output_path = os.path.abspath(args.output) if args.output else None
+    workdir = args.workdir or tempfile.mkdtemp(prefix="medi-bench-")
+    os.makedirs(workdir, exist_ok=True)
+    os.chdir(workdir) # ingest/rag 的路徑都是相對於目前目錄
+    report = {
+        "config": {k: v for k, v in vars(args).items() if k not in ("workdir", "output")},
+        "python": platform.python_version(), "cpu_count": os.cpu_count(),
+    }
+    patients = synthetic_patients(args.reports)
+
+    try:
+        if not args.skip_ingest and not args.url:
+            print(f"📄 產生 {args.reports} 份合成病歷於 {workdir} ...")
+            report["corpus_generation_s"] = round(generate_corpus(patients), 3)
+            print("⏱️ Ingest 分階段計時 ...")
+            report["ingest"] = bench_ingest_stages(args.index_type)
+            print(f"  - {report['ingest']['stages_s']}")
+            print("⏱️ Ingest 端對端 (create_vector_db --full) ...")
+            report["ingest"]["end_to_end_s"] = bench_ingest_end_to_end(args.index_type)
+            print(f"  - {report['ingest']['end_to_end_s']}s")
+            print("⏱️ Ingest 端對端再重建一次 (PDF 未變更：頁面快取與 Embedding 快取皆命中) ...")
+            report["ingest"]["rebuild_page_cached_s"] = bench_ingest_end_to_end(args.index_type)
+            print(f"  - {report['ingest']['rebuild_page_cached_s']}s")
+            report["peak_rss_mb_after_ingest"] = peak_rss_mb()
+
+        if not args.skip_load:
+            levels = [int(c) for c in args.concurrency.split(",") if c.strip()]
+            queries_by_level = [(c, build_queries(patients, args.requests, args.global_ratio, seed=c))
+                                for c in levels]
+            server = None
+            if args.workers and not args.url:
+                server = start_server(args.workers, args.port, args.timeout)
+                args.url = f"http://127.0.0.1:{args.port}"
+            try:
+                print(f"🚦 壓力測試 {args.endpoint}：並發 {levels}，每級 {args.requests} 個請求 ...")
+                report["load"] = asyncio.run(bench_load(args, queries_by_level))
+                if server is not None and platform.system() == "Linux":
+                    report["worker_memory_mb"] = worker_memory_mb(server.pid)
+            finally:
+                if server is not None:
+                    server.terminate()
+                    server.wait()
+        report["peak_rss_mb"] = peak_rss_mb()
+    finally:
+        os.chdir(ROOT)
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if output_path:
+        with open(output_path, "w", encoding="utf-8") as f:
+            f.write(output)
+        print(f"💾 已寫入 {output_path}")
+    else:
+        print(output)
+
+if __name__ == "__main__":
+    main()
@@ -1,114 +1,399 @@
+import time
+_PROCESS_START = time.perf_counter() # 冷啟動計時起點 (越早越好)
+
 import os
 import sys
-import re
+import asyncio
+import json
+from typing import List
 from fastapi import FastAPI, HTTPException
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from pydantic import BaseModel
 
 # 強制修正路徑
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
 try:
-    from app.core.rag import get_rag_chain
+    from app.core.rag import (
+        get_rag_chain, aget_rag_chain, get_index_version, get_indexed_sources, aembed_query,
+        use_query_vector, register_reload_listener, abatch_answer, rag_status, refresh_index,
+    )
+    from app.core.ann import INDEX_TYPES
+    from app.core.jobs import IngestJobManager
+    from app.core.answer_cache import answer_cache, normalize_query
+    from app.core.highlight import KeywordMatcher
+    from app.core.metrics import FuncMetric, render as render_metrics
+    from app.core.singleflight import SingleFlight
+    from app.core.llm_scheduler import OverloadedError
+    from app.core.tracing import StageTimingCallback, finish_trace, span, start_trace
 except ImportError as e:
     print(f"❌ Import Error: {e}")
     sys.exit(1)
 
 app = FastAPI(title="Medi-Insight RAG API")
 
+# 索引重新載入時，回答快取一起清空
+register_reload_listener(answer_cache.invalidate)
+
 class QueryRequest(BaseModel):
     query: str
     file_name: str = None
 
+class BatchQueryRequest(BaseModel):
+    items: List[QueryRequest]
+
+class IngestJobRequest(BaseModel):
+    incremental: bool = True
+    index_type: str = None
+
+# 單次 /chat/batch 最多可送的問題數
+BATCH_MAX_ITEMS = int(os.getenv("CHAT_BATCH_MAX_ITEMS", "256"))
+
+# 背景 ingest：worker process 建好索引後，在這個 process 重新載入 (熱抽換，不需重啟)
+ingest_jobs = IngestJobManager(on_success=refresh_index)
+
+# 請求合併：同一病歷、同一問題 (正規化後)、同一索引版本且同時進行中的 /chat 與 /chat/stream，
+# 共用一次檢索 + LLM 呼叫 (例如查房時多位醫師同時對同一份病歷問同樣的問題)
+chat_flights = SingleFlight()
+
+FuncMetric("rag_chat_singleflight_total", "Chat executions vs. requests coalesced onto an in-flight execution.",
+           lambda: [({"result": name}, value) for name, value in chat_flights.stats.items()], kind="counter")
+FuncMetric("rag_chat_singleflight_inflight", "Chat executions currently shared by single-flight.",
+           chat_flights.in_flight)
+
 # --- ✨ 升級版：關鍵句萃取與高亮 (Key Sentence Extraction) ---
-def extract_key_context(text: str, query: str) -> str:
+def extract_key_context(text: str, query: str, matcher: KeywordMatcher = None) -> str:
     """
     只回傳包含關鍵字的句子，並加上高亮。
-    如果完全沒對到關鍵字(純語意相關)，則回傳前 200 字作為摘要。
+    如果完全沒對到關鍵字(純語意相關)，則回傳前 2 句作為摘要。
+    :param matcher: 同一個問題的多個片段請共用同一個 KeywordMatcher (只編譯一次)
     """
-    # 1. 取得關鍵字 (忽略太短的字)
-    keywords = [kw for kw in query.split() if len(kw) > 1]
-    
-    # 2. 簡單斷句 (針對英文句點、問號或換行切分)
-    # 這裡的邏輯是：遇到 . ? ! 或 換行 就切開
-    sentences = re.split(r'(?<=[.!?])\s+|\n', text)
-    
-    # 清理空白
-    sentences = [s.strip() for s in sentences if s.strip()]
-
-    selected_sentences = []
-    found_match = False
-
-    for sent in sentences:
-        # 檢查這句話有沒有包含任何一個關鍵字 (Case Insensitive)
-        if any(k.lower() in sent.lower() for k in keywords):
-            found_match = True
-            
-            # 進行高亮處理
-            highlighted_sent = sent
-            for kw in keywords:
-                pattern = re.compile(re.escape(kw), re.IGNORECASE)
-                highlighted_sent = pattern.sub(lambda m: f"**{m.group(0)}**", highlighted_sent)
-            
-            selected_sentences.append(highlighted_sent)
-
-    # 3. 組合結果
-    if found_match:
-        # 如果有找到關鍵句，用 " ... " 連接，讓閱讀感像摘要
-        return " ... ".join(selected_sentences)
-    else:
-        # --- 防呆機制 ---
-        # 如果 RAG 找到了段落(因為語意相似)，但沒有精確關鍵字
-        # 我們回傳前 2 句就好，不要整坨丟出來
-        fallback = " ".join(sentences[:2])
-        return f"{fallback} ..."
+    if matcher is None:
+        matcher = KeywordMatcher(query)
+    return matcher.extract(text)
+
+def warmup_rag():
+    """(背景 Thread) 預載入 RAG 組件，並記錄冷啟動時間"""
+    try:
+        get_rag_chain()
+    except Exception as e:
+        rag_status["error"] = str(e)
+        print(f"❌ RAG 預載入失敗: {str(e)}")
+    cold_start = time.perf_counter() - _PROCESS_START
+    rag_status["timings"]["cold_start"] = round(cold_start, 3)
+    rag_status["warmup_done"] = True
+    state = "ready" if rag_status["ready"] else "NOT ready"
+    print(f"⏱️ 冷啟動完成 ({state})：{cold_start:.2f}s，各階段 {rag_status['timings']}")
 
 @app.on_event("startup")
 async def startup_event():
-    print("🚀 API 啟動中，正在預載入 RAG 模型...")
-    get_rag_chain() 
+    # 不在 startup 中同步載入 (會擋住 uvicorn 開始服務)，改在背景預熱；
+    # 是否可以接流量請看 /ready
+    print("🚀 API 啟動中，背景預載入 RAG 模型...")
+    asyncio.get_running_loop().run_in_executor(None, warmup_rag)
+
+@app.get("/health")
+async def health_endpoint():
+    """Liveness：Process 活著就回 200"""
+    return {"status": "ok"}
+
+@app.get("/ready")
+async def ready_endpoint():
+    """Readiness：Embedding 模型、索引與 LLM 都載入完成才回 200，否則 503"""
+    body = {"ready": rag_status["ready"], "warmup_done": rag_status.get("warmup_done", False),
+            "error": rag_status["error"],
+            "index_version": get_index_version(), "timings": rag_status["timings"]}
+    return JSONResponse(body, status_code=200 if rag_status["ready"] else 503)
+
+@app.get("/files")
+async def list_files_endpoint():
+    """data/ 底下的 PDF 病歷檔，以及各自是否已在服務中的索引裡"""
+    data_dir = "data"
+    names = sorted(f for f in os.listdir(data_dir) if f.lower().endswith(".pdf")) if os.path.isdir(data_dir) else []
+    indexed = get_indexed_sources()
+    return {"files": [{"name": name, "indexed": resolve_source(name) in indexed} for name in names],
+            "index_version": get_index_version()}
+
+def resolve_source(file_name):
+    """把前端傳來的檔名轉成 metadata 中的 source 路徑"""
+    if not file_name:
+        return None
+    return os.path.join("data", file_name).replace("\\", "/")
+
+def format_sources(docs, query):
+    """整理檢索到的片段，作為回應中的 sources 清單"""
+    with span("highlight"):
+        return _format_sources(docs, query)
+
+def _format_sources(docs, query):
+    # 整個問題只編譯一次關鍵字比對器，所有片段共用
+    matcher = KeywordMatcher(query)
+    sources_list = []
+    for doc in docs:
+        # 取得原始文字
+        raw_content = doc.page_content
+        
+        # --- 關鍵修改：呼叫新的萃取邏輯 ---
+        # 我們不再無腦 replace \n，因為 \n 在病歷中通常代表一個新的項目
+        # ingest 時已預先斷句 (sentence_spans)，舊索引沒有的話現場斷句
+        refined_content = matcher.extract(raw_content, doc.metadata.get("sentence_spans"))
+
+        sources_list.append({
+            "source": os.path.basename(doc.metadata.get("source", "Unknown")),
+            "page": doc.metadata.get("page", 0) + 1,
+            "content": refined_content 
+        })
+    return sources_list
+
+async def lookup_cached_answer(target_source, query):
+    """
+    查回答快取，回傳 (快取結果或 None, 問題向量)。
+    只有啟用語意比對時才需要先算問題向量。
+    """
+    with span("cache_lookup"):
+        query_vector = await aembed_query(query) if answer_cache.semantic_enabled else None
+        cached = answer_cache.get(target_source, get_index_version(), query, query_vector)
+    return cached, query_vector
+
+async def answer_events(rag_chain, target_source, query, index_version, query_vector, trace):
+    """
+    (single-flight 的 producer) 執行 RAG Chain，依序產出 (event, data)：sources、token ...、done。
+    完成時寫入回答快取；合併進來的請求都收到同一份事件。
+    """
+    sources_list, answer_parts = None, []
+    # Chain 裡只有 LLM 那一步會向排程器取得名額 (interactive lane)；忙碌時丟出 OverloadedError，所有合併進來的請求都會收到。
+    # sources 等到 LLM 送出第一個 token 才發出：被拒絕時還沒有任何事件，/chat/stream 仍能回 429
+    # 查語意快取時已算過問題向量：檢索直接沿用，快取未命中不會多做一次 Embedding
+    with use_query_vector(query, query_vector):
+        async for chunk in rag_chain.astream({"input": query}, config={"callbacks": [StageTimingCallback(trace)]}):
+            if "context" in chunk:
+                sources_list = format_sources(chunk["context"], query)
+            if chunk.get("answer"):
+                if not answer_parts:
+                    yield "sources", sources_list or []
+                answer_parts.append(chunk["answer"])
+                yield "token", {"text": chunk["answer"]}
+    if not answer_parts:
+        yield "sources", sources_list or []
+    answer = "".join(answer_parts)
+    answer_cache.put(target_source, index_version, query, {"answer": answer, "sources": sources_list or []}, query_vector)
+    yield "done", {"answer": answer}
+
+def join_answer(rag_chain, target_source, query, index_version, query_vector, trace):
+    """加入 (或開始) 這個問題的執行，回傳 (事件 iterator, 是否為實際執行者)"""
+    key = (target_source or "", normalize_query(query), index_version)
+    events, leader = chat_flights.join(
+        key, lambda: answer_events(rag_chain, target_source, query, index_version, query_vector, trace))
+    if not leader:
+        print("🔗 相同問題正在處理中，共用同一次回答")
+    return events, leader
+
+def overloaded_response(error):
+    """LLM 排程器拒絕 (佇列已滿 / 預估等待超過上限 / 供應商限速)：429 + Retry-After，前端的 ApiClient 會依此退避重試"""
+    return JSONResponse({"detail": str(error), "reason": error.reason}, status_code=429,
+                        headers={"Retry-After": error.retry_after_header})
 
 @app.post("/chat")
 async def chat_endpoint(request: QueryRequest):
+    # 每個階段的耗時記在 trace 中 (/metrics 與慢請求 log)
+    trace = start_trace("/chat", file_name=request.file_name)
+    status = "error"
     try:
         print(f"📩 收到提問: {request.query}")
 
-        target_source = None
-        if request.file_name:
-            target_source = os.path.join("data", request.file_name)
-            target_source = target_source.replace("\\", "/")
+        target_source = resolve_source(request.file_name)
 
-        rag_chain = get_rag_chain(selected_source=target_source)
+        rag_chain = await aget_rag_chain(selected_source=target_source)
         
         if not rag_chain:
             raise HTTPException(status_code=503, detail="RAG init failed.")
 
-        response = rag_chain.invoke({"input": request.query})
-        
-        sources_list = []
-        if "context" in response:
-            for doc in response["context"]:
-                # 取得原始文字
-                raw_content = doc.page_content
-                
-                # --- 關鍵修改：呼叫新的萃取邏輯 ---
-                # 我們不再無腦 replace \n，因為 \n 在病歷中通常代表一個新的項目
-                refined_content = extract_key_context(raw_content, request.query)
-
-                sources_list.append({
-                    "source": os.path.basename(doc.metadata.get("source", "Unknown")),
-                    "page": doc.metadata.get("page", 0) + 1,
-                    "content": refined_content 
-                })
-
-        return {
-            "answer": response["answer"],
-            "sources": sources_list
-        }
+        index_version = get_index_version()
+        cached, query_vector = await lookup_cached_answer(target_source, request.query)
+        if cached is not None:
+            print("⚡ 回答快取命中")
+            status = "cache_hit"
+            return cached
 
+        # 非同步執行：檢索在 Thread Pool 中進行，Gemini 走 async client，不會卡住 event loop
+        # 相同問題同時進行中時直接共用那一次的結果
+        events, leader = join_answer(rag_chain, target_source, request.query, index_version, query_vector, trace)
+        result = {"answer": "", "sources": []}
+        async for event, data in events:
+            if event == "sources":
+                result["sources"] = data
+            elif event == "done":
+                result["answer"] = data["answer"]
+        status = "ok" if leader else "coalesced"
+        return result
+
+    except OverloadedError as e:
+        print(f"🚦 {str(e)}")
+        status = "shed"
+        return overloaded_response(e)
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"❌ 處理錯誤: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        finish_trace(trace, status)
+
+def sse_event(event, data):
+    """組成一筆 Server-Sent Event"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+@app.post("/chat/stream")
+async def chat_stream_endpoint(request: QueryRequest):
+    """
+    串流版 /chat (SSE)：
+    先送出 sources (檢索完成就送)，再逐段送出 token，最後送 done。
+    LLM 排程器拒絕時回 429 + Retry-After (等到第一個事件，也就是 LLM 開始回答，才開始回應，所以還來得及回非 200)。
+    """
+    print(f"📩 收到串流提問: {request.query}")
+    target_source = resolve_source(request.file_name)
+    rag_chain = await aget_rag_chain(selected_source=target_source)
+    if not rag_chain:
+        raise HTTPException(status_code=503, detail="RAG init failed.")
+
+    trace = start_trace("/chat/stream", file_name=request.file_name)
+    try:
+        index_version = get_index_version()
+        cached, query_vector = await lookup_cached_answer(target_source, request.query)
+        if cached is not None:
+            print("⚡ 回答快取命中")
+            finish_trace(trace, "cache_hit")
+            events = [("sources", cached["sources"]), ("token", {"text": cached["answer"]}),
+                      ("done", {"answer": cached["answer"]})]
+            return sse_response(sse_event(event, data) for event, data in events)
+
+        # 相同問題同時進行中時訂閱同一次執行 (已送出的事件會先重播)
+        events, leader = join_answer(rag_chain, target_source, request.query, index_version,
+                                     query_vector, trace)
+        first = await anext(events, None) # 檢索完成且排程器已放行 LLM
+    except OverloadedError as e:
+        print(f"🚦 {str(e)}")
+        finish_trace(trace, "shed")
+        return overloaded_response(e)
+    except Exception as e:
+        print(f"❌ 串流處理錯誤: {str(e)}")
+        finish_trace(trace, "error")
+        raise HTTPException(status_code=500, detail=str(e))
+
+    async def event_stream():
+        status = "error"
+        try:
+            if first is not None:
+                yield sse_event(*first)
+            async for event, data in events:
+                yield sse_event(event, data)
+            status = "ok" if leader else "coalesced"
+        except Exception as e:
+            print(f"❌ 串流處理錯誤: {str(e)}")
+            yield sse_event("error", {"detail": str(e)})
+        finally:
+            finish_trace(trace, status)
+
+    return sse_response(event_stream())
+
+def sse_response(body):
+    return StreamingResponse(
+        body,
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+@app.post("/chat/batch")
+async def chat_batch_endpoint(request: BatchQueryRequest):
+    """
+    批次問答 (給夜間品質審查之類的大量提問)：
+    全部問題一次 Embedding、批次 FAISS 檢索，再平行送進 LLM。
+    單題失敗只會在該題回傳 error，不影響其他題。
+    """
+    if len(request.items) > BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=413, detail=f"Too many items (max {BATCH_MAX_ITEMS}).")
+    if not await aget_rag_chain():
+        raise HTTPException(status_code=503, detail="RAG init failed.")
+
+    print(f"📦 收到批次提問: {len(request.items)} 題")
+    trace = start_trace("/chat/batch", items=len(request.items))
+    requests = [(item.query, 3, resolve_source(item.file_name)) for item in request.items]
+    try:
+        outcomes = await abatch_answer(requests)
+    except Exception as e:
+        print(f"❌ 批次處理錯誤: {str(e)}")
+        finish_trace(trace, "error")
+        raise HTTPException(status_code=500, detail=str(e))
+
+    results = []
+    for item, (docs, answer) in zip(request.items, outcomes):
+        result = {"query": item.query, "file_name": item.file_name}
+        if isinstance(answer, OverloadedError):
+            # 這一題在 batch lane 排不到 LLM (互動請求優先)，稍後再送一次即可
+            result["error"] = str(answer)
+            result["retry_after"] = round(answer.retry_after, 1)
+        elif isinstance(answer, Exception):
+            result["error"] = str(answer)
+        else:
+            result["answer"] = answer
+            result["sources"] = format_sources(docs, item.query)
+        results.append(result)
+    finish_trace(trace, "ok")
+    return {"results": results}
+
+@app.get("/cache/stats")
+async def cache_stats_endpoint():
+    """回答快取的命中率與計數，以及請求合併 (single-flight) 的計數 (每個 key 的計數取合併最多的前幾名)"""
+    return {
+        "answer_cache": {**answer_cache.stats, "hit_rate": round(answer_cache.hit_rate(), 4),
+                         "entries": len(answer_cache)},
+        "coalescing": {**chat_flights.stats, "in_flight": chat_flights.in_flight(),
+                       "keys": [{"source": source, "query": query, "index_version": version, **counters}
+                                for (source, query, version), counters in chat_flights.top_keys()]},
+        "index_version": get_index_version(),
+    }
+
+@app.post("/ingest/jobs", status_code=202)
+async def submit_ingest_job(request: IngestJobRequest):
+    """送出背景 ingest job (同時只能有一個)，之後以 GET /ingest/jobs/{job_id} 查詢進度"""
+    if request.index_type and request.index_type.lower() not in INDEX_TYPES:
+        raise HTTPException(status_code=422, detail=f"index_type 必須是 {', '.join(INDEX_TYPES)}")
+    job, running = ingest_jobs.submit(request.incremental, request.index_type)
+    if job is None:
+        raise HTTPException(status_code=409, detail={"message": "已有 ingest job 執行中",
+                                                     "job": running.to_dict()})
+    return job.to_dict()
+
+@app.get("/ingest/jobs")
+async def list_ingest_jobs():
+    return {"jobs": [job.to_dict() for job in ingest_jobs.list_jobs()]}
+
+@app.get("/ingest/jobs/{job_id}")
+async def get_ingest_job(job_id: str):
+    """job 狀態：running -> reloading -> succeeded / failed / cancelled，progress 含檔案與 chunk 進度"""
+    job = ingest_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found.")
+    return job.to_dict()
+
+@app.post("/ingest/jobs/{job_id}/cancel")
+async def cancel_ingest_job(job_id: str):
+    """要求取消 (在下一個檢查點停止；新快照發布後就無法取消)"""
+    job = ingest_jobs.cancel(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found.")
+    return job.to_dict()
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    """Prometheus 格式的指標：各階段延遲 histogram、請求數、索引大小/版本、快取計數"""
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4; charset=utf-8")
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    # API_WORKERS > 1：多個 worker process 以 mmap 共用同一份索引快照 (page cache)，
+    # 每個 worker 只各自多一份 Embedding 模型；執行緒數依 worker 數平分 CPU，避免互搶
+    workers = int(os.getenv("API_WORKERS", "1"))
+    if workers > 1:
+        os.environ.setdefault("OMP_NUM_THREADS", str(max(1, (os.cpu_count() or 1) // workers)))
+    uvicorn.run("main:app" if workers > 1 else app, host="0.0.0.0", port=8000, workers=workers)
\ No newline at end of file
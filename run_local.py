@@ -3,12 +3,43 @@ import time
 import sys
 import os
 import signal
+import json
+import urllib.request
+import urllib.error
 
 # 定義要執行的指令
 # 注意：在地端我們用 127.0.0.1 比較安全，也不需要 nohup
 backend_cmd = [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", "8000", "--reload"]
 frontend_cmd = [sys.executable, "-m", "streamlit", "run", "web_ui.py", "--server.port", "8501"]
 
+READY_URL = "http://127.0.0.1:8000/ready"
+READY_TIMEOUT = int(os.getenv("READY_TIMEOUT", "300"))
+
+def wait_for_backend(backend_process, timeout=READY_TIMEOUT):
+    """
+    輪詢後端 /ready，直到模型與索引載入完成 (取代固定 sleep)。
+    預熱結束但沒有就緒 (例如還沒 ingest) 時也不再等待。
+    """
+    started = time.time()
+    while time.time() - started < timeout:
+        if backend_process.poll() is not None:
+            print("❌ 後端程序已結束，請檢查上方錯誤訊息。")
+            return False
+        try:
+            with urllib.request.urlopen(READY_URL, timeout=2) as resp:
+                print(f"✅ 後端已就緒 ({time.time() - started:.1f}s)")
+                return True
+        except urllib.error.HTTPError as e:
+            body = json.loads(e.read() or b"{}")
+            if body.get("warmup_done"):
+                print(f"⚠️ 後端預熱完成但尚未就緒: {body.get('error')}")
+                return False
+        except (urllib.error.URLError, OSError):
+            pass # 還沒開始 listen
+        time.sleep(0.5)
+    print(f"⚠️ 等待 {timeout}s 後端仍未就緒，先啟動前端。")
+    return False
+
 def run_services():
     print("🚀 正在啟動 Medi-Insight RAG 系統...")
     
@@ -16,8 +47,8 @@ def run_services():
     print("🔥 啟動後端 API (FastAPI)...")
     backend_process = subprocess.Popen(backend_cmd)
     
-    # 等待幾秒確保後端已經起來 (避免前端連不到)
-    time.sleep(3)
+    # 等待後端真正就緒 (避免前端連不到，或模型還沒載完)
+    wait_for_backend(backend_process)
     
     # 2. 啟動前端 (Frontend)
     print("✨ 啟動前端 UI (Streamlit)...")
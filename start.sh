@@ -2,13 +2,38 @@
 
 # 1. 啟動後端 (關鍵修改：拿掉 nohup 和 log redirection，讓 Log 直接吐到螢幕)
 # 這樣你在 docker run 的視窗就能看到 "Application startup complete"
-echo "🚀 Starting Backend (FastAPI)..."
-uvicorn main:app --host 0.0.0.0 --port 8000 &
+# API_WORKERS > 1 時啟動多個 worker，共用同一份 mmap 索引；執行緒數依 worker 數平分 CPU
+API_WORKERS=${API_WORKERS:-1}
+if [ "$API_WORKERS" -gt 1 ] && [ -z "$OMP_NUM_THREADS" ]; then
+    threads=$(( $(nproc) / API_WORKERS ))
+    export OMP_NUM_THREADS=$(( threads > 0 ? threads : 1 ))
+fi
+echo "🚀 Starting Backend (FastAPI, ${API_WORKERS} worker(s))..."
+uvicorn main:app --host 0.0.0.0 --port 8000 --workers "$API_WORKERS" &
 
-# 2. 等待機制 (稍微加長一點，確保 Transformer 模型載入完畢)
-echo "⏳ Waiting for RAG Model to load (10s)..."
-sleep 10
+# 2. 等待機制：輪詢 /ready，直到 Embedding 模型與索引真的載入完成 (不再固定 sleep)
+#    如果預熱結束但仍未就緒 (例如還沒有 faiss_index)，就不再等待，讓使用者可以從 UI 執行 Ingest
+READY_TIMEOUT=${READY_TIMEOUT:-300}
+echo "⏳ Waiting for RAG backend to become ready (timeout ${READY_TIMEOUT}s)..."
+waited=0
+while true; do
+    body=$(curl -s http://localhost:8000/ready)
+    if echo "$body" | grep -q '"ready":true'; then
+        echo "✅ Backend ready after ${waited}s"
+        break
+    fi
+    if echo "$body" | grep -q '"warmup_done":true'; then
+        echo "⚠️ Backend warm-up finished but not ready: ${body}"
+        break
+    fi
+    if [ "$waited" -ge "$READY_TIMEOUT" ]; then
+        echo "⚠️ Backend not ready after ${READY_TIMEOUT}s, starting frontend anyway."
+        break
+    fi
+    sleep 1
+    waited=$((waited + 1))
+done
 
 # 3. 啟動前端 (這是主程序，不能背景執行)
 echo "✨ Starting Frontend (Streamlit)..."
-streamlit run web_ui.py --server.port 8501 --server.address 0.0.0.0
\ No newline at end of file
+streamlit run web_ui.py --server.port 8501 --server.address 0.0.0.0
@@ -0,0 +1,6 @@
+import os
+import sys
+
+# 測試在專案根目錄的 import 路徑下執行 (與 benchmarks/ 相同)
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT)
@@ -0,0 +1,68 @@
+import mmap
+import random
+from collections import Counter
+import numpy as np
+from app.core.bm25 import B, K1, BM25Index, has_bm25, tokenize
+
+GENES = ["EGFR", "KRAS", "ALK", "EML4-ALK", "HER2", "BRAF", "TP53", "PIK3CA"]
+WORDS = ["mutation", "amplification", "sensitive", "resistant", "osimertinib", "肺腺癌", "標靶治療", "stage", "iv"]
+
+def corpus(count=400, sources=20, seed=0):
+    rng = random.Random(seed)
+    texts = [" ".join(rng.choice(GENES + WORDS) for _ in range(rng.randint(3, 30))) for _ in range(count)]
+    # source 與文件編號交錯 (增量 ingest 後 FAISS 位置不會依 source 排好)
+    doc_sources = [f"data/patient_report_{rng.randrange(sources):03d}.pdf" for _ in range(count)]
+    return texts, doc_sources
+
+def reference_scores(texts, doc_sources, query, source=None):
+    """直接由原文逐文件計算 BM25 分數，指定 source 時以 NumPy mask 過濾 (對照組)"""
+    counts = [Counter(tokenize(text)) for text in texts]
+    doclen = np.asarray([sum(c.values()) for c in counts], dtype=np.float64)
+    scores = np.zeros(len(texts))
+    for term in dict.fromkeys(tokenize(query)):
+        df = sum(1 for c in counts if term in c)
+        if not df:
+            continue
+        idf = np.log(1.0 + (len(texts) - df + 0.5) / (df + 0.5))
+        tf = np.asarray([c.get(term, 0) for c in counts], dtype=np.float64)
+        scores += idf * tf * (K1 + 1.0) / (tf + K1 * (1.0 - B + B * doclen / doclen.mean()))
+    if source is not None:
+        scores[np.asarray(doc_sources) != source] = 0.0
+    return scores
+
+def assert_top_k(got, scores, k):
+    expected = np.sort(scores[scores > 0])[::-1][:k]
+    assert len(got) == len(expected)
+    assert np.allclose(scores[got], expected, rtol=1e-5)
+
+def test_filtered_search_reads_only_the_source_slice_and_matches_reference():
+    texts, doc_sources = corpus()
+    index = BM25Index.build(texts, doc_sources)
+    for query in ("EGFR mutation osimertinib", "EML4-ALK 肺腺癌", "stage iv HER2 amplification"):
+        assert_top_k(index.search(query, 10), reference_scores(texts, doc_sources, query), 10)
+        for source in sorted(set(doc_sources)):
+            got = index.search(query, 5, source)
+            assert_top_k(got, reference_scores(texts, doc_sources, query, source), 5)
+            assert all(doc_sources[d] == source for d in got)
+
+    # 每個詞的 postings 依 source 排序，分區查詢只取該 source 的區段
+    term = index.vocab["egfr"]
+    start, end = index.offsets[term], index.offsets[term + 1]
+    assert np.all(np.diff(index.postsrc[start:end]) >= 0)
+    code = index.source_codes[doc_sources[0]]
+    docs, _ = index._postings(term, code)
+    assert len(docs) == int(np.sum(index.postsrc[start:end] == code))
+
+def test_save_and_load_keep_source_sorted_postings(tmp_path):
+    texts, doc_sources = corpus(50)
+    index = BM25Index.build(texts, doc_sources)
+    index.save(str(tmp_path))
+    assert has_bm25(str(tmp_path))
+    loaded = BM25Index.load(str(tmp_path))
+    assert np.array_equal(loaded.postsrc, index.postsrc)
+    # 詞彙表以 mmap 開啟、二分搜尋查詞 (不建立 dict)
+    assert isinstance(loaded.vocab.blob, mmap.mmap) and len(loaded.vocab) == len(index.vocab)
+    for term in ("egfr", "eml4-alk", "肺腺", "osimertinib"):
+        assert loaded.vocab[term] == index.vocab[term]
+    assert "nivolumab" not in loaded.vocab and loaded.vocab.get("") is None
+    assert np.array_equal(loaded.search("KRAS resistant", 5, doc_sources[3]), index.search("KRAS resistant", 5, doc_sources[3]))
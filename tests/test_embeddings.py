@@ -0,0 +1,127 @@
+import json
+import numpy as np
+import pytest
+from app.core.embedding_cache import CachedEmbeddings, EmbeddingCache
+from app.core.embeddings import create_embeddings, embedding_id, embedding_signature
+
+# int8 量化後的向量與 torch 後端逐筆 cosine similarity 的下限
+INT8_TOLERANCE = 0.99
+
+SAMPLE_CHUNKS = [
+    "Patient Name: Chen Wei-Ming\nPatient ID: ACT-2024-001\nDOB: 1965-03-12 (Male)",
+    "History: 20 pack-year smoker, presented with persistent cough and weight loss.",
+    "Diagnosis: Lung Adenocarcinoma, Stage IV. EGFR L858R VAF/Type: 23.4% (Missense). "
+    "Significance: Sensitive to EGFR TKIs.",
+    "Recommended: Osimertinib 80mg daily. Alternative: Gefitinib. Monitor liver function every 4 weeks.",
+    "Breast cancer, HER2 amplification detected. Trastuzumab recommended.",
+    "KRAS G12C",
+]
+
+@pytest.fixture(scope="module")
+def model_dir(tmp_path_factory):
+    """
+    與 all-MiniLM-L6-v2 同結構的 sentence-transformers 模型資料夾 (隨機權重、就地訓練的 WordPiece)，
+    測試不需要連網下載模型；比較的是後端之間的數值誤差，與權重是否訓練過無關。
+    """
+    torch = pytest.importorskip("torch")
+    pytest.importorskip("onnxruntime")
+    pytest.importorskip("transformers")
+    from transformers import BertConfig, BertModel, PreTrainedTokenizerFast
+    from tokenizers import Tokenizer, models, normalizers, pre_tokenizers, processors, trainers
+
+    path = tmp_path_factory.mktemp("minilm")
+    torch.manual_seed(0)
+    config = BertConfig(vocab_size=500, hidden_size=384, num_hidden_layers=2, num_attention_heads=12,
+                        intermediate_size=1536, max_position_embeddings=512)
+    BertModel(config).eval().save_pretrained(path)
+
+    tokenizer = Tokenizer(models.WordPiece(unk_token="[UNK]"))
+    tokenizer.normalizer = normalizers.BertNormalizer(lowercase=True)
+    tokenizer.pre_tokenizer = pre_tokenizers.BertPreTokenizer()
+    special = ["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]"]
+    tokenizer.train_from_iterator(SAMPLE_CHUNKS * 5, trainers.WordPieceTrainer(vocab_size=500, special_tokens=special))
+    tokenizer.post_processor = processors.TemplateProcessing(
+        single="[CLS] $A [SEP]", special_tokens=[(t, tokenizer.token_to_id(t)) for t in ("[CLS]", "[SEP]")])
+    tokenizer.save(str(path / "tokenizer.json"))
+    PreTrainedTokenizerFast(tokenizer_object=tokenizer, unk_token="[UNK]", pad_token="[PAD]",
+                            cls_token="[CLS]", sep_token="[SEP]", mask_token="[MASK]").save_pretrained(path)
+
+    (path / "1_Pooling").mkdir()
+    (path / "modules.json").write_text(json.dumps([
+        {"idx": 0, "name": "0", "path": "", "type": "sentence_transformers.models.Transformer"},
+        {"idx": 1, "name": "1", "path": "1_Pooling", "type": "sentence_transformers.models.Pooling"},
+        {"idx": 2, "name": "2", "path": "2_Normalize", "type": "sentence_transformers.models.Normalize"},
+    ]))
+    (path / "1_Pooling" / "config.json").write_text(json.dumps(
+        {"word_embedding_dimension": 384, "pooling_mode_mean_tokens": True, "pooling_mode_cls_token": False}))
+    (path / "sentence_bert_config.json").write_text(json.dumps({"max_seq_length": 256, "do_lower_case": False}))
+    return str(path)
+
+def torch_vectors(model_dir, texts):
+    """torch 後端 (sentence-transformers) 的向量；沒安裝時以 transformers 做相同的 mean pooling + normalize"""
+    try:
+        return np.asarray(create_embeddings("torch", model_name=model_dir).embed_documents(texts), dtype=np.float32)
+    except ImportError:
+        import torch
+        from transformers import AutoModel, AutoTokenizer
+        tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        model = AutoModel.from_pretrained(model_dir).eval()
+        batch = tokenizer(texts, padding=True, truncation=True, max_length=256, return_tensors="pt")
+        with torch.no_grad():
+            hidden = model(**batch).last_hidden_state
+        mask = batch["attention_mask"][..., None].float()
+        pooled = (hidden * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1e-9)
+        return torch.nn.functional.normalize(pooled, dim=1).numpy()
+
+def cosine(a, b):
+    return (a * b).sum(axis=1) / (np.linalg.norm(a, axis=1) * np.linalg.norm(b, axis=1))
+
+@pytest.mark.parametrize("backend,tolerance", [("onnx", 0.9999), ("onnx-int8", INT8_TOLERANCE)])
+def test_onnx_matches_torch_backend(model_dir, tmp_path, monkeypatch, backend, tolerance):
+    from app.core import embeddings
+    monkeypatch.setattr(embeddings, "EMBEDDING_ONNX_DIR", str(tmp_path))
+    reference = torch_vectors(model_dir, SAMPLE_CHUNKS)
+    onnx = create_embeddings(backend, model_name=model_dir)
+    vectors = np.asarray(onnx.embed_documents(SAMPLE_CHUNKS), dtype=np.float32)
+    assert vectors.shape == reference.shape
+    assert cosine(vectors, reference).min() >= tolerance
+    # 問題向量走同一條路徑 (單筆、沒有 padding)
+    query = np.asarray([onnx.embed_query(SAMPLE_CHUNKS[2])], dtype=np.float32)
+    assert cosine(query, reference[2:3]).min() >= tolerance
+
+def test_embedding_cache_is_separated_by_backend_and_precision(tmp_path):
+    assert embedding_signature("onnx-int8", "m") == {"model": "m", "backend": "onnx-int8", "precision": "int8"}
+    ids = {embedding_id(backend, "m") for backend in ("torch", "onnx", "onnx-int8")}
+    assert len(ids) == 3
+
+    class Constant:
+        def __init__(self, value):
+            self.value = value
+
+        def embed_documents(self, texts):
+            return [[self.value, 0.0] for _ in texts]
+
+    fp32 = CachedEmbeddings(lambda: Constant(1.0), embedding_id("torch", "m"),
+                            EmbeddingCache(embedding_id("torch", "m"), str(tmp_path)))
+    assert fp32.embed_documents(["same chunk"]) == [[1.0, 0.0]]
+    # 換成 int8：同樣的文字不能拿到 fp32 的快取向量
+    int8 = CachedEmbeddings(lambda: Constant(2.0), embedding_id("onnx-int8", "m"),
+                            EmbeddingCache(embedding_id("onnx-int8", "m"), str(tmp_path)))
+    assert int8.embed_documents(["same chunk"]) == [[2.0, 0.0]]
+    assert int8.misses == 1 and int8.hits == 0
+
+def test_cache_recovers_from_crash_between_vector_and_key_writes(tmp_path):
+    cache = EmbeddingCache("m|onnx|fp32", str(tmp_path))
+    cache.put_many([b"a" * 16], [[1.0, 0.0]])
+    # 模擬中斷：向量已寫入、key 還沒寫
+    with open(cache._file("vectors.f32"), "ab") as f:
+        f.write(np.asarray([[9.0, 9.0]], dtype=np.float32).tobytes())
+
+    reopened = EmbeddingCache("m|onnx|fp32", str(tmp_path))
+    assert len(reopened) == 1
+    reopened.put_many([b"b" * 16], [[0.0, 1.0]])
+    assert reopened.get(b"b" * 16).tolist() == [0.0, 1.0]
+
+    again = EmbeddingCache("m|onnx|fp32", str(tmp_path))
+    assert again.get(b"a" * 16).tolist() == [1.0, 0.0]
+    assert again.get(b"b" * 16).tolist() == [0.0, 1.0]
@@ -0,0 +1,199 @@
+import asyncio
+import pytest
+from langchain_core.runnables import RunnablePassthrough
+from app.core import fake_llm, llm_scheduler as scheduler_module
+from app.core.fake_llm import FakeChatModel
+from app.core.llm_scheduler import LLMScheduler, OverloadedError, ScheduledRunnable
+
+# 以離線 FakeChatModel 與很小的上限測試 LLM 排程器 (不需要 Gemini 或索引)
+
+@pytest.fixture(autouse=True)
+def reset_fake_quota():
+    # FakeChatModel 的配額視窗是整個 process 共用的
+    fake_llm._quota_calls.clear()
+    yield
+    fake_llm._quota_calls.clear()
+
+def fast_llm(**kwargs):
+    return FakeChatModel(latency_ms=0, token_ms=0, answer_tokens=3, **kwargs)
+
+async def hold(scheduler, lane, started, release):
+    """取得名額後一直佔著，直到 release 被設定"""
+    async with scheduler.slot(lane):
+        started.set()
+        await release.wait()
+
+def test_interactive_jumps_ahead_of_queued_batch():
+    async def main():
+        scheduler = LLMScheduler(max_concurrency=1, queue_size=8)
+        scheduler._service_seconds = 0.01
+        order = []
+
+        async def job(lane, name):
+            async with scheduler.slot(lane):
+                order.append(name)
+                await asyncio.sleep(0)
+
+        started, release = asyncio.Event(), asyncio.Event()
+        holder = asyncio.create_task(hold(scheduler, "batch", started, release))
+        await started.wait()
+        jobs = [asyncio.create_task(job("batch", f"b{i}")) for i in range(3)]
+        await asyncio.sleep(0)
+        jobs.append(asyncio.create_task(job("interactive", "i0")))
+        await asyncio.sleep(0)
+        assert scheduler.queued("batch") == 3 and scheduler.queued("interactive") == 1
+        release.set()
+        await asyncio.gather(holder, *jobs)
+        assert order == ["i0", "b0", "b1", "b2"]
+
+    asyncio.run(main())
+
+def test_batch_flood_does_not_shed_interactive():
+    async def main():
+        scheduler = LLMScheduler(max_concurrency=1, queue_size=2, batch_queue_size=4,
+                                 max_wait={"interactive": 5, "batch": 5})
+        scheduler._service_seconds = 0.01
+        started, release = asyncio.Event(), asyncio.Event()
+        holder = asyncio.create_task(hold(scheduler, "batch", started, release))
+        await started.wait()
+
+        async def job(lane):
+            async with scheduler.slot(lane):
+                pass
+
+        batch = [asyncio.create_task(job("batch")) for _ in range(4)]
+        await asyncio.sleep(0)
+        with pytest.raises(OverloadedError) as shed:
+            await job("batch")
+        assert shed.value.reason == "queue_full"
+        interactive = [asyncio.create_task(job("interactive")) for _ in range(2)]
+        await asyncio.sleep(0)
+        assert scheduler.queued("interactive") == 2
+        release.set()
+        await asyncio.gather(holder, *batch, *interactive)
+        assert scheduler.stats[("interactive", "shed_queue_full")] == 0
+
+    asyncio.run(main())
+
+def test_deadline_shedding_returns_retry_after():
+    async def main():
+        scheduler = LLMScheduler(max_concurrency=1, queue_size=8)
+        scheduler._service_seconds = 5.0
+        started, release = asyncio.Event(), asyncio.Event()
+        holder = asyncio.create_task(hold(scheduler, "interactive", started, release))
+        await started.wait()
+
+        # 預估等待 (5 秒) 超過上限：不排隊直接拒絕
+        with pytest.raises(OverloadedError) as shed:
+            async with scheduler.slot("interactive", max_wait=1):
+                pass
+        assert shed.value.reason == "deadline"
+        assert shed.value.retry_after >= 1 and shed.value.retry_after_header == "5"
+
+        # 預估來得及但實際排隊逾時：移出佇列後拒絕
+        scheduler._service_seconds = 0.01
+        with pytest.raises(OverloadedError) as shed:
+            async with scheduler.slot("interactive", max_wait=0.05):
+                pass
+        assert shed.value.reason == "deadline" and shed.value.retry_after > 0
+        assert scheduler.queued() == 0
+        release.set()
+        await holder
+        assert scheduler.stats[("interactive", "shed_deadline")] == 2
+        assert scheduler.running == 0
+
+    asyncio.run(main())
+
+def test_provider_rate_limit_becomes_overloaded_and_pauses():
+    async def main():
+        scheduler = LLMScheduler(max_concurrency=2, queue_size=8)
+        llm = ScheduledRunnable(fast_llm(quota_rpm=1), "interactive", scheduler)
+        assert (await llm.ainvoke("hello")).content
+
+        with pytest.raises(OverloadedError) as limited:
+            await llm.ainvoke("hello again")
+        assert limited.value.reason == "provider_rate_limit"
+        assert 50 < limited.value.retry_after <= 60 # FakeChatModel 的訊息帶有 "retry in N s"
+        assert scheduler.stats[("interactive", "rate_limited")] == 1
+        assert scheduler.running == 0
+
+        # 暫停期間新的呼叫不會送到供應商，直接以 deadline 拒絕
+        with pytest.raises(OverloadedError) as shed:
+            await llm.ainvoke("third")
+        assert shed.value.reason == "deadline" and shed.value.retry_after > 50
+        assert len(fake_llm._quota_calls) == 1
+
+    asyncio.run(main())
+
+def test_cancel_while_queued_releases_slot():
+    async def main():
+        scheduler = LLMScheduler(max_concurrency=1, queue_size=8)
+        scheduler._service_seconds = 0.01
+        await scheduler._acquire("interactive", 5) # 佔住唯一的名額
+
+        async def job():
+            async with scheduler.slot("interactive"):
+                await asyncio.sleep(10)
+
+        # 還在排隊時取消：移出佇列
+        waiting = asyncio.create_task(job())
+        await asyncio.sleep(0)
+        assert scheduler.queued() == 1
+        waiting.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiting
+        assert scheduler.queued() == 0 and scheduler.running == 1
+
+        # 剛被放行、還沒開始執行就取消：名額要還回去
+        admitted = asyncio.create_task(job())
+        await asyncio.sleep(0)
+        scheduler._release()
+        assert scheduler.running == 1 and scheduler.queued() == 0 # 名額已交給 admitted
+        admitted.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await admitted
+        assert scheduler.running == 0
+
+        # 名額已釋放，新的請求可以馬上執行
+        async with scheduler.slot("interactive", max_wait=0.1):
+            assert scheduler.running == 1
+
+    asyncio.run(main())
+
+def test_scheduled_runnable_holds_slot_only_for_the_llm_step():
+    async def main():
+        scheduler = LLMScheduler(max_concurrency=1, queue_size=8)
+        seen = []
+
+        def retrieve(_):
+            seen.append(scheduler.running)
+            return []
+
+        chain = RunnablePassthrough.assign(context=retrieve).assign(
+            answer=(lambda x: x["input"]) | ScheduledRunnable(fast_llm(), "interactive", scheduler))
+        chunks = [chunk async for chunk in chain.astream({"input": "question"})]
+        assert seen == [0] # 檢索期間沒有佔用 LLM 名額
+        assert any("answer" in chunk for chunk in chunks)
+        assert scheduler.running == 0 and scheduler.stats[("interactive", "admitted")] == 1
+
+    asyncio.run(main())
+
+def test_chat_endpoints_return_429_with_retry_after(monkeypatch):
+    from fastapi.testclient import TestClient
+    import main
+    from app.core import rag
+
+    # 供應商剛回報限速：排程器暫停 30 秒，interactive 最多只等 10 秒 -> 直接 429
+    scheduler = LLMScheduler(max_concurrency=2, queue_size=8)
+    scheduler.pause(30)
+    monkeypatch.setattr(scheduler_module, "llm_scheduler", scheduler)
+    monkeypatch.setattr(rag, "llm", fast_llm())
+    chain = RunnablePassthrough.assign(context=lambda _: []).assign(answer=rag.get_qa_chain())
+    monkeypatch.setattr(rag, "get_rag_chain", lambda selected_source=None, k=3: chain)
+
+    client = TestClient(main.app) # 不進 with 區塊：不觸發 startup 的模型預載
+    for path in ("/chat", "/chat/stream"):
+        response = client.post(path, json={"query": "What is the diagnosis?"})
+        assert response.status_code == 429, path
+        assert response.headers["Retry-After"] == "30"
+        assert response.json()["reason"] == "deadline"
@@ -0,0 +1,42 @@
+import asyncio
+import numpy as np
+from app.core import rag
+
+class CountingEmbeddings:
+    def __init__(self):
+        self.calls = []
+
+    def embed_documents(self, texts):
+        self.calls.append(list(texts))
+        return [[float(len(t)), 1.0] for t in texts]
+
+def test_embed_queries_reuses_provided_vectors(monkeypatch):
+    fake = CountingEmbeddings()
+    monkeypatch.setattr(rag, "embeddings", fake)
+    requests = [("first", 3, None), ("second question", 3, None)]
+    vectors = rag._embed_queries(requests, (None, None), [[9.0, 9.0], None])
+    assert fake.calls == [["second question"]] # 只計算沒有提供向量的問題
+    assert np.array_equal(vectors, np.asarray([[9.0, 9.0], [15.0, 1.0]], dtype=np.float32))
+
+    rag._embed_queries(requests, (None, None), [[1.0, 0.0], [0.0, 1.0]])
+    assert len(fake.calls) == 1 # 全部都有提供：不做 forward pass
+
+def test_retriever_uses_query_vector_from_cache_lookup(monkeypatch):
+    seen = []
+
+    async def fake_search(query, k=3, selected_source=None, embedding=None):
+        seen.append((query, embedding))
+        return []
+
+    monkeypatch.setattr(rag, "asearch_documents", fake_search)
+    retriever = rag.PartitionedRetriever(k=3)
+
+    async def main():
+        with rag.use_query_vector("What is the diagnosis?", [0.5, 0.5]):
+            await retriever.ainvoke("What is the diagnosis?")
+            await retriever.ainvoke("another question") # 不同的問題不會誤用
+        await retriever.ainvoke("What is the diagnosis?")
+
+    asyncio.run(main())
+    assert seen == [("What is the diagnosis?", [0.5, 0.5]), ("another question", None),
+                    ("What is the diagnosis?", None)]
@@ -0,0 +1,25 @@
+import numpy as np
+import pytest
+from langchain_core.documents import Document
+from langchain_core.embeddings import DeterministicFakeEmbedding
+from app.core.store import SourcePositions, load_source_positions, load_store, save_store
+
+def test_source_positions_are_memory_mapped(tmp_path):
+    FAISS = pytest.importorskip("langchain_community.vectorstores").FAISS
+    sources = ["data/a.pdf", "data/b.pdf", "data/a.pdf", "data/c.pdf", "data/b.pdf", "data/a.pdf"]
+    docs = [Document(page_content=f"chunk {i}", metadata={"source": src, "page": 0})
+            for i, src in enumerate(sources)]
+    embeddings = DeterministicFakeEmbedding(size=8)
+    save_store(FAISS.from_documents(docs, embeddings), str(tmp_path))
+
+    positions = load_source_positions(str(tmp_path))
+    assert isinstance(positions, SourcePositions)
+    assert set(positions) == {"data/a.pdf", "data/b.pdf", "data/c.pdf"}
+    assert positions["data/a.pdf"].tolist() == [0, 2, 5]
+    assert positions["data/b.pdf"].tolist() == [1, 4]
+    assert isinstance(positions["data/c.pdf"], np.memmap) # 各 source 是共用 mmap 陣列的切片
+    assert positions.get("data/missing.pdf") is None
+
+    store = load_store(str(tmp_path), embeddings)
+    for source, rows in positions.items():
+        assert all(store.docstore.search(str(pos)).metadata["source"] == source for pos in rows)
@@ -1,7 +1,8 @@
 import streamlit as st
 import requests
 import os
-import sys
+import json
+from app.core.api_client import ApiClient, CircuitOpenError
 
 # --- 1. 全局配置 & CSS ---
 st.set_page_config(
@@ -36,6 +37,17 @@ st.markdown("""
 
 # --- 2. 動態讀取 data 資料夾 ---
 DATA_FOLDER = "data"
+BACKEND_URL = os.getenv("API_URL", "http://localhost:8000")
+INGEST_POLL_SECONDS = 1.0
+# 檔案清單與後端狀態的快取秒數 (Streamlit 每次互動都會 rerun，不必每次都打 API)
+STATUS_TTL_SECONDS = 5
+
+@st.cache_resource
+def get_api_client():
+    """所有 session 與 rerun 共用同一個 Client (連線池、重試、斷路器)"""
+    return ApiClient(BACKEND_URL)
+
+api = get_api_client()
 
 def get_pdf_files():
     """掃描 data 資料夾下的所有 PDF"""
@@ -46,12 +58,119 @@ def get_pdf_files():
     files.sort()
     return files
 
-pdf_files = get_pdf_files()
+@st.cache_data(ttl=STATUS_TTL_SECONDS, show_spinner=False)
+def fetch_pdf_files():
+    """向後端取得病歷清單 (失敗時丟出例外，不會被快取)"""
+    response = api.get("/files")
+    response.raise_for_status()
+    return [f["name"] for f in response.json()["files"]]
+
+@st.cache_data(ttl=STATUS_TTL_SECONDS, show_spinner=False)
+def fetch_backend_status():
+    """後端 /ready 狀態；503 代表尚未就緒而不是過載，不重試"""
+    try:
+        response = api.get("/ready", retry=False, timeout=(2, 3))
+        return response.json()
+    except CircuitOpenError as e:
+        return {"ready": False, "error": str(e), "unreachable": True}
+    except (requests.exceptions.RequestException, ValueError):
+        return {"ready": False, "error": "無法連線至後端 API", "unreachable": True}
+
+try:
+    pdf_files = fetch_pdf_files()
+except (requests.exceptions.RequestException, ValueError, KeyError):
+    pdf_files = get_pdf_files() # 後端暫時連不上時，退回讀取本機 data/ 資料夾
+
+def iter_sse_events(response):
+    """解析後端 /chat/stream 的 Server-Sent Events，逐筆產出 (event, data)"""
+    event, data_lines = "message", []
+    for line in response.iter_lines(decode_unicode=True):
+        if line is None:
+            continue
+        if line == "":
+            if data_lines:
+                yield event, json.loads("\n".join(data_lines))
+            event, data_lines = "message", []
+        elif line.startswith("event:"):
+            event = line[len("event:"):].strip()
+        elif line.startswith("data:"):
+            data_lines.append(line[len("data:"):].strip())
+
+def render_ingest_job(job, progress_bar, status_text):
+    """把後端 ingest job 的進度畫到 progress bar 與說明文字"""
+    progress = job.get("progress", {})
+    files_total = progress.get("files_total") or 0
+    files_done = progress.get("files_done", 0)
+    ratio = files_done / files_total if files_total else 0.0
+    if job["status"] != "running":
+        ratio = 1.0
+    progress_bar.progress(min(ratio, 1.0))
+    status_text.caption(
+        f"階段: {progress.get('stage')} ｜ 檔案 {files_done}/{files_total} ｜ "
+        f"片段 已解析 {progress.get('chunks_parsed', 0)}、已 Embedding {progress.get('chunks_embedded', 0)}"
+    )
+
+@st.fragment(run_every=INGEST_POLL_SECONDS)
+def ingest_job_panel():
+    """
+    背景 ingest job 的進度 (實際工作在後端 worker process，這裡只顯示進度)。
+    每 INGEST_POLL_SECONDS 秒只重跑這個 fragment、查一次狀態，不會卡住整個頁面：
+    輪詢期間取消按鈕與對話都能正常使用。job 結束時結果存進 session_state 並整頁 rerun。
+    """
+    job_id = st.session_state.get("ingest_job_id")
+    if not job_id:
+        return
+    try:
+        response = api.get(f"/ingest/jobs/{job_id}")
+    except CircuitOpenError as e:
+        st.error(f"⚡ {e}")
+        return
+    except requests.exceptions.ConnectionError:
+        st.error("❌ 無法連線至後端 API，請確認是否已執行 `python main.py`。")
+        return
+    if response.status_code != 200:
+        # 例如後端重啟後 job 已不存在 (404)：停止輪詢，不然每次 rerun 都會失敗
+        st.session_state.pop("ingest_job_id", None)
+        st.warning(f"無法取得 Ingest 進度 ({response.status_code})，後端可能已重啟；請確認索引狀態後再重新執行。")
+        return
+    job = response.json()
+
+    if job["status"] in ("succeeded", "failed", "cancelled"):
+        st.session_state.ingest_job_id = None
+        st.session_state.ingest_result = job
+        # 索引換了：清掉檔案清單與後端狀態的快取，整頁 rerun 顯示結果與新的索引版本
+        fetch_pdf_files.clear()
+        fetch_backend_status.clear()
+        st.rerun()
+
+    st.caption("⏳ 後端正在讀取 data/ 資料夾並更新向量庫...")
+    render_ingest_job(job, st.progress(0.0), st.empty())
+    if st.button("⏹️ 取消 Ingest", key="cancel_ingest"):
+        api.post(f"/ingest/jobs/{job_id}/cancel")
+        st.caption("已送出取消要求...")
+
+def show_ingest_result(job):
+    if job["status"] == "succeeded":
+        st.success(f"索引更新成功！(索引版本 v{job.get('index_version')})")
+    elif job["status"] == "cancelled":
+        st.warning("Ingest 已取消，沿用原本的索引")
+    else:
+        st.error(f"更新失敗: {job.get('error')}")
+    if job.get("log"):
+        with st.expander("執行細節"):
+            st.text(job["log"])
 
 # --- 3. 側邊欄：檔案選擇 ---
 with st.sidebar:
     st.image("https://cdn-icons-png.flaticon.com/512/3063/3063176.png", width=50)
     st.markdown("### Medi-Insight **Workspace**")
+    backend = fetch_backend_status()
+    if backend.get("ready"):
+        st.caption(f"🟢 後端就緒 (索引版本 v{backend.get('index_version')})")
+    elif backend.get("unreachable"):
+        st.caption(f"🔴 {backend.get('error')}")
+    else:
+        st.caption(f"🟡 後端尚未就緒: {backend.get('error') or '預熱中'}")
     st.markdown("---")
     
     st.markdown("#### 📂 選擇病歷檔案 (Data Source)")
@@ -64,24 +183,27 @@ with st.sidebar:
         st.warning("⚠️ data/ 資料夾中沒有 PDF 檔案")
         st.caption("請先執行 create_pdf.py 生成檔案")
 
-    # Ingest 功能
-    if st.button("🔄 重建索引 (Ingest)"):
-        with st.spinner("正在讀取 data/ 資料夾並更新向量庫..."):
-            try:
-                sys.path.append(os.path.dirname(os.path.abspath(__file__)))
-                from app.core.ingest import create_vector_db
-                success, log = create_vector_db()
-                if success:
-                    st.success("索引更新成功！")
-                    with st.expander("執行細節"):
-                        st.text(log)
-                else:
-                    st.error("更新失敗")
-                    st.text(log)
-            except ImportError:
-                st.error("找不到 app.core.ingest 模組，請確認路徑。")
-            except Exception as e:
-                st.error(f"執行錯誤: {e}")
+    # Ingest 功能：交給後端背景 job 執行，完成後後端自動換上新索引
+    try:
+        if st.button("🔄 重建索引 (Ingest)"):
+            response = api.post("/ingest/jobs", json={"incremental": True})
+            if response.status_code in (202, 409):
+                body = response.json()
+                job = body if response.status_code == 202 else body["detail"]["job"]
+                st.session_state.ingest_job_id = job["job_id"]
+                st.session_state.ingest_result = None
+            else:
+                st.error(f"無法啟動 Ingest ({response.status_code}): {response.text}")
+    except CircuitOpenError as e:
+        st.error(f"⚡ {e}")
+    except requests.exceptions.ConnectionError:
+        st.error("❌ 無法連線至後端 API，請確認是否已執行 `python main.py`。")
+
+    # 進行中的 job 只在這個 fragment 裡輪詢；結束後的結果保留到下一次 Ingest
+    if st.session_state.get("ingest_job_id"):
+        ingest_job_panel()
+    elif st.session_state.get("ingest_result"):
+        show_ingest_result(st.session_state.ingest_result)
 
     st.markdown("---")
     if st.button("🗑️ 清除對話紀錄"):
@@ -131,39 +253,59 @@ if prompt := st.chat_input("請輸入關於此病歷的問題..."):
         # Assistant
         with st.chat_message("assistant", avatar="🧬"):
             message_placeholder = st.empty()
+            evidence_container = st.container()
             try:
                 with st.spinner("🔍 RAG 檢索分析中..."):
-                    backend_host = os.getenv("API_URL", "http://localhost:8000")
-                    api_url = f"{backend_host}/chat"
-                    
                     # ✅ 關鍵：將 file_name 傳給後端
                     payload = {
                         "query": prompt, 
                         "file_name": selected_file 
                     }
                     
-                    response = requests.post(api_url, json=payload, timeout=60)
+                    # 串流模式：(連線逾時, 每段資料之間的讀取逾時)；後端忙碌 (429/503) 時會自動退避重試
+                    response = api.post("/chat/stream", json=payload, stream=True, timeout=(5, 60))
                     
-                    if response.status_code == 200:
-                        data = response.json()
-                        full_response = data.get("answer", "")
-                        sources_data = data.get("sources", [])
-                        
+                if response.status_code == 200:
+                    response.encoding = "utf-8"
+                    full_response = ""
+                    sources_data = []
+                    stream_error = None
+
+                    # 先收到 sources (檢索完成)，接著逐段收到回答
+                    for event, data in iter_sse_events(response):
+                        if event == "sources":
+                            sources_data = data
+                            if sources_data:
+                                with evidence_container:
+                                    with st.status("✅ 佐證資料 (Evidence)"):
+                                        for idx, src in enumerate(sources_data):
+                                            st.info(f"**{src['source']}** (Page {src['page']})\n\n{src['content']}")
+                        elif event == "token":
+                            full_response += data.get("text", "")
+                            message_placeholder.markdown(full_response + "▌")
+                        elif event == "error":
+                            stream_error = data.get("detail", "")
+                            break
+
+                    if stream_error is not None:
+                        message_placeholder.error(f"⚠️ 後端錯誤: {stream_error}")
+                    else:
                         message_placeholder.markdown(full_response)
-                        
-                        if sources_data:
-                            with st.status("✅ 佐證資料 (Evidence)"):
-                                for idx, src in enumerate(sources_data):
-                                    st.info(f"**{src['source']}** (Page {src['page']})\n\n{src['content']}")
-                        
                         st.session_state.messages.append({
                             "role": "assistant", 
                             "content": full_response,
                             "sources": sources_data
                         })
-                    else:
-                        err_msg = f"⚠️ 後端錯誤 ({response.status_code}): {response.text}"
-                        message_placeholder.error(err_msg)
-            
+                elif response.status_code == 429:
+                    # 重試後仍被 LLM 排程器拒絕 (尖峰時段或配額用完)
+                    retry_after = response.headers.get("Retry-After", "")
+                    message_placeholder.warning(f"🚦 系統忙碌中，請約 {retry_after or '幾'} 秒後再問一次。")
+                else:
+                    err_msg = f"⚠️ 後端錯誤 ({response.status_code}): {response.text}"
+                    message_placeholder.error(err_msg)
+                response.close() # 串流讀完 (或中斷) 後把連線還給連線池
+
+            except CircuitOpenError as e:
+                message_placeholder.error(f"⚡ {e}")
             except requests.exceptions.ConnectionError:
                 message_placeholder.error("❌ 無法連線至後端 API (localhost:8000)。請確認是否已執行 `python main.py`。")
\ No newline at end of file